@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Store, query and expire tfplan/tfapply logs and plans.
+
+Each deployment has an artifact store in DEPLOY/artifacts (see STORE_NAME):
+
+    index.jsonl             one JSON record per plan or apply run
+    lock                    locked while the store is changed (the index
+                            itself is replaced when records expire)
+    collected               last (automatic) expiry, see COLLECT_INTERVAL
+    segments/NNNNNN.log.gz  logs, each a separate gzip member appended to the
+                            current segment (so `zcat` works on a segment,
+                            and one log can be read by seeking to it)
+    plans/SHA256.plan       plan files, stored once for identical plans
+    profiles/*.prof         helper profiles (see phasetime.py), expired
+                            with the records
+
+Index records have the plan timestamp ('stamp', e.g. '20150501-123456' or
+'20150501-123456-destroy'), 'kind' ('plan' or 'apply'), 'exit' code,
+'targets', 'time' (seconds since the epoch), log 'segment', 'offset' and
+'length', and 'plan' digest (or null). Storing a run also expires old
+records (see collect) if that was last done more than a day ago.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+STORE_NAME = str('artifacts')
+INDEX_NAME = str('index.jsonl')
+LOCK_NAME = str('lock')
+COLLECTED_NAME = str('collected')
+SEGMENTS = str('segments')
+PLANS = str('plans')
+
+# Profiles directory in artifact store (or .terraform without deployment)
+PROFILES = str('profiles')
+
+# A new log segment is started when the current one is at least this large
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Default retention: records newer than DAYS, and at least the last KEEP
+RETENTION_DAYS = 90
+RETENTION_KEEP = 20
+
+# Seconds between automatic expiry of records when runs are stored
+COLLECT_INTERVAL = 86400
+
+# Buffer size for copying logs and plans
+CHUNK_SIZE = 1024 * 1024
+
+KINDS = ('plan', 'apply')
+
+# Loose plan artifacts (from before the store) removed by gc when expired
+LOOSE = re.compile(r'^[0-9]{8}-[0-9]{6}(-destroy)?'
+                   r'\.(plan|failed|log|targets|fingerprint)$')
+
+
+def store_path(deployment, *names):
+    """Get path in deployment artifact store.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param names: path components in store
+    :type names: str
+    :returns: path
+    :rtype: str
+    """
+    return os.path.join(deployment, STORE_NAME, *names)
+
+
+def lock_store(deployment):
+    """Lock deployment artifact store, creating it if necessary.
+
+    The lock is on a separate file, as the index is replaced by collect().
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: lock file (closing it releases the lock)
+    :rtype: file
+    """
+    for name in (SEGMENTS, PLANS):
+        if not os.path.isdir(store_path(deployment, name)):
+            os.makedirs(store_path(deployment, name))
+    lock_file = open(store_path(deployment, LOCK_NAME), 'a')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+
+def read_index(deployment):
+    """Read index records of deployment artifact store.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: index records (oldest first)
+    :rtype: list(dict)
+    """
+    records = []
+    try:
+        with open(store_path(deployment, INDEX_NAME)) as index_file:
+            for line in index_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # partly written record
+                    pass
+    except IOError:
+        pass
+    return records
+
+
+def segment_names(deployment):
+    """Get log segment filenames of deployment artifact store.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: segment filenames (oldest first)
+    :rtype: list(str)
+    """
+    try:
+        return sorted(name for name in os.listdir(
+            store_path(deployment, SEGMENTS)) if name.endswith('.log.gz'))
+    except OSError:
+        return []
+
+
+def store_plan(deployment, plan):
+    """Store plan file (once for identical plans).
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param plan: plan filename
+    :type plan: str
+    :returns: plan digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(plan, 'rb') as plan_file:
+        for data in iter(lambda: plan_file.read(CHUNK_SIZE), b''):
+            digest.update(data)
+    digest = digest.hexdigest()
+    stored = store_path(deployment, PLANS, digest + '.plan')
+    if not os.path.exists(stored):
+        (temp_fd, temp_name) = tempfile.mkstemp(
+            dir=store_path(deployment, PLANS))
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                with open(plan, 'rb') as plan_file:
+                    shutil.copyfileobj(plan_file, temp_file, CHUNK_SIZE)
+            os.rename(temp_name, stored)
+        except (IOError, OSError):
+            os.remove(temp_name)
+            raise
+    return digest
+
+
+def put(deployment, kind, stamp, status, log=None, plan=None, targets=()):
+    """Store log (and plan) of a run and add it to the index.
+
+    Expired records are then removed (with the default retention) if that
+    was last done more than COLLECT_INTERVAL seconds ago.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param kind: 'plan' or 'apply'
+    :type kind: str
+    :param stamp: plan timestamp (from plan filename)
+    :type stamp: str
+    :param status: exit code
+    :type status: int
+    :param log: log filename (None for no log)
+    :type log: str
+    :param plan: plan filename (None for no plan)
+    :type plan: str
+    :param targets: -target options
+    :type targets: list(str)
+    :returns: index record
+    :rtype: dict
+    """
+    with lock_store(deployment):
+        record = {'stamp': stamp, 'kind': kind, 'exit': status,
+                  'targets': list(targets), 'time': int(time.time()),
+                  'segment': None, 'offset': 0, 'length': 0, 'plan': None}
+        if plan is not None and os.path.isfile(plan) and \
+                os.path.getsize(plan):
+            record['plan'] = store_plan(deployment, plan)
+        if log is not None:
+            segments = segment_names(deployment)
+            if segments and os.path.getsize(store_path(
+                    deployment, SEGMENTS, segments[-1])) < SEGMENT_SIZE:
+                record['segment'] = segments[-1]
+            else:
+                record['segment'] = '{0:06d}.log.gz'.format(
+                    int(segments[-1].split('.')[0]) + 1 if segments else 1)
+            with open(store_path(deployment, SEGMENTS, record['segment']),
+                      'ab') as segment:
+                segment.seek(0, os.SEEK_END)
+                record['offset'] = segment.tell()
+                with gzip.GzipFile(fileobj=segment, mode='wb',
+                                   filename='') as member:
+                    with open(log, 'rb') as log_file:
+                        shutil.copyfileobj(log_file, member, CHUNK_SIZE)
+                record['length'] = segment.tell() - record['offset']
+        with open(store_path(deployment, INDEX_NAME), 'a') as index_file:
+            index_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    try:
+        collected = os.path.getmtime(store_path(deployment, COLLECTED_NAME))
+    except OSError:  # never collected
+        collected = 0
+    if not 0 <= time.time() - collected < COLLECT_INTERVAL:
+        try:
+            collect(deployment)
+        except (IOError, OSError):  # not fatal, retried by the next put
+            pass
+    return record
+
+
+def find(records, kind=None, status=None, stamp=None):
+    """Find index records matching all given criteria.
+
+    :param records: index records
+    :type records: list(dict)
+    :param kind: 'plan' or 'apply'
+    :type kind: str
+    :param status: exit code
+    :type status: int
+    :param stamp: plan timestamp (or prefix, e.g. '20150501')
+    :type stamp: str
+    :returns: matching records
+    :rtype: list(dict)
+    """
+    return [record for record in records
+            if (kind is None or record['kind'] == kind)
+            and (status is None or record['exit'] == status)
+            and (stamp is None or record['stamp'].startswith(stamp))]
+
+
+def write_log(deployment, record, output_file):
+    """Write stored log of a run.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param record: index record
+    :type record: dict
+    :param output_file: binary file object for log
+    :type output_file: file
+    """
+    if record['segment'] is None:
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(store_path(deployment, SEGMENTS, record['segment']),
+              'rb') as segment:
+        segment.seek(record['offset'])
+        remaining = record['length']
+        while remaining > 0 and not decompressor.unused_data:
+            data = segment.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            output_file.write(decompressor.decompress(data))
+    output_file.write(decompressor.flush())
+
+
+def collect(deployment, days=RETENTION_DAYS, keep=RETENTION_KEEP):
+    """Expire old records, and remove logs, plans and loose files.
+
+    Records older than days (except for the last keep records) are removed
+    from the index; then segments and plans no longer in the index, and
+    expired loose (pre-store) plan files, logs and failed plans, are removed,
+    as are profiles older than days (except for the last keep profiles).
+    The time of this is recorded (see COLLECTED_NAME) for put().
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param days: retention in days
+    :type days: int
+    :param keep: minimum number of records kept
+    :type keep: int
+    :returns: numbers of records, segments, plans, loose files and
+              profiles removed
+    :rtype: tuple(int, int, int, int, int)
+    """
+    cutoff = time.time() - days * 86400
+    with lock_store(deployment):
+        open(store_path(deployment, COLLECTED_NAME), 'a').close()
+        os.utime(store_path(deployment, COLLECTED_NAME), None)
+        records = read_index(deployment)
+        kept = [record for (number, record) in enumerate(records)
+                if record['time'] >= cutoff or number >= len(records) - keep]
+        (temp_fd, temp_name) = tempfile.mkstemp(
+            dir=store_path(deployment))
+        with os.fdopen(temp_fd, 'w') as temp_file:
+            for record in kept:
+                temp_file.write(json.dumps(record, sort_keys=True) + '\n')
+        os.rename(temp_name, store_path(deployment, INDEX_NAME))
+
+        segments = set(record['segment'] for record in kept)
+        current = segment_names(deployment)[-1:]
+        dead_segments = [name for name in segment_names(deployment)
+                         if name not in segments and name not in current]
+        for name in dead_segments:
+            os.remove(store_path(deployment, SEGMENTS, name))
+
+        plans = set('{0}.plan'.format(record['plan']) for record in kept)
+        dead_plans = [name for name in os.listdir(store_path(deployment,
+                                                             PLANS))
+                      if name.endswith('.plan') and name not in plans]
+        for name in dead_plans:
+            os.remove(store_path(deployment, PLANS, name))
+
+    live = set(os.path.basename(os.path.realpath(os.path.join(
+        deployment, link))) for link in ('latest.plan', 'destroy.plan'))
+    loose = [name for name in os.listdir(deployment)
+             if LOOSE.match(name) and re.sub(r'\.[a-z]+$', '.plan', name)
+             not in live and
+             os.path.getmtime(os.path.join(deployment, name)) < cutoff]
+    for name in loose:
+        os.remove(os.path.join(deployment, name))
+
+    profiles = []
+    if os.path.isdir(store_path(deployment, PROFILES)):
+        profiles = sorted(
+            (os.path.getmtime(store_path(deployment, PROFILES, name)), name)
+            for name in os.listdir(store_path(deployment, PROFILES))
+            if name.endswith('.prof'))
+    dead_profiles = [name for (mtime, name)
+                     in profiles[:max(len(profiles) - keep, 0)]
+                     if mtime < cutoff]
+    for name in dead_profiles:
+        os.remove(store_path(deployment, PROFILES, name))
+    return (len(records) - len(kept), len(dead_segments), len(dead_plans),
+            len(loose), len(dead_profiles))
+
+
+def main():
+    """Store, list, show or expire deployment artifacts.
+
+    :returns: Exit code (1 on error, 2 if no matching records)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Store and query tfplan/tfapply logs and plans.'
+    )
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    put_cmd = commands.add_parser('put', help='store log and plan of a run')
+    put_cmd.add_argument('--kind', dest='kind', choices=KINDS, required=True)
+    put_cmd.add_argument('--stamp', dest='stamp', required=True,
+                         help='plan timestamp (from plan filename)')
+    put_cmd.add_argument('--exit', dest='status', type=int, required=True,
+                         help='exit code of run', metavar='CODE')
+    put_cmd.add_argument('--log', dest='log', default=None,
+                         help='log file', metavar='FILE')
+    put_cmd.add_argument('--plan', dest='plan', default=None,
+                         help='plan file', metavar='FILE')
+    put_cmd.add_argument('--targets', dest='targets', default=None,
+                         help='file with -target options', metavar='FILE')
+
+    list_cmd = commands.add_parser('list', help='list runs')
+    show_cmd = commands.add_parser('show', help='print log (or stored plan '
+                                   'filename) of last matching run')
+    show_cmd.add_argument('--plan', dest='show_plan', default=False,
+                          action='store_true',
+                          help='print stored plan filename instead')
+    for command in (list_cmd, show_cmd):
+        command.add_argument('--kind', dest='kind', choices=KINDS,
+                             default=None)
+        command.add_argument('--exit', dest='status', type=int,
+                             default=None, help='exit code of run',
+                             metavar='CODE')
+
+    gc_cmd = commands.add_parser('gc', help='remove expired artifacts')
+    gc_cmd.add_argument('--days', dest='days', type=int,
+                        default=RETENTION_DAYS,
+                        help='retention in days (default: %(default)s)')
+    gc_cmd.add_argument('--keep', dest='keep', type=int,
+                        default=RETENTION_KEEP,
+                        help='minimum runs kept (default: %(default)s)')
+
+    for command in (put_cmd, list_cmd, show_cmd, gc_cmd):
+        command.add_argument('deployment', metavar='DEPLOY',
+                             help='deployment (with .tfvars file)')
+    for command in (list_cmd, show_cmd):
+        command.add_argument('stamp', nargs='?', default=None,
+                             help='plan timestamp (or prefix, e.g. '
+                             '20150501)', metavar='STAMP')
+    args = parser.parse_args()
+    deployment = re.sub(r'\.tfvars$', '', args.deployment)
+
+    try:
+        if args.command == 'put':
+            targets = []
+            if args.targets is not None and os.path.exists(args.targets):
+                with open(args.targets) as targets_file:
+                    targets = targets_file.read().split()
+            put(deployment, args.kind, args.stamp, args.status, args.log,
+                args.plan, targets)
+            return 0
+
+        if args.command == 'gc':
+            print('removed {0} runs, {1} log segments, {2} plans, {3} loose '
+                  'files, {4} profiles'.format(*collect(deployment, args.days,
+                                                        args.keep)))
+            return 0
+
+        records = find(read_index(deployment), args.kind, args.status,
+                       args.stamp)
+        if not records:
+            print('no matching runs', file=sys.stderr)
+            return 2
+        if args.command == 'list':
+            for record in records:
+                print('{0}\t{1}\t{2}\t{3}\t{4}'.format(
+                    record['stamp'], record['kind'], record['exit'],
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(record['time'])),
+                    ' '.join(record['targets'])))
+        elif args.show_plan:
+            if records[-1]['plan'] is None:
+                print('no plan stored', file=sys.stderr)
+                return 2
+            print(store_path(deployment, PLANS,
+                             records[-1]['plan'] + '.plan'))
+        else:
+            if hasattr(sys.stdout, 'buffer'):
+                output_file = sys.stdout.buffer  # pylint: disable=E1101
+            else:
+                output_file = sys.stdout
+            write_log(deployment, records[-1], output_file)
+            output_file.flush()
+        return 0
+
+    except (IOError, OSError, zlib.error) as err:
+        print(err, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the Python helpers on large synthetic inputs.
+
+Each case runs a helper on generated worst-case input (see CASES):
+
+    getremote       getremote.name() on a 100 MB multi-module state, with
+                    'remote' at the end
+    writemime       writemime.py with hundreds of text parts and multi-MB
+                    binary parts
+    writemime-gzip  the same, with -z
+    userdata-decode userdata_decode.decode() on a long history of Base64
+                    (some gzip compressed) userdata revisions
+    getconfig       getconfig.py on metadata with thousands of 'meta' keys
+
+Inputs are generated (deterministically, so runs are comparable) in the
+work directory, and only regenerated if the --scale changes. Each run of a
+case is a separate process, so that its peak RSS is its own; the fastest
+of --repeat runs is reported, with throughput (input MB/s) and peak RSS.
+
+With --save, results are saved as the baseline; otherwise, if there is a
+baseline (for the same scale), the exit code is 1 if the time or peak RSS
+of any case is more than --threshold percent worse than the baseline.
+Everything runs locally; no network access is needed.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+WORK_DIR = str('.benchmark')
+BASELINE_NAME = 'baseline.json'
+INPUTS = str('inputs')
+
+# Input sizes (at scale 1)
+STATE_SIZE = 100 * 1024 * 1024
+TEXT_PARTS = 300
+TEXT_PART_SIZE = 4 * 1024
+BINARY_PARTS = 4
+BINARY_PART_SIZE = 4 * 1024 * 1024
+REVISIONS = 500
+REVISION_PARTS = 10
+META_KEYS = 5000
+
+# Words for generated text
+VOCABULARY = [hashlib.sha1(str(index).encode()).hexdigest()[:3 + index % 7]
+              for index in range(4096)]
+
+# Default regression threshold (percent worse than baseline)
+THRESHOLD = 25
+
+# Output formats
+TEXT, JSON = 'text', 'json'
+FORMATS = (TEXT, JSON)
+
+# Variables removed from the environment of benchmark runs (caches would
+# make runs after the first trivial, timing records would be written)
+CLEAN_ENV = ('WRITEMIME_CACHE', 'USERDATA_DECODE_CACHE', 'GETCONFIG_CACHE',
+             'TFTOOLS_TIMINGS', 'TFTOOLS_PROFILE')
+
+
+def noise(size, seed):
+    """Generate deterministic incompressible bytes.
+
+    :param size: number of bytes
+    :type size: int
+    :param seed: seed text
+    :type seed: str
+    :returns: bytes
+    :rtype: bytes
+    """
+    blocks = []
+    for counter in range((size + 63) // 64):
+        blocks.append(hashlib.sha512(
+            '{0}:{1}'.format(seed, counter).encode()).digest())
+    return b''.join(blocks)[:size]
+
+
+def words(rng, count):
+    """Generate text words.
+
+    :param rng: random number generator (seeded, for repeatable inputs)
+    :type rng: random.Random
+    :param count: number of words
+    :type count: int
+    :returns: words
+    :rtype: list(str)
+    """
+    return [rng.choice(VOCABULARY) for _ in range(count)]
+
+
+def make_state(filename, size):
+    """Generate multi-module Terraform state with 'remote' at the end.
+
+    :param filename: state filename
+    :type filename: str
+    :param size: approximate size in bytes
+    :type size: int
+    """
+    rng = random.Random(1)
+    with open(filename, 'w') as state_file:
+        state_file.write('{\n    "version": 1,\n    "serial": 42,\n'
+                         '    "modules": [\n')
+        written = 0
+        module = 0
+        while written < size:
+            resources = {}
+            for index in range(50):
+                text = words(rng, 40)
+                attributes = dict(('metadata.{0}'.format(key), value)
+                                  for (key, value) in enumerate(text))
+                # escaped quotes and newlines, as in real user_data
+                attributes['user_data'] = '#!/bin/sh\necho "{0}" > {1}\n'.format(
+                    ' '.join(text), "'/etc/motd'")
+                attributes['id'] = hashlib.sha1(
+                    attributes['user_data'].encode()).hexdigest()
+                resources['openstack_compute_instance_v2.node.{0}'.format(
+                    index)] = {'type': 'openstack_compute_instance_v2',
+                               'primary': {'id': attributes['id'],
+                                           'attributes': attributes}}
+            chunk = json.dumps({'path': ['root', 'mod{0}'.format(module)],
+                                'outputs': {}, 'resources': resources},
+                               indent=4, sort_keys=True)
+            state_file.write((',\n' if module else '') + chunk)
+            written += len(chunk)
+            module += 1
+        state_file.write('\n    ],\n    "remote": {"type": "atlas", '
+                         '"config": {"name": "example/bench"}}\n}\n')
+
+
+def make_parts(directory, scale):
+    """Generate writemime part files.
+
+    :param directory: directory for part files
+    :type directory: str
+    :param scale: input size scale
+    :type scale: float
+    :returns: part filenames
+    :rtype: list(str)
+    """
+    rng = random.Random(2)
+    names = []
+    for index in range(max(1, int(TEXT_PARTS * scale))):
+        name = os.path.join(directory, 'part{0:03d}.sh'.format(index))
+        lines = ['#!/bin/sh']
+        while sum(len(line) + 1 for line in lines) < TEXT_PART_SIZE:
+            lines.append('echo ' + ' '.join(words(rng, 12)))
+        with open(name, 'w') as part_file:
+            part_file.write('\n'.join(lines) + '\n')
+        names.append(name)
+    for index in range(BINARY_PARTS):
+        name = os.path.join(directory, 'blob{0}.bin'.format(index))
+        with open(name, 'wb') as part_file:
+            part_file.write(noise(max(1024, int(BINARY_PART_SIZE * scale)),
+                                  'blob{0}'.format(index)))
+        names.append(name)
+    return names
+
+
+def make_userdata(directory, scale):
+    """Generate history of MIME multipart userdata revisions.
+
+    :param directory: directory for userdata files
+    :type directory: str
+    :param scale: input size scale
+    :type scale: float
+    :returns: userdata filenames
+    :rtype: list(str)
+    """
+    rng = random.Random(3)
+    texts = []
+    names = []
+    for revision in range(max(1, int(REVISIONS * scale))):
+        boundary = '===============' + hashlib.md5(
+            str(revision).encode()).hexdigest()[:19] + '=='
+        lines = ['Content-Type: multipart/mixed; boundary="{0}"'.format(
+            boundary), 'MIME-Version: 1.0', '']
+        if revision % 10 == 0:  # parts change every few revisions
+            texts = ['\n'.join(' '.join(words(rng, 12)) for _ in range(60))
+                     for _ in range(REVISION_PARTS - 1)]
+        for part in range(REVISION_PARTS):
+            if part == REVISION_PARTS - 1:
+                (mime_type, data) = ('application/octet-stream',
+                                     noise(2048, 'ud{0}'.format(revision)))
+            else:
+                (mime_type, data) = ('text/x-shellscript',
+                                     texts[part].encode())
+            coded = base64.b64encode(data).decode()
+            lines.extend([
+                '--' + boundary,
+                'Content-Type: {0}; charset="utf-8"'.format(mime_type),
+                'MIME-Version: 1.0', 'Content-Transfer-Encoding: base64',
+                'Content-Disposition: attachment; filename="part{0}"'.format(
+                    part), ''
+            ] + [coded[pos:pos + 76] for pos in range(0, len(coded), 76)])
+        lines.append('--' + boundary + '--')
+        data = ('\n'.join(lines) + '\n').encode()
+        name = os.path.join(directory, 'rev{0:04d}.userdata'.format(revision))
+        if revision % 5 == 4:  # as writemime.py -z
+            with gzip.open(name, 'wb') as userdata_file:
+                userdata_file.write(data)
+        else:
+            with open(name, 'wb') as userdata_file:
+                userdata_file.write(data)
+        names.append(name)
+    return names
+
+
+def make_metadata(filename, scale):
+    """Generate OpenStack metadata JSON with many 'meta' keys.
+
+    :param filename: metadata filename
+    :type filename: str
+    :param scale: input size scale
+    :type scale: float
+    """
+    rng = random.Random(4)
+    meta = {}
+    count = max(1, int(META_KEYS * scale))
+    for (index, word) in enumerate(words(rng, count)):
+        value = ' '.join(words(rng, 8))
+        if index % 7 == 0:
+            value = "it's " + value
+        elif index % 11 == 0:
+            value = '$HOME\\' + value
+        meta['{0}-{1}'.format(word, index)] = value
+    with open(filename, 'w') as meta_file:
+        json.dump({'uuid': '83679162-1378-4288-a2d4-70e13ec132aa',
+                   'name': 'bench', 'meta': meta}, meta_file)
+
+
+def prepare(work, scale):
+    """Generate inputs (unless already generated at this scale).
+
+    :param work: work directory
+    :type work: str
+    :param scale: input size scale
+    :type scale: float
+    :returns: input directory
+    :rtype: str
+    """
+    directory = os.path.join(work, INPUTS)
+    stamp = os.path.join(directory, 'scale')
+    try:
+        with open(stamp) as stamp_file:
+            if float(stamp_file.read()) == scale:
+                return directory
+    except (IOError, ValueError):
+        pass
+    for name in ('parts', 'userdata'):
+        if not os.path.isdir(os.path.join(directory, name)):
+            os.makedirs(os.path.join(directory, name))
+    for name in os.listdir(os.path.join(directory, 'userdata')):
+        os.remove(os.path.join(directory, 'userdata', name))
+    print('Generating inputs in {0}...'.format(directory), file=sys.stderr)
+    make_state(os.path.join(directory, 'terraform.tfstate'),
+               int(STATE_SIZE * scale))
+    make_parts(os.path.join(directory, 'parts'), scale)
+    make_userdata(os.path.join(directory, 'userdata'), scale)
+    make_metadata(os.path.join(directory, 'meta_data.json'), scale)
+    with open(stamp, 'w') as stamp_file:
+        stamp_file.write(repr(scale))
+    return directory
+
+
+def file_sizes(filenames):
+    """Get total size of files.
+
+    :param filenames: filenames
+    :type filenames: list(str)
+    :returns: total size in bytes
+    :rtype: int
+    """
+    return sum(os.path.getsize(name) for name in filenames)
+
+
+def run_main(module, argv):
+    """Run a helper's main() with arguments, discarding standard output.
+
+    :param module: helper module
+    :type module: module
+    :param argv: command-line arguments
+    :type argv: list(str)
+    :returns: exit code
+    :rtype: int
+    """
+    (saved_argv, saved_stdout) = (sys.argv, sys.stdout)
+    try:
+        sys.argv = [module.__file__] + argv
+        with io.open(os.devnull, 'w', encoding='utf-8') as devnull:
+            sys.stdout = devnull
+            return module.main() or 0
+    finally:
+        (sys.argv, sys.stdout) = (saved_argv, saved_stdout)
+
+
+def bench_getremote(inputs, output):  # pylint: disable=W0613
+    """Run getremote.name() on the large state (without its cache).
+
+    :param inputs: input directory
+    :type inputs: str
+    :param output: output filename
+    :type output: str
+    :returns: input bytes
+    :rtype: int
+    """
+    import getremote
+    statefile = os.path.join(inputs, 'terraform.tfstate')
+    if os.path.exists(statefile + getremote.CACHE_SUFFIX):
+        os.remove(statefile + getremote.CACHE_SUFFIX)
+    if getremote.name(statefile) is None:
+        raise ValueError('no remote found')
+    os.remove(statefile + getremote.CACHE_SUFFIX)
+    return os.path.getsize(statefile)
+
+
+def bench_writemime(inputs, output, options=()):
+    """Run writemime.py with hundreds of text parts and binary parts.
+
+    :param inputs: input directory
+    :type inputs: str
+    :param output: output filename
+    :type output: str
+    :param options: writemime.py options
+    :type options: list(str)
+    :returns: input bytes
+    :rtype: int
+    """
+    import writemime
+    directory = os.path.join(inputs, 'parts')
+    parts = sorted(os.path.join(directory, name)
+                   for name in os.listdir(directory))
+    if run_main(writemime, list(options) + ['-o', output] + parts):
+        raise ValueError('writemime.py failed')
+    return file_sizes(parts)
+
+
+def bench_writemime_gzip(inputs, output):
+    """Run writemime.py -z with hundreds of text parts and binary parts.
+
+    :param inputs: input directory
+    :type inputs: str
+    :param output: output filename
+    :type output: str
+    :returns: input bytes
+    :rtype: int
+    """
+    return bench_writemime(inputs, output, ['-z'])
+
+
+def bench_userdata_decode(inputs, output):
+    """Run userdata_decode.decode() on each userdata revision.
+
+    :param inputs: input directory
+    :type inputs: str
+    :param output: output filename
+    :type output: str
+    :returns: input bytes
+    :rtype: int
+    """
+    import userdata_decode
+    directory = os.path.join(inputs, 'userdata')
+    names = sorted(os.path.join(directory, name)
+                   for name in os.listdir(directory))
+    with open(output, 'wb') as output_file:
+        for name in names:
+            with userdata_decode.open_userdata(name) as input_file:
+                userdata_decode.decode(input_file, output_file)
+    return file_sizes(names)
+
+
+def bench_getconfig(inputs, output):  # pylint: disable=W0613
+    """Run getconfig.py on metadata with thousands of 'meta' keys.
+
+    :param inputs: input directory
+    :type inputs: str
+    :param output: output filename
+    :type output: str
+    :returns: input bytes
+    :rtype: int
+    """
+    import getconfig
+    import warnings
+    meta_name = os.path.join(inputs, 'meta_data.json')
+    warnings.simplefilter('ignore')
+    for fmt in getconfig.FORMATS:
+        if run_main(getconfig, ['-f', meta_name, '-F', fmt]):
+            raise ValueError('getconfig.py failed')
+    return os.path.getsize(meta_name) * len(getconfig.FORMATS)
+
+
+CASES = [
+    ('getremote', bench_getremote),
+    ('writemime', bench_writemime),
+    ('writemime-gzip', bench_writemime_gzip),
+    ('userdata-decode', bench_userdata_decode),
+    ('getconfig', bench_getconfig),
+]
+
+
+def peak_rss():
+    """Get peak resident set size of this process.
+
+    :returns: peak RSS in bytes
+    :rtype: int
+    """
+    # on Linux, ru_maxrss includes the parent before exec, VmHWM does not
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def run_case(case, work):
+    """Run benchmark case in this process and output its result as JSON.
+
+    :param case: case name
+    :type case: str
+    :param work: work directory (with generated inputs)
+    :type work: str
+    """
+    output = os.path.join(work, case + '.out')
+    start = time.time()
+    nbytes = dict(CASES)[case](os.path.join(work, INPUTS), output)
+    seconds = time.time() - start
+    if os.path.exists(output):
+        os.remove(output)
+    print(json.dumps({'seconds': seconds, 'bytes': nbytes,
+                      'rss': peak_rss()}))
+
+
+def measure(case, work, repeat):
+    """Run benchmark case in separate processes.
+
+    :param case: case name
+    :type case: str
+    :param work: work directory (with generated inputs)
+    :type work: str
+    :param repeat: number of runs
+    :type repeat: int
+    :returns: result with fastest 'seconds', input 'bytes', 'throughput'
+              (bytes per second) and peak 'rss' (bytes)
+    :rtype: dict
+    :raises ValueError: if the case fails
+    """
+    env = dict((name, value) for (name, value) in os.environ.items()
+               if name not in CLEAN_ENV)
+    runs = []
+    for _ in range(repeat):
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--run', case,
+             '--work', work], stdout=subprocess.PIPE, env=env)
+        out = process.communicate()[0]
+        if process.returncode:
+            raise ValueError('{0} failed (exit {1})'.format(
+                case, process.returncode))
+        runs.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    result = min(runs, key=lambda run: run['seconds'])
+    result['rss'] = max(run['rss'] for run in runs)
+    result['throughput'] = result['bytes'] / max(result['seconds'], 1e-6)
+    return result
+
+
+def regressions(results, baseline, threshold):
+    """Compare results with baseline.
+
+    :param results: results for each case
+    :type results: dict
+    :param baseline: baseline results for each case
+    :type baseline: dict
+    :param threshold: allowed regression (percent)
+    :type threshold: float
+    :returns: description of each regression
+    :rtype: list(str)
+    """
+    found = []
+    for (case, result) in sorted(results.items()):
+        if case not in baseline:
+            continue
+        for (measurement, label, unit) in (('seconds', 'time', 1),
+                                           ('rss', 'peak RSS MB', 1e6)):
+            base = baseline[case][measurement]
+            if base and result[measurement] > base * (1 + threshold / 100):
+                found.append('{0}: {1} {2:+.0f}% (baseline {3:.3f}, now '
+                             '{4:.3f})'.format(
+                                 case, label,
+                                 (result[measurement] / base - 1) * 100,
+                                 base / unit, result[measurement] / unit))
+    return found
+
+
+def main():
+    """Run benchmarks, and save baseline or compare with it.
+
+    :returns: Exit code (1 if any case failed or regressed)
+    :rtype: int
+    """
+    names = [case for (case, _) in CASES]
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Python helpers on large synthetic inputs.'
+    )
+    parser.add_argument('cases', nargs='*', default=[],
+                        help='cases to run (default: all of ' +
+                        ', '.join(names) + ')', metavar='CASE')
+    parser.add_argument('-w', '--work', dest='work', default=WORK_DIR,
+                        help="directory for inputs and baseline (default: "
+                        "'%(default)s')", metavar='DIR')
+    parser.add_argument('-b', '--baseline', dest='baseline', default=None,
+                        help='baseline file (default: DIR/' + BASELINE_NAME +
+                        ')', metavar='FILE')
+    parser.add_argument('-s', '--save', dest='save', default=False,
+                        action='store_true',
+                        help='save results as baseline')
+    parser.add_argument('-S', '--scale', dest='scale', default=1.0,
+                        type=float,
+                        help='input size scale (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', dest='repeat', default=3,
+                        type=int,
+                        help='runs of each case (default: %(default)s)')
+    parser.add_argument('-t', '--threshold', dest='threshold',
+                        default=THRESHOLD, type=float,
+                        help='regression threshold, percent (default: '
+                        '%(default)s)')
+    parser.add_argument('-F', '--format', dest='fmt', default=TEXT,
+                        choices=FORMATS,
+                        help="output format (default: '%(default)s')")
+    parser.add_argument('--run', dest='run', default=None, choices=names,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        run_case(args.run, args.work)
+        return 0
+
+    for case in args.cases:
+        if case not in names:
+            parser.error("unknown case '{0}'".format(case))
+    if args.scale <= 0 or args.repeat < 1:
+        parser.error('SCALE must be positive and REPEAT at least 1')
+    baseline_name = args.baseline or os.path.join(args.work, BASELINE_NAME)
+
+    prepare(args.work, args.scale)
+    results = {}
+    try:
+        for case in args.cases or names:
+            results[case] = measure(case, args.work, args.repeat)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+
+    baseline = {}
+    try:
+        with open(baseline_name) as baseline_file:
+            saved = json.load(baseline_file)
+        if saved.get('scale') == args.scale:
+            baseline = saved['cases']
+    except (IOError, ValueError, KeyError, AttributeError):
+        pass
+    found = regressions(results, baseline, args.threshold)
+
+    if args.fmt == JSON:
+        print(json.dumps({'scale': args.scale, 'cases': results,
+                          'regressions': found}, indent=2, sort_keys=True))
+    else:
+        print('{0:<16} {1:>9} {2:>9} {3:>9} {4:>9} {5:>7}'.format(
+            'CASE', 'MB', 'SECONDS', 'MB/S', 'RSS MB', 'VS BASE'))
+        for case in args.cases or names:
+            result = results[case]
+            change = '-'
+            if case in baseline and baseline[case]['seconds']:
+                change = '{0:+.0f}%'.format(
+                    (result['seconds'] / baseline[case]['seconds'] - 1) * 100)
+            print('{0:<16} {1:9.1f} {2:9.3f} {3:9.1f} {4:9.1f} {5:>7}'.format(
+                case, result['bytes'] / 1e6, result['seconds'],
+                result['throughput'] / 1e6, result['rss'] / 1e6, change))
+        for regression in found:
+            print('REGRESSION ' + regression)
+
+    if args.save:
+        if os.path.dirname(baseline_name) and not os.path.isdir(
+                os.path.dirname(baseline_name)):
+            os.makedirs(os.path.dirname(baseline_name))
+        cases = dict(baseline)
+        cases.update(results)
+        with open(baseline_name, 'w') as baseline_file:
+            json.dump({'scale': args.scale, 'cases': cases}, baseline_file,
+                      indent=2, sort_keys=True)
+        return 0
+    return 1 if found else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
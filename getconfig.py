@@ -1,23 +1,99 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Get metadata from configuration drive.
+"""Get metadata from configuration drive (or metadata service).
 
 Prints metadata values as 'key="value"' so that shell scripts can e.g.
 `eval "$(config-meta-env.py)"` to get all metadata as (non-exported) variables.
+Several keys (or dotted paths) can be output at once, also as a systemd
+EnvironmentFile or JSON object (-F env|json).
+
+The config drive and the OpenStack metadata service are both queried (at
+the same time), and the first valid metadata is used, so that a missing or
+slow config drive does not fail boot scripts. $GETCONFIG_URL sets the
+metadata service URL (e.g. a local test server, or empty for none).
 """
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import argparse
+import hashlib
 import json
+import mmap
 import os
+import re
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import warnings
 
+# Python 2/3 compatibility
+try:
+    # noinspection PyCompatibility
+    from http.client import HTTPConnection, HTTPException
+    # noinspection PyCompatibility
+    from queue import Queue
+    # noinspection PyCompatibility
+    from urllib.parse import urlparse
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from httplib import HTTPConnection, HTTPException
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from Queue import Queue
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from urlparse import urlparse
+
+try:
+    import phasetime
+except ImportError:  # standalone (e.g. on an instance), no timing/profiling
+    phasetime = None
+
 # '2013-10-17' is pinned config drive API revision, 'latest' might work as well
 META_NAME = str(os.path.join('openstack', '2013-10-17', 'meta_data.json'))
 CONFIG_DRIVE = '/dev/disk/by-label/config-2'
+DISK_BY_LABEL = '/dev/disk/by-label'
+DISK_BY_UUID = '/dev/disk/by-uuid'
+
+# ISO9660 volume descriptors start at 16 * 2048; Joliet escape sequences
+ISO_VD_OFFSET = 16 * 2048
+ISO_JOLIET = (b'%/@', b'%/C', b'%/E')
+
+# Environment variable for config drive device, image file or directory
+DRIVE_ENV = 'GETCONFIG_DRIVE'
+
+# Metadata service (META_NAME is under it); environment variable overrides
+# it (empty to only use the config drive)
+METADATA_URL = 'http://169.254.169.254'
+URL_ENV = 'GETCONFIG_URL'
+
+# Metadata service connect and read timeout (seconds); it answers quickly if
+# it is there at all
+HTTP_TIMEOUT = 2
+
+# Metadata service connections kept open for reuse, by host and port
+CONNECTIONS = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+# Parsed metadata cache on root-only tmpfs; environment variable overrides it
+# (empty to disable), and at most CACHE_ENTRIES drive identities are kept
+CACHE_DIR = '/run/getconfig'
+CACHE_ENV = 'GETCONFIG_CACHE'
+CACHE_ENTRIES = 4
+
+# Output formats: shell key='value', systemd EnvironmentFile, JSON object
+SHELL = 'shell'
+ENV = 'env'
+JSON = 'json'
+FORMATS = (SHELL, ENV, JSON)
+
+# Python 2/3 compatibility
+try:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    STRING = basestring             # pylint: disable=E0602
+except NameError:
+    STRING = str
 
 # translation table bytestring for mapping illegal metadata key chars to '_'
 LEGALIZE = b''.join(
@@ -25,30 +101,22 @@ LEGALIZE = b''.join(
 ) + b'_' * 128
 
 
-def metadata(meta_name=None):
-    """Mount configuration drive and load JSON metadata.
+def parse_metadata(data):
+    """Parse JSON metadata.
 
-    :param meta_name: Filename for metadata JSON file
-    :type meta_name: str
-    :returns: parsed JSON metadata from file
+    :param data: metadata JSON text
+    :type data: bytes
+    :returns: parsed JSON metadata
     :rtype: dict
-    :raises ValueError: if config drive or metadata file are missing/corrupted
+    :raises ValueError: if metadata is corrupted
     """
-    mountpoint = None
-    mounted = False
+    if phasetime is not None:
+        phasetime.processed(len(data))
     try:
-        if meta_name is None:
-            mountpoint = tempfile.mkdtemp(prefix=str('confdrv.'))
-            subprocess.check_output(['mount', '-r', CONFIG_DRIVE, mountpoint],
-                                    stderr=subprocess.STDOUT)
-            mounted = True
-            meta_name = os.path.join(mountpoint, META_NAME)
-
-        with open(meta_name) as meta_data:
-            meta = json.loads(meta_data.read())
-            if isinstance(meta, dict):
-                return meta
-            raise TypeError()
+        meta = json.loads(data.decode('utf-8'))
+        if isinstance(meta, dict):
+            return meta
+        raise TypeError()
 
     except (TypeError, KeyError):  # meta missing or not dict
         raise ValueError('Unknown structure in metadata file')
@@ -56,9 +124,292 @@ def metadata(meta_name=None):
     except ValueError:  # returned by json.loads on JSON syntax error
         raise ValueError('Unknown format in metadata file')
 
+
+def read_metadata(meta_name):
+    """Load JSON metadata from file.
+
+    :param meta_name: Filename for metadata JSON file
+    :type meta_name: str
+    :returns: parsed JSON metadata from file
+    :rtype: dict
+    :raises ValueError: if metadata file is missing/corrupted
+    """
+    try:
+        with open(meta_name, 'rb') as meta_data:
+            return parse_metadata(meta_data.read())
+
     except IOError as err:
         raise ValueError(err)
 
+
+def iso_records(image, extent, length, block):
+    """Generate the directory records in an ISO9660 directory extent.
+
+    :param image: config drive image
+    :type image: mmap.mmap
+    :param extent: directory extent (logical block number)
+    :type extent: int
+    :param length: directory length in bytes
+    :type length: int
+    :param block: logical block size
+    :type block: int
+    :returns: generator of directory records
+    :rtype: generator(bytearray)
+    """
+    pos = extent * block
+    end = pos + length
+    while pos < end:
+        rec_len = struct.unpack_from('<B', image, pos)[0]
+        if rec_len == 0:  # records do not cross blocks, skip to next
+            pos = (pos // block + 1) * block
+            continue
+        yield bytearray(image[pos:pos + rec_len])
+        pos += rec_len
+
+
+def rock_ridge_name(image, record, block, skip=0):
+    """Get the Rock Ridge (NM) alternate name from an ISO9660 record.
+
+    :param image: config drive image
+    :type image: mmap.mmap
+    :param record: directory record
+    :type record: bytearray
+    :param block: logical block size
+    :type block: int
+    :param skip: bytes to skip at start of system use area (from SP entry)
+    :type skip: int
+    :returns: alternate name, or None if there is none
+    :rtype: str
+    """
+    name_len = record[32]
+    area = record[33 + name_len + (1 - name_len % 2) + skip:]
+    name = bytearray()
+    while area:
+        continuation = None
+        pos = 0
+        while pos + 4 <= len(area) and area[pos + 2] >= 4:
+            (signature, entry_len) = (bytes(area[pos:pos + 2]), area[pos + 2])
+            if signature == b'NM' and entry_len > 5:
+                name.extend(area[pos + 5:pos + entry_len])
+            elif signature == b'CE':
+                (ce_block, ce_offset, ce_len) = struct.unpack_from(
+                    '<I4xI4xI', bytes(area), pos + 4)
+                continuation = ce_block * block + ce_offset, ce_len
+            elif signature == b'ST':
+                break
+            pos += entry_len
+        if continuation is None:
+            break
+        area = bytearray(image[continuation[0]:sum(continuation)])
+    return name.decode('utf-8') if name else None
+
+
+def iso9660_read(image, parts):
+    """Read a file from an ISO9660 image, using Joliet or Rock Ridge names.
+
+    :param image: config drive image
+    :type image: mmap.mmap
+    :param parts: path components of file
+    :type parts: list(str)
+    :returns: file contents
+    :rtype: bytes
+    :raises ValueError: if file is not found
+    """
+    # Prefer Joliet (supplementary) volume descriptor, else the primary one
+    volume = None
+    joliet = False
+    offset = ISO_VD_OFFSET
+    while image[offset + 1:offset + 6] == b'CD001':
+        vd_type = struct.unpack_from('<B', image, offset)[0]
+        if vd_type == 255:  # terminator
+            break
+        if vd_type == 1 and volume is None:
+            volume = offset
+        elif vd_type == 2 and image[offset + 88:offset + 91] in ISO_JOLIET:
+            (volume, joliet) = (offset, True)
+        offset += 2048
+    if volume is None:
+        raise ValueError('No ISO9660 primary volume descriptor')
+
+    block = struct.unpack_from('<H', image, volume + 128)[0]
+    (extent, length) = struct.unpack_from('<I4xI', image, volume + 156 + 2)
+    skip = 0
+    if not joliet:  # root '.' SUSP SP entry gives bytes to skip (if any)
+        root = next(iso_records(image, extent, length, block))
+        if bytes(root[34:36]) == b'SP':
+            skip = root[40]
+
+    flags = 2
+    for part in parts:
+        if not flags & 2:  # not a directory
+            raise ValueError("No '{0}' on config drive".format(part))
+        for record in iso_records(image, extent, length, block):
+            name = name_iso = bytes(record[33:33 + record[32]])
+            if name in (b'\0', b'\1'):  # '.' and '..'
+                continue
+            want = part
+            if joliet:
+                name = name.decode('utf-16-be')
+            else:
+                name = rock_ridge_name(image, record, block, skip)
+                if name is None:  # plain names only have [A-Z0-9_] and '.'
+                    name = name_iso.decode('ascii', 'replace').lower()
+                    want = part.replace('-', '_')
+            if name.split(';')[0].rstrip('.') == want:
+                (extent, length) = struct.unpack_from('<I4xI',
+                                                      bytes(record), 2)
+                flags = record[25]
+                break
+        else:
+            raise ValueError("No '{0}' on config drive".format(part))
+    if flags & 2:
+        raise ValueError("'{0}' is a directory".format(parts[-1]))
+    return image[extent * block:extent * block + length]
+
+
+def fat_read(image, parts):
+    """Read a file from a FAT12/16/32 image, using VFAT long names.
+
+    :param image: config drive image
+    :type image: mmap.mmap
+    :param parts: path components of file
+    :type parts: list(str)
+    :returns: file contents
+    :rtype: bytes
+    :raises ValueError: if file is not found
+    """
+    (sector, cluster_sectors, reserved, fats, root_entries, total,
+     fat_size) = struct.unpack_from('<HBHBHHxH', image, 11)
+    if not fat_size:
+        fat_size = struct.unpack_from('<I', image, 36)[0]
+    if not total:
+        total = struct.unpack_from('<I', image, 32)[0]
+    if not sector or not cluster_sectors:
+        raise ValueError('Invalid FAT boot sector')
+    fat = reserved * sector
+    root = (reserved + fats * fat_size) * sector
+    data = root + ((root_entries * 32 + sector - 1) // sector) * sector
+    clusters = (total * sector - data) // (cluster_sectors * sector)
+    if clusters < 4085:
+        (fmt, bits, last) = ('<H', 12, 0xff8)
+    elif clusters < 65525:
+        (fmt, bits, last) = ('<H', 16, 0xfff8)
+    else:
+        (fmt, bits, last) = ('<I', 32, 0x0ffffff8)
+
+    def read_chain(cluster, size=None):
+        """Read cluster chain (up to size bytes)."""
+        chunks = []
+        cluster_size = cluster_sectors * sector
+        for _ in range(clusters):
+            if cluster < 2 or cluster >= last:
+                break
+            start = data + (cluster - 2) * cluster_size
+            chunks.append(image[start:start + cluster_size])
+            if bits == 12:  # odd clusters are in the high 12 bits
+                value = struct.unpack_from(fmt, image,
+                                           fat + cluster * 3 // 2)[0]
+                cluster = value >> 4 if cluster & 1 else value & 0xfff
+            else:
+                cluster = struct.unpack_from(fmt, image,
+                                             fat + cluster * bits // 8)[0]
+                cluster &= 0x0fffffff
+        return b''.join(chunks)[:size]
+
+    if bits == 32:
+        directory = read_chain(struct.unpack_from('<I', image, 44)[0])
+    else:
+        directory = image[root:root + root_entries * 32]
+
+    for part in parts:
+        found = None
+        long_name = []
+        entries = bytearray(directory)
+        for pos in range(0, len(entries) - 31, 32):
+            entry = entries[pos:pos + 32]
+            if entry[0] == 0:  # end of directory
+                break
+            if entry[0] == 0xe5:  # deleted
+                long_name = []
+            elif entry[11] == 0x0f:  # VFAT long name entry (last one first)
+                long_name.insert(0, entry[1:11] + entry[14:26] + entry[28:32])
+            elif entry[11] & 0x08:  # volume label
+                long_name = []
+            else:
+                names = [bytes(entry[0:8]).rstrip().decode('ascii', 'replace')]
+                if bytes(entry[8:11]).rstrip():
+                    names[0] += '.' + bytes(entry[8:11]).rstrip().decode(
+                        'ascii', 'replace')
+                names[0] = names[0].lower()
+                if long_name:
+                    names.append(bytes(bytearray().join(long_name)).decode(
+                        'utf-16-le').split('\0')[0])
+                long_name = []
+                if part in names or part.lower() == names[0]:
+                    found = entry
+                    break
+        if found is None:
+            raise ValueError("No '{0}' on config drive".format(part))
+        (high, low, size) = struct.unpack_from('<H4xHI', bytes(found), 20)
+        if found[11] & 0x10:
+            directory = read_chain(high << 16 | low)
+        else:
+            directory = None
+            contents = read_chain(high << 16 | low, size)
+    if directory is not None:
+        raise ValueError("'{0}' is a directory".format(parts[-1]))
+    return contents
+
+
+def read_drive(drive, meta_name=META_NAME):
+    """Read a file from a config drive without mounting it.
+
+    The config drive device or image file is memory-mapped and its ISO9660
+    (with Joliet or Rock Ridge names) or FAT (with VFAT names) filesystem is
+    read directly, so no privileges (other than read access) are needed.
+
+    :param drive: config drive device or image file
+    :type drive: str
+    :param meta_name: path of file on config drive
+    :type meta_name: str
+    :returns: file contents
+    :rtype: bytes
+    :raises ValueError: if filesystem is unknown or file is not found
+    :raises IOError: (or OSError) if drive cannot be read
+    """
+    with open(drive, 'rb') as drive_file:
+        drive_file.seek(0, os.SEEK_END)
+        image = mmap.mmap(drive_file.fileno(), drive_file.tell(),
+                          access=mmap.ACCESS_READ)
+    try:
+        parts = meta_name.split(os.sep)
+        if image[ISO_VD_OFFSET + 1:ISO_VD_OFFSET + 6] == b'CD001':
+            return iso9660_read(image, parts)
+        if image[510:512] == b'\x55\xaa':
+            return fat_read(image, parts)
+        raise ValueError('Unknown filesystem on config drive')
+    finally:
+        image.close()
+
+
+def mount_metadata(drive):
+    """Mount configuration drive (device or image file) and load metadata.
+
+    :param drive: config drive device or image file
+    :type drive: str
+    :returns: parsed JSON metadata from config drive
+    :rtype: dict
+    :raises ValueError: if config drive or metadata file are missing/corrupted
+    """
+    mountpoint = None
+    mounted = False
+    try:
+        mountpoint = tempfile.mkdtemp(prefix=str('confdrv.'))
+        subprocess.check_output(['mount', '-r', drive, mountpoint],
+                                stderr=subprocess.STDOUT)
+        mounted = True
+        return read_metadata(os.path.join(mountpoint, META_NAME))
+
     except subprocess.CalledProcessError as err:
         raise ValueError(err.output.rstrip())
 
@@ -72,61 +423,469 @@ def metadata(meta_name=None):
             pass
 
 
-def outformat(key, val):
+def drive_identity(drive):
+    """Identify config drive (and so its metadata) without mounting it.
+
+    For a device or image file, this is its (resolved) path, filesystem
+    labels and UUIDs (from udev by-label/by-uuid links), size, and node/file
+    identity and mtime; for a directory, it is the path and the size and
+    mtime of META_NAME in it.
+
+    :param drive: config drive device, image file, or directory
+    :type drive: str
+    :returns: identity for drive
+    :rtype: list
+    :raises OSError: (or IOError) if drive cannot be examined
+    """
+    real = os.path.realpath(drive)
+    stat = os.stat(real)
+    if os.path.isdir(real):
+        meta_stat = os.stat(os.path.join(real, META_NAME))
+        return [real, stat.st_ino, meta_stat.st_ino, meta_stat.st_size,
+                meta_stat.st_mtime]
+
+    links = []
+    for by_dir in (DISK_BY_LABEL, DISK_BY_UUID):
+        if os.path.isdir(by_dir):
+            links.extend(sorted(
+                os.path.join(by_dir, link) for link in os.listdir(by_dir)
+                if os.path.realpath(os.path.join(by_dir, link)) == real
+            ))
+    with open(real, 'rb') as drive_file:
+        drive_file.seek(0, os.SEEK_END)
+        size = drive_file.tell()
+    return [real, links, size, stat.st_rdev, stat.st_ino, stat.st_mtime]
+
+
+def cache_dir():
+    """Get metadata cache directory, if it is private and can be used.
+
+    The directory is created (mode 0700) if needed; it is only used if it is
+    owned by the current user and not accessible to anyone else, as metadata
+    may contain secrets (e.g. private keys).
+
+    :returns: metadata cache directory, or None if cache is not usable
+    :rtype: str
+    """
+    directory = os.environ.get(CACHE_ENV, CACHE_DIR)
+    if not directory:
+        return None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        stat = os.lstat(directory)
+        if stat.st_uid == os.getuid() and not stat.st_mode & 0o077:
+            return directory
+    except OSError:
+        pass
+    return None
+
+
+def cache_metadata(directory, key, meta):
+    """Save parsed metadata in cache, evicting least recently used entries.
+
+    :param directory: metadata cache directory
+    :type directory: str
+    :param key: cache key (from drive identity)
+    :type key: str
+    :param meta: parsed JSON metadata
+    :type meta: dict
+    """
+    try:
+        (temp_fd, temp_name) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(temp_fd, 'w') as temp_file:
+            json.dump(meta, temp_file)
+        os.rename(temp_name, os.path.join(directory, key + '.json'))
+
+        entries = sorted(
+            (os.path.getmtime(os.path.join(directory, entry)), entry)
+            for entry in os.listdir(directory) if entry.endswith('.json')
+        )
+        for (_, entry) in entries[:-CACHE_ENTRIES]:
+            os.remove(os.path.join(directory, entry))
+    except (IOError, OSError):  # not fatal, just not cached
+        pass
+
+
+def drive_metadata(drive, mount=True):
+    """Load JSON metadata from config drive, mounting it if necessary.
+
+    The config drive is read directly with read_drive() if possible, falling
+    back to mounting it (unless mount is False). Metadata read from the
+    config drive is cached (see CACHE_DIR), keyed by the drive identity, so
+    that only the first call reads the drive.
+
+    :param drive: config drive device, image file, or directory
+    :type drive: str
+    :param mount: mount config drive if it cannot be read directly
+    :type mount: bool
+    :returns: parsed JSON metadata from config drive
+    :rtype: dict
+    :raises ValueError: if config drive or metadata file are missing/corrupted
+                        (or it needs to be mounted, and mount is False)
+    """
+    directory = cache_dir()
+    key = None
+    if directory is not None:
+        try:
+            key = hashlib.sha256(
+                json.dumps(drive_identity(drive)).encode()
+            ).hexdigest()
+            cached = os.path.join(directory, key + '.json')
+            with open(cached) as cache_file:
+                meta = json.load(cache_file)
+            if isinstance(meta, dict):
+                os.utime(cached, None)
+                return meta
+        except (IOError, OSError, ValueError):  # no (valid) cache entry
+            pass
+
+    if os.path.isdir(drive):
+        meta = read_metadata(os.path.join(drive, META_NAME))
+    else:
+        try:
+            meta = parse_metadata(read_drive(drive))
+        except (IOError, OSError, ValueError, IndexError, struct.error) as err:
+            if not mount:
+                raise ValueError("Config drive '{0}' not read without "
+                                 'mounting: {1}'.format(drive, err))
+            meta = None  # unsupported, unreadable or misread, try mounting
+        if meta is None:
+            meta = mount_metadata(drive)
+
+    if key is not None:
+        cache_metadata(directory, key, meta)
+    return meta
+
+
+def http_get(url, timeout=HTTP_TIMEOUT):
+    """Get a resource with HTTP GET, keeping the connection open for reuse.
+
+    A kept-alive connection that the server has since closed is replaced by
+    a new one (once).
+
+    :param url: http: URL
+    :type url: str
+    :param timeout: connect and read timeout (seconds)
+    :type timeout: float
+    :returns: response body
+    :rtype: bytes
+    :raises ValueError: if the request fails or the response is not 200 OK
+    """
+    parts = urlparse(url)
+    if parts.scheme != 'http' or not parts.hostname:
+        raise ValueError("Not an http: URL: '{0}'".format(url))
+    key = (parts.hostname, parts.port or 80)
+    path = parts.path or '/'
+    with CONNECTIONS_LOCK:
+        connection = CONNECTIONS.pop(key, None)
+    reused = connection is not None
+    while True:
+        if connection is None:
+            connection = HTTPConnection(key[0], key[1], timeout=timeout)
+        try:
+            connection.request(str('GET'), str(path),
+                               headers={str('Accept'): str('application/json')})
+            response = connection.getresponse()
+            data = response.read()
+            break
+        except (HTTPException, socket.error) as err:
+            connection.close()
+            connection = None
+            if not reused:
+                raise ValueError("{0}: '{1}'".format(
+                    str(err) or type(err).__name__, url))
+            reused = False  # server closed kept-alive connection, reconnect
+
+    if response.will_close:
+        connection.close()
+    else:
+        with CONNECTIONS_LOCK:
+            CONNECTIONS[key] = connection
+    if response.status != 200:
+        raise ValueError("{0} {1}: '{2}'".format(response.status,
+                                                 response.reason, url))
+    return data
+
+
+def service_metadata(url):
+    """Load JSON metadata from metadata service.
+
+    :param url: metadata service URL (META_NAME is under it)
+    :type url: str
+    :returns: parsed JSON metadata from metadata service
+    :rtype: dict
+    :raises ValueError: if metadata service or metadata are missing/corrupted
+    """
+    return parse_metadata(http_get(
+        url.rstrip('/') + '/' + '/'.join(META_NAME.split(os.sep))))
+
+
+def first_metadata(sources):
+    """Query metadata sources concurrently, returning the first valid result.
+
+    Each source is run in its own (daemon) thread; once one returns
+    metadata, the others are not waited for, so sources must not leave
+    anything to clean up (e.g. a mounted config drive).
+
+    :param sources: metadata source functions (returning dict, or raising
+                    ValueError), with no arguments
+    :type sources: list(function)
+    :returns: parsed JSON metadata from the first source to return it
+    :rtype: dict
+    :raises ValueError: if every source failed (with all their errors)
+    """
+    results = Queue()
+
+    def run(index, source):
+        """Run a source, queueing its metadata or exception."""
+        try:
+            results.put((index, source(), None))
+        except Exception as err:  # pylint: disable=W0703
+            results.put((index, None, err))
+
+    for (index, source) in enumerate(sources):
+        thread = threading.Thread(target=run, args=(index, source))
+        thread.daemon = True
+        thread.start()
+
+    errors = [None] * len(sources)
+    for _ in sources:
+        (index, meta, err) = results.get()
+        if err is None:
+            return meta
+        if not isinstance(err, ValueError):
+            raise err  # unexpected, as if the source was called directly
+        errors[index] = str(err)
+    raise ValueError('; '.join(errors))
+
+
+def metadata(meta_name=None, drive=None, url=None):
+    """Load JSON metadata from config drive or metadata service.
+
+    The config drive (see drive_metadata()) and metadata service (see
+    service_metadata()) are queried concurrently, and the first valid
+    metadata from either is used. Only if neither has metadata is the config
+    drive mounted, after the other queries have finished (so no abandoned
+    query can leave it mounted).
+
+    :param meta_name: Filename for metadata JSON file
+    :type meta_name: str
+    :param drive: config drive device, image file, or directory (default:
+                  $GETCONFIG_DRIVE or CONFIG_DRIVE); ignored with meta_name
+    :type drive: str
+    :param url: metadata service URL (default: $GETCONFIG_URL or
+                METADATA_URL, '' for none); ignored with meta_name
+    :type url: str
+    :returns: parsed JSON metadata from file
+    :rtype: dict
+    :raises ValueError: if config drive or metadata file are missing/corrupted
+                        (and metadata service failed)
+    """
+    if meta_name is not None:
+        return read_metadata(meta_name)
+
+    if drive is None:
+        drive = os.environ.get(DRIVE_ENV, CONFIG_DRIVE)
+    if url is None:
+        url = os.environ.get(URL_ENV, METADATA_URL)
+
+    if not url:
+        return drive_metadata(drive)
+    try:
+        return first_metadata([lambda: drive_metadata(drive, mount=False),
+                               lambda: service_metadata(url)])
+    except ValueError as err:
+        if not os.path.exists(drive) or os.path.isdir(drive):
+            raise
+        try:
+            return drive_metadata(drive)
+        except ValueError as mount_err:
+            raise ValueError('{0}; {1}'.format(err, mount_err))
+
+
+def legal_key(key):
+    """Map a metadata key to a legal (shell variable) name.
+
+    Any characters other than ASCII alphanumerics are replaced with
+    underscore*s* and an underscore is prepended if first character is a
+    digit (or the key is empty).
+
+    :param key: metadata key
+    :type key: str
+    :returns: legal name for key
+    :rtype: str
+    """
+    good_key = key.encode().translate(LEGALIZE).decode()
+    if not good_key or good_key[0].isdigit():
+        good_key = '_' + good_key
+    return good_key
+
+
+def key_table(keys):
+    """Precompute legal names for metadata keys, with a single warning.
+
+    :param keys: metadata keys
+    :type keys: iterable(str)
+    :returns: legal name for each key
+    :rtype: dict
+    :raises UserWarning: (once) if any keys are transformed to make them legal
+    """
+    table = dict((key, legal_key(key)) for key in keys)
+    mapped = ["'{0}' to '{1}'".format(key, good_key)
+              for (key, good_key) in sorted(table.items()) if key != good_key]
+    if mapped:
+        warnings.warn(UserWarning('mapped key ' + ', '.join(mapped)))
+    return table
+
+
+def outformat(key, val, fmt=SHELL, good_key=None):
     r"""Format a metadata key='value' string.
 
     Keys must begin with an ASCII alphabetic character and contain only
     alphanumerics or underscore (_). Any illegal characters are replaced
     with underscore*s* and an underscore is prepended if first character is a
-    digit; a UserWarning is raised if either of these changes are made.
+    digit; a UserWarning is raised if either of these changes are made
+    (unless the legal key is given, e.g. from a key_table()).
 
     Values are free (Unicode) text; the formatted string escapes any single
     quotes (') with a backslash (\) and places single quotes around the value
     (and around any escaped single quotes, e.g r"it's" -> r"'it'\''s'").
+    Non-text values (e.g. lists) are formatted as JSON text.
+
+    With fmt=ENV, the output is a systemd EnvironmentFile key="value" line,
+    with backslash escapes for any \, ", $ or ` in the value; with fmt=JSON,
+    it is a "key": value JSON object member (key is used as is).
 
     :param key: metadata key (must contain only alphanumerics and underscore)
     :type key: str
     :param val: metadata value (free text)
     :type val: str
+    :param fmt: output format (SHELL, ENV or JSON)
+    :type fmt: str
+    :param good_key: legal key to use (default: legalized key, with warning)
+    :type good_key: str
     :returns: formatted string for output
     :rtype: str
     :raises UserWarning: if key is transformed to make it legal
     """
-    good_key = key.encode().translate(LEGALIZE).decode()
-    if good_key[0].isdigit():
-        good_key = '_' + good_key
-    if good_key != key:
-        warnings.warn(UserWarning(
-            "mapped key '{0}' to '{1}".format(key, good_key)
-        ))
+    if fmt == JSON:
+        return '{0}: {1}'.format(json.dumps(key), json.dumps(val))
+    if good_key is None:
+        good_key = key_table([key])[key]
+    if not isinstance(val, STRING):
+        val = json.dumps(val, sort_keys=True)
+    if fmt == ENV:
+        good_val = re.sub(r'([\\"$`])', r'\\\1', val)
+        return '{0}="{1}"'.format(str(good_key), str(good_val))
     good_val = val.replace("'", r"'\''")
     return "{0}='{1}'".format(str(good_key), str(good_val))
 
 
+def lookup(meta, path):
+    """Look up a metadata key or dotted path into nested dicts.
+
+    Keys containing dots are matched whole in preference to dotted paths.
+
+    :param meta: (nested) metadata dict
+    :type meta: dict
+    :param path: key or dotted path, e.g. 'meta.roles'
+    :type path: str
+    :returns: (last) key and value
+    :rtype: tuple(str, object)
+    :raises KeyError: if there is no such key or path
+    """
+    if path in meta:
+        # noinspection PyRedundantParentheses
+        return (path, meta[path])
+    (key, _, rest) = path.partition('.')
+    if rest and isinstance(meta.get(key), dict):
+        return lookup(meta[key], rest)
+    raise KeyError(path)
+
+
 def main():
     """Print OpenStack metadata key='value' pairs from configuration drive.
 
+    (Or from the metadata service, if it answers first; see metadata().)
+
+    Each KEY (or dotted path) with a dict value is expanded to its entries,
+    other values are output under their (last) key; the default KEY is 'meta'
+    (user-provided metadata dict), for which embedded private keys are
+    suppressed. All keys are output from a single read of the metadata.
+    With -F json and more than one KEY, each value is instead nested under
+    its KEY as given; otherwise, KEYs that would output the same (legal) name
+    more than once are an error.
+
     :returns: int Exit code (1 on format error/file not found/access error)
     """
-    filename = None
-    key = 'meta'  # metadata key for user-provided metadata (tags) dict
+    parser = argparse.ArgumentParser(
+        description='Print metadata values from configuration drive (or '
+        'metadata service).'
+    )
+    parser.add_argument('-f', '--file', dest='filename', default=None,
+                        help='read metadata JSON from FILE instead (or give '
+                        'FILE path with a / before a single KEY)',
+                        metavar='FILE')
+    parser.add_argument('-F', '--format', dest='fmt', default=SHELL,
+                        choices=FORMATS,
+                        help="output format (default: '%(default)s')")
+    parser.add_argument('keys', nargs='*', default=[],
+                        help="metadata key or dotted path (default: 'meta')",
+                        metavar='KEY')
+    args = parser.parse_args()
+    if (args.filename is None and len(args.keys) == 2 and
+            os.sep in args.keys[0] and os.path.isfile(args.keys[0])):
+        # original 'FILE KEY' usage, only for a FILE path with a separator
+        # (e.g. ./meta_data.json), so that a file in the current directory
+        # cannot change the meaning of two KEYs
+        args.filename = args.keys.pop(0)
+    keys = args.keys or ['meta']
+
     try:
-        if len(sys.argv) > 3:
-            raise ValueError('usage: ' + sys.argv[0] + ' [ [FILE] KEY ]')
-        elif len(sys.argv) > 2:
-            filename = sys.argv[1]
-            key = sys.argv[2]
-        elif len(sys.argv) > 1:
-            key = sys.argv[1]
-        meta_data = metadata(filename)
-        if isinstance(meta_data[key], dict):
-            for subkey in meta_data[key].keys():
-                output = outformat(subkey, meta_data[key][subkey])
-                # suppress embedded private keys without explicit 'meta' arg
-                if len(sys.argv) > 1 or 'PRIVATE KEY' not in output:
-                    print(output)
-        else:
-            print(outformat(key, meta_data[key]))
+        meta_data = metadata(args.filename)
+        nested = args.fmt == JSON and len(keys) > 1
+        items = []
+        for (index, path) in enumerate(keys):
+            if path in keys[:index]:
+                continue
+            try:
+                (key, val) = lookup(meta_data, path)
+            except KeyError:
+                hint = ''
+                if index == 0 and os.path.isfile(path):
+                    hint = " (for metadata file use '-f {0}')".format(path)
+                raise ValueError("No metadata key '{0}'{1}".format(path, hint))
+            if nested:
+                items.append((path, val, path))
+            elif isinstance(val, dict):
+                items.extend((key, val[key], path) for key in val)
+            else:
+                items.append((key, val, path))
+
+        table = {}
+        if args.fmt != JSON:
+            table = key_table(key for (key, _, _) in items)
+        seen = {}
+        for (key, _, path) in items:
+            name = table.get(key, key)
+            if name in seen:
+                raise ValueError(
+                    "Metadata key '{0}' (from '{1}') and '{2}' (from '{3}') "
+                    "both output as '{4}'".format(seen[name][0], seen[name][1],
+                                                  key, path, name))
+            seen[name] = (key, path)
+        output = []
+        for (key, val, _) in items:
+            line = outformat(key, val, args.fmt, table.get(key))
+            # suppress embedded private keys without explicit 'meta' arg
+            if args.keys or 'PRIVATE KEY' not in line:
+                output.append(line)
+
+        if args.fmt == JSON:
+            print('{' + ', '.join(output) + '}')
+        elif output:
+            print('\n'.join(output))
         return 0
 
     except ValueError as err:
@@ -134,4 +893,6 @@ def main():
         return 1
 
 if __name__ == '__main__':
-    sys.exit(main())
+    if phasetime is None:
+        sys.exit(main())
+    sys.exit(phasetime.main_timed('getconfig', main))
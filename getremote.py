@@ -1,14 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Get remote name from terraform state file."""
+"""Get remote name from terraform state file.
+
+Only the start of the state file is read: scanning stops as soon as the
+top-level 'remote' object is complete. The result is cached next to the
+state file (see CACHE_SUFFIX), keyed by the state file identity, so that
+repeated lookups only stat the state file.
+"""
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import json
+import os
+import re
 import sys
+import tempfile
+
+import phasetime
 
 TF_STATE = str('.terraform/terraform.tfstate')
 
+# Cache file for remote name is the state filename with this suffix (not
+# '.remote', which tfremote uses for saved remote state, see tftools.py)
+CACHE_SUFFIX = str('.remote-name')
+
+# Buffer size for reading state file
+CHUNK_SIZE = 64 * 1024
+
+# Complete string, structural character, or start of incomplete string
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]|"')
+
+# Anything but brackets (including complete strings), skipped when nested
+NESTED = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
 # Python 2/3 compatibility
 try:
     # noinspection PyCompatibility,PyUnresolvedReferences
@@ -17,6 +41,124 @@ except NameError:
     STRING = str
 
 
+def remote_text(tf_state, chunk_size=CHUNK_SIZE):
+    """Get JSON text of the top-level 'remote' value from a state file.
+
+    The state file is tokenized incrementally (only strings and structural
+    characters are matched) and reading stops at the end of the value.
+
+    :param tf_state: Terraform state file object
+    :type tf_state: file
+    :param chunk_size: read size
+    :type chunk_size: int
+    :returns: JSON text of 'remote' value
+    :returns: None if the state has no 'remote'
+    :rtype: str
+    :raises ValueError: if the state file cannot be parsed
+    :raises TypeError: if the state is not a JSON object
+    """
+    buf = ''
+    pos = 0
+    depth = 0
+    key = None
+    start = None  # start of 'remote' value in buf
+    while True:
+        if depth > 1:
+            pos = NESTED.match(buf, pos).end()
+        match = TOKEN.search(buf, pos)
+        if match is not None and match.group() != '"':
+            token = match.group()
+            pos = match.end()
+            if depth == 0 and token != '{':
+                raise TypeError()
+            if token[0] == '"':
+                if depth == 1 and key is None:
+                    key = json.loads(token)
+            elif token == ':':
+                if depth == 1 and key == 'remote':
+                    start = pos
+            elif token in '{[':
+                depth += 1
+            elif depth == 1 and start is not None:  # ',' or '}' ends value
+                return buf[start:match.start()]
+            elif token == ',':
+                if depth == 1:
+                    key = None
+            else:
+                depth -= 1
+                if depth == 0:
+                    return None
+                if depth == 1 and start is not None:
+                    return buf[start:pos]
+            continue
+
+        # need more input (string incomplete): keep only what is still needed
+        data = tf_state.read(chunk_size)
+        if not data:
+            raise ValueError('Unexpected end of JSON')
+        phasetime.processed(len(data))
+        keep = pos if match is None else match.start()
+        if start is not None:
+            keep = min(keep, start)
+        buf = buf[keep:] + data
+        pos -= keep
+        if start is not None:
+            start -= keep
+
+
+def state_identity(statefile):
+    """Get state file identity for cache.
+
+    :param statefile: Filename for Terraform state file
+    :type statefile: str
+    :returns: absolute path, inode, size and mtime of state file
+    :rtype: list
+    :raises OSError: if state file does not exist
+    """
+    state_stat = os.stat(statefile)
+    return [os.path.abspath(statefile), state_stat.st_ino,
+            state_stat.st_size,
+            getattr(state_stat, 'st_mtime_ns', state_stat.st_mtime)]
+
+
+def save_json(filename, value):
+    """Write JSON file atomically (errors are ignored, as for a cache).
+
+    Also used for the caches of stateindex.py and preflight.py.
+
+    :param filename: output filename
+    :type filename: str
+    :param value: value to write
+    :type value: object
+    """
+    temp_name = None
+    try:
+        (temp_fd, temp_name) = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or os.curdir)
+        with os.fdopen(temp_fd, 'w') as output_file:
+            json.dump(value, output_file, separators=(',', ':'))
+        os.rename(temp_name, filename)
+        temp_name = None
+    except (IOError, OSError):  # not writable, just don't save it
+        pass
+    finally:
+        if temp_name is not None:
+            os.remove(temp_name)
+
+
+def cache_name(statefile, identity, remote_name):
+    """Cache remote name for a state file (errors are ignored).
+
+    :param statefile: Filename for Terraform state file
+    :type statefile: str
+    :param identity: state file identity
+    :type identity: list
+    :param remote_name: remote name (or None)
+    :type remote_name: str
+    """
+    save_json(statefile + CACHE_SUFFIX, [identity, remote_name])
+
+
 def name(statefile=TF_STATE):
     """Extract Atlas remote name from Terraform remote state JSON file.
 
@@ -27,19 +169,30 @@ def name(statefile=TF_STATE):
     :rtype: str
     :raises ValueError: if the state file is missing or cannot be parsed
     """
+    identity = None
+    try:
+        identity = state_identity(statefile)
+        with open(statefile + CACHE_SUFFIX) as cache_file:
+            (cached_identity, remote_name) = json.load(cache_file)
+        if cached_identity == identity:
+            return remote_name
+    except (OSError, IOError, ValueError, TypeError):  # no (valid) cache
+        pass
+
     try:
         with open(statefile) as tf_state:
-            state = json.loads(tf_state.read())
-            remote = state.get('remote', None)
-            if remote is None:
-                return None
+            text = remote_text(tf_state)
+        remote = None if text is None else json.loads(text)
+        if remote is None:
+            remote_name = None
+        else:
             remote_name = remote['config']['name']
-            if remote_name.count('/') == 1 and isinstance(remote_name, STRING):
-                return remote_name
-            raise TypeError()
+            if not (isinstance(remote_name, STRING) and
+                    remote_name.count('/') == 1):
+                raise TypeError()
 
     except (TypeError, AttributeError, KeyError):
-        # remote,config not dict; name not "a/b" string; config,name missing
+        # state,remote,config not dict; name not "a/b" string; name missing
         raise ValueError('Unknown structure in Terraform state')
 
     except ValueError:  # returned by json.loads on JSON syntax error
@@ -51,6 +204,10 @@ def name(statefile=TF_STATE):
             return None
         raise ValueError(err)
 
+    if identity is not None:
+        cache_name(statefile, identity, remote_name)
+    return remote_name
+
 
 def main():
     """Print Atlas remote name.
@@ -74,4 +231,4 @@ def main():
         return 1
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(phasetime.main_timed('getremote', main))
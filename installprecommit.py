@@ -32,6 +32,14 @@ except KeyError:
 if os.system('git config diff.userdata.textconv $PWD/userdata_decode.py'):
     print('Problem configuring Git diff filter for userdata')
 
+# Git can cache textconv output of (committed) userdata blobs in notes, but
+# decoded userdata can have secrets, so only if USERDATA_DECODE_CACHE is set
+if os.environ.get('USERDATA_DECODE_CACHE'):
+    if os.system('git config diff.userdata.cachetextconv true'):
+        print('Problem configuring Git diff filter cache for userdata')
+else:
+    os.system('git config --unset diff.userdata.cachetextconv')
+
 if os.system('pre-commit --version'):
     os.system('pip install pre-commit')
 
@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared cache of git Terraform modules, linked into .terraform/modules.
+
+Instead of `terraform get -update` fetching every module again in each
+checkout, tfplan links a cached copy of each git module into the directory
+where terraform would get it (MODULES_DIR/MD5, see module_key()), so that
+`terraform get` (without -update) only has to get any other modules.
+
+The cache directory (see CACHE_ENV and CACHE_DEFAULT) is shared by all
+checkouts and worktrees of the user:
+
+    trees/COMMIT/   files of a module repository at a commit (content
+                    addressed: one copy for all sources and refs of it)
+    repos/SHA1.git  bare repository for each source URL, for fetching
+    index.json      commit of each (source URL, ref), last use and size of
+                    each tree, and counts of hits, fetches and evictions
+
+A ref that is a commit ID, or a tag that was resolved before, is used
+without contacting the source; branches (and the default HEAD) are moving,
+so they are checked with `git ls-remote`, and only a new commit is fetched.
+Least recently used trees are evicted when the cache is larger than
+$TFTOOLS_MODULE_CACHE_SIZE MiB (see SIZE_ENV).
+
+Only git sources (git::URL, github.com/ORG/REPO and user@host:path) are
+cached; local paths are left to terraform (which links them), but with
+other remote sources, tfplan still uses `terraform get -update`.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+# Python 2/3 compatibility
+try:
+    # noinspection PyCompatibility
+    from urllib.parse import parse_qs
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from urlparse import parse_qs
+
+# Environment variables: cache directory (empty to disable the cache), size
+# limit (MiB) and how trees are linked ('hardlink' or 'symlink')
+CACHE_ENV = 'TFTOOLS_MODULE_CACHE'
+SIZE_ENV = 'TFTOOLS_MODULE_CACHE_SIZE'
+LINK_ENV = 'TFTOOLS_MODULE_LINK'
+
+CACHE_DEFAULT = '~/.cache/tftools/modules'
+SIZE_DEFAULT = 1024
+
+# Hard links are not affected by eviction of the tree (or by a cache on
+# another file system, where symbolic links are used instead)
+HARDLINK, SYMLINK = 'hardlink', 'symlink'
+LINKS = (HARDLINK, SYMLINK)
+
+MODULES_DIR = str('.terraform/modules')
+
+TREES = str('trees')
+REPOS = str('repos')
+INDEX_NAME = str('index.json')
+LOCK_NAME = str('lock')
+
+# Commit of a module linked into MODULES_DIR/MD5 is in MD5 + MARKER
+MARKER = str('.commit')
+
+# Ref for commits fetched into a cache repository
+FETCHED_REF = 'refs/modcache/'
+
+COUNTERS = ('hits', 'fetches', 'checks', 'evictions')
+
+# Output formats
+TEXT, JSON = 'text', 'json'
+FORMATS = (TEXT, JSON)
+
+MODULE = re.compile(r'\bmodule\s+"([^"]+)"\s*\{')
+SOURCE = re.compile(r'(?:^|[\s{])source\s*=\s*"([^"]*)"')
+COMMIT = re.compile(r'^[0-9a-f]{40}$')
+GITHUB = re.compile(r'^github\.com/([^/]+)/([^/]+?)(?:\.git)?$')
+SCP_LIKE = re.compile(r'^[A-Za-z0-9_.-]+@[A-Za-z0-9_.-]+:')
+
+
+def cache_dir():
+    """Get module cache directory.
+
+    :returns: directory (None if the cache is disabled)
+    :rtype: str
+    """
+    directory = os.environ.get(CACHE_ENV, CACHE_DEFAULT)
+    return os.path.expanduser(directory) if directory else None
+
+
+def modules(directory):
+    """Get module names and sources from Terraform configuration.
+
+    :param directory: configuration directory (*.tf files)
+    :type directory: str
+    :returns: (name, source) for each module block
+    :rtype: list(tuple(str, str))
+    """
+    result = []
+    for filename in sorted(glob.glob(os.path.join(directory, '*.tf'))):
+        with open(filename, 'rb') as tf_file:
+            text = tf_file.read().decode('utf-8', 'replace')
+        for match in MODULE.finditer(text):
+            # block ends at matching brace (outside strings)
+            (depth, pos, in_string) = (1, match.end(), False)
+            while depth and pos < len(text):
+                char = text[pos]
+                if in_string:
+                    if char == '\\':
+                        pos += 1
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                pos += 1
+            source = SOURCE.search(text, match.end(), pos)
+            if source is not None:
+                result.append((match.group(1), source.group(1)))
+    return result
+
+
+def module_key(path, source):
+    """Get directory name in MODULES_DIR used by terraform for a module.
+
+    :param path: module names from the root module
+    :type path: list(str)
+    :param source: module source (as in configuration)
+    :type source: str
+    :returns: MD5 hex digest of storage key
+    :rtype: str
+    """
+    key = 'root.{0}-{1}'.format('.'.join(path), source)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def is_local(source):
+    """Check if module source is a local path.
+
+    :param source: module source
+    :type source: str
+    :returns: True if source is a local path
+    :rtype: bool
+    """
+    return source in ('.', '..') or source.startswith(('./', '../', '/'))
+
+
+def git_source(source, directory):
+    """Get git URL, ref and subdirectory of module source.
+
+    :param source: module source
+    :type source: str
+    :param directory: configuration directory (for relative paths)
+    :type directory: str
+    :returns: URL, ref (None for default HEAD) and subdirectory ('' for
+              none), or None if not a git source
+    :rtype: tuple(str, str, str)
+    """
+    forced = source.startswith('git::')
+    if forced:
+        source = source[len('git::'):]
+    scheme = source.find('://')
+    sub = source.find('//', scheme + 3 if scheme >= 0 else 0)
+    subdir = ''
+    if sub >= 0:
+        (source, subdir) = (source[:sub], source[sub + 2:])
+        if '?' in subdir:
+            (subdir, query) = subdir.split('?', 1)
+            source += '?' + query
+    (url, _, query) = source.partition('?')
+    params = parse_qs(query)
+    if set(params) - set(['ref']):
+        return None  # e.g. sshkey, not handled here
+    ref = params['ref'][-1] if 'ref' in params else None
+    if not forced:
+        match = GITHUB.match(url)
+        if match is not None:
+            url = 'https://github.com/{0}/{1}.git'.format(*match.groups())
+        elif SCP_LIKE.match(url) is None:
+            return None
+    elif '://' not in url and SCP_LIKE.match(url) is None:
+        url = os.path.abspath(os.path.join(directory, url))
+    return (url, ref, subdir)
+
+
+def git(args, env=None, git_dir=None):
+    """Run git command.
+
+    :param args: git arguments
+    :type args: list(str)
+    :param env: environment
+    :type env: dict
+    :param git_dir: repository (--git-dir)
+    :type git_dir: str
+    :returns: standard output
+    :rtype: str
+    :raises ValueError: if git fails
+    """
+    command = [str('git')] + ([str('--git-dir'), git_dir] if git_dir else [])
+    command += [str(arg) for arg in args]
+    try:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError as err:
+        raise ValueError('git: {0}'.format(err))
+    (output, error) = process.communicate()
+    if process.returncode != 0:
+        raise ValueError('git {0}: {1}'.format(
+            args[0], error.decode('utf-8', 'replace').strip()))
+    return output.decode('utf-8', 'replace')
+
+
+def resolve(url, ref, index, resolved, env=None):
+    """Get commit of git ref, checking the source only for moving refs.
+
+    :param url: git URL
+    :type url: str
+    :param ref: ref (None for default HEAD)
+    :type ref: str
+    :param index: cache index (refs are updated)
+    :type index: dict
+    :param resolved: refs already checked in this run (updated)
+    :type resolved: set(str)
+    :param env: environment for git
+    :type env: dict
+    :returns: commit ID
+    :rtype: str
+    :raises ValueError: if ref is not found
+    """
+    if ref is not None and COMMIT.match(ref):
+        return ref
+    key = '{0}#{1}'.format(url, ref or '')
+    known = index['refs'].get(key)
+    if known is not None and (key in resolved or not known['moving'] and
+                              known['commit'] in index['trees']):
+        return known['commit']
+    resolved.add(key)
+    index['stats']['checks'] += 1
+    refs = {}
+    # the peeled entry of an annotated tag is only listed if asked for
+    for line in git(['ls-remote', url, ref or 'HEAD', (ref or 'HEAD') + '^{}'],
+                    env).splitlines():
+        (commit, _, name) = line.partition('\t')
+        refs[name] = commit
+    # annotated tags are peeled (^{}) to their commits
+    for (name, moving) in (('refs/tags/{0}^{{}}', False),
+                           ('refs/tags/{0}', False),
+                           ('refs/heads/{0}', True), ('{0}', True)):
+        name = name.format(ref or 'HEAD')
+        if name in refs:
+            index['refs'][key] = {'commit': refs[name], 'moving': moving}
+            return refs[name]
+    raise ValueError("ref '{0}' not found in '{1}'".format(ref or 'HEAD', url))
+
+
+def tree_size(directory):
+    """Get total size of files in directory tree.
+
+    :param directory: directory
+    :type directory: str
+    :returns: size (bytes)
+    :rtype: int
+    """
+    size = 0
+    for (dirpath, _, filenames) in os.walk(directory):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def fetch(cache, url, ref, commit, env=None):
+    """Fetch commit of git URL into the cache, as trees/COMMIT.
+
+    :param cache: cache directory
+    :type cache: str
+    :param url: git URL
+    :type url: str
+    :param ref: ref (None for default HEAD)
+    :type ref: str
+    :param commit: commit ID
+    :type commit: str
+    :param env: environment for git
+    :type env: dict
+    :returns: size of tree (bytes)
+    :rtype: int
+    :raises ValueError: if commit cannot be fetched
+    """
+    repo = os.path.join(cache, REPOS,
+                        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.git')
+    if not os.path.isdir(repo):
+        git(['init', '--quiet', '--bare', repo], env)
+    try:
+        git(['cat-file', '-e', commit + '^{commit}'], env, repo)
+    except ValueError:
+        if ref is None or COMMIT.match(ref):
+            refspecs = ['+refs/heads/*:refs/heads/*',
+                        '+refs/tags/*:refs/tags/*']
+        else:
+            refspecs = ['+{0}:{1}{2}'.format(ref, FETCHED_REF, commit)]
+        if ref is None:
+            refspecs.append('+HEAD:{0}{1}'.format(FETCHED_REF, commit))
+        git(['fetch', '--quiet', url] + refspecs, env, repo)
+        git(['cat-file', '-e', commit + '^{commit}'], env, repo)
+
+    trees = os.path.join(cache, TREES)
+    if not os.path.isdir(trees):
+        os.makedirs(trees)
+    temp_dir = tempfile.mkdtemp(dir=trees, prefix='.fetch-')
+    try:
+        process = subprocess.Popen(
+            [str('git'), str('--git-dir'), repo, str('archive'),
+             str('--format=tar'), str(commit)], env=env,
+            stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+            archive.extractall(temp_dir)
+        process.stdout.close()
+        if process.wait() != 0:
+            raise ValueError("git archive of '{0}' failed".format(commit))
+        size = tree_size(temp_dir)
+        os.chmod(temp_dir, 0o755)  # not 0700 as made by mkdtemp
+        os.rename(temp_dir, os.path.join(trees, commit))
+    except (IOError, OSError, tarfile.TarError) as err:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise ValueError(err)
+    except ValueError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return size
+
+
+def remove_module(target):
+    """Remove linked (or downloaded) module directory.
+
+    :param target: module directory
+    :type target: str
+    """
+    if os.path.islink(target) or os.path.isfile(target):
+        os.remove(target)
+    elif os.path.isdir(target):
+        shutil.rmtree(target)
+
+
+def link_tree(tree, target, link):
+    """Link cached tree as module directory (replacing it).
+
+    :param tree: cached tree directory
+    :type tree: str
+    :param target: module directory
+    :type target: str
+    :param link: HARDLINK or SYMLINK
+    :type link: str
+    """
+    remove_module(target)
+    if link == HARDLINK:
+        try:
+            for (dirpath, dirnames, filenames) in os.walk(tree):
+                relative = os.path.relpath(dirpath, tree)
+                os.mkdir(os.path.normpath(os.path.join(target, relative)))
+                for name in filenames + [name for name in dirnames if
+                                         os.path.islink(os.path.join(dirpath,
+                                                                     name))]:
+                    source = os.path.join(dirpath, name)
+                    dest = os.path.join(target, relative, name)
+                    if os.path.islink(source):
+                        os.symlink(os.readlink(source), dest)
+                    else:
+                        os.link(source, dest)
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            remove_module(target)  # different file system, use symlink
+    os.symlink(os.path.abspath(tree), target)
+
+
+def read_index(cache):
+    """Read cache index.
+
+    :param cache: cache directory (None for an empty index)
+    :type cache: str
+    :returns: index with 'refs', 'trees' and 'stats'
+    :rtype: dict
+    """
+    index = {}
+    try:
+        if cache is not None:
+            with open(os.path.join(cache, INDEX_NAME)) as index_file:
+                index = json.load(index_file)
+    except (IOError, ValueError):
+        pass
+    index.setdefault('refs', {})
+    index.setdefault('trees', {})
+    index.setdefault('stats', {})
+    for counter in COUNTERS:
+        index['stats'].setdefault(counter, 0)
+    return index
+
+
+def write_index(cache, index):
+    """Write cache index (atomically).
+
+    :param cache: cache directory
+    :type cache: str
+    :param index: cache index
+    :type index: dict
+    """
+    (temp_fd, temp_name) = tempfile.mkstemp(dir=cache)
+    with os.fdopen(temp_fd, 'w') as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    os.rename(temp_name, os.path.join(cache, INDEX_NAME))
+
+
+def evict(cache, index, keep, limit):
+    """Remove least recently used trees until the cache is within limit.
+
+    :param cache: cache directory
+    :type cache: str
+    :param index: cache index (trees and stats are updated)
+    :type index: dict
+    :param keep: commits not to evict (used now)
+    :type keep: set(str)
+    :param limit: size limit (bytes)
+    :type limit: int
+    """
+    size = sum(tree['size'] for tree in index['trees'].values())
+    for commit in sorted(index['trees'],
+                         key=lambda commit: index['trees'][commit]['used']):
+        if size <= limit:
+            break
+        if commit in keep:
+            continue
+        shutil.rmtree(os.path.join(cache, TREES, commit), ignore_errors=True)
+        size -= index['trees'].pop(commit)['size']
+        index['stats']['evictions'] += 1
+        print('Evicted module tree {0}'.format(commit[:12]))
+
+
+def link_modules(directory=os.curdir, env=None, link=None):
+    """Link cached git modules (fetching new commits) into MODULES_DIR.
+
+    :param directory: configuration directory
+    :type directory: str
+    :param env: environment for git
+    :type env: dict
+    :param link: HARDLINK or SYMLINK (default: $TFTOOLS_MODULE_LINK or
+                 HARDLINK)
+    :type link: str
+    :returns: True if all modules are linked or local, False if there are
+              other remote modules (which need `terraform get -update`)
+    :rtype: bool
+    :raises ValueError: if a module cannot be resolved or fetched (or the
+                        cache is disabled)
+    """
+    cache = cache_dir()
+    if cache is None:
+        raise ValueError('module cache disabled (${0} is empty)'.format(
+            CACHE_ENV))
+    link = link or os.environ.get(LINK_ENV) or HARDLINK
+    if link not in LINKS:
+        raise ValueError("${0} not one of {1}: '{2}'".format(
+            LINK_ENV, ', '.join(LINKS), link))
+    try:
+        limit = int(os.environ.get(SIZE_ENV) or SIZE_DEFAULT) * 1024 * 1024
+    except ValueError:
+        raise ValueError('${0} not a number'.format(SIZE_ENV))
+    modules_dir = os.path.join(directory, MODULES_DIR)
+    try:
+        for path in (cache, modules_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        lock_file = open(os.path.join(cache, LOCK_NAME), 'a')
+    except (IOError, OSError) as err:
+        raise ValueError(err)
+    with lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        index = read_index(cache)
+        used = set()
+        try:
+            complete = link_children(cache, index, directory, [], used,
+                                     set(), env, modules_dir, link)
+            evict(cache, index, used, limit)
+        except (IOError, OSError) as err:
+            raise ValueError(err)
+        finally:
+            write_index(cache, index)
+    return complete
+
+
+def link_children(cache, index, config_dir, path, used, resolved, env,
+                  modules_dir, link):
+    """Link cached git modules of a configuration and its modules.
+
+    :param cache: cache directory
+    :type cache: str
+    :param index: cache index (updated)
+    :type index: dict
+    :param config_dir: configuration directory of (sub)module
+    :type config_dir: str
+    :param path: module names from the root module to this one
+    :type path: list(str)
+    :param used: commits used (updated)
+    :type used: set(str)
+    :param resolved: refs already checked in this run (updated)
+    :type resolved: set(str)
+    :param env: environment for git
+    :type env: dict
+    :param modules_dir: MODULES_DIR of root module
+    :type modules_dir: str
+    :param link: HARDLINK or SYMLINK
+    :type link: str
+    :returns: True if all modules are linked or local
+    :rtype: bool
+    """
+    complete = True
+    for (name, source) in modules(config_dir):
+        if is_local(source):
+            child = os.path.join(config_dir, source)
+        else:
+            parts = git_source(source, config_dir)
+            if parts is None:
+                complete = False
+                continue
+            (url, ref, subdir) = parts
+            commit = resolve(url, ref, index, resolved, env)
+            tree = os.path.join(cache, TREES, commit)
+            if os.path.isdir(tree):
+                if commit not in index['trees']:  # index was lost
+                    index['trees'][commit] = {'size': tree_size(tree)}
+                index['stats']['hits'] += 1
+            else:
+                print('Fetching module {0}: {1} ({2})'.format(
+                    name, source, commit[:12]))
+                index['trees'][commit] = {'size': fetch(cache, url, ref,
+                                                        commit, env)}
+                index['stats']['fetches'] += 1
+            index['trees'][commit]['used'] = time.time()
+            used.add(commit)
+            target = os.path.join(modules_dir, module_key(path + [name],
+                                                          source))
+            marker = target + MARKER
+            try:
+                with open(marker) as marker_file:
+                    linked = marker_file.read().strip()
+            except IOError:
+                linked = None
+            if linked != commit or not os.path.isdir(target):
+                link_tree(tree, target, link)
+                with open(marker, 'w') as marker_file:
+                    marker_file.write(commit + '\n')
+            child = os.path.join(tree, subdir)
+        complete &= link_children(cache, index, child, path + [name], used,
+                                  resolved, env, modules_dir, link)
+    return complete
+
+
+def stats():
+    """Get module cache statistics.
+
+    :returns: 'cache' directory, 'trees' count and 'size', 'repos' count and
+              'repos_size', 'limit' (bytes), and COUNTERS
+    :rtype: dict
+    """
+    cache = cache_dir()
+    index = read_index(cache)
+    repos = glob.glob(os.path.join(cache, REPOS, '*.git')) if cache else []
+    result = {
+        'cache': cache, 'trees': len(index['trees']),
+        'size': sum(tree['size'] for tree in index['trees'].values()),
+        'repos': len(repos),
+        'repos_size': sum(tree_size(repo) for repo in repos),
+        'limit': int(os.environ.get(SIZE_ENV) or SIZE_DEFAULT) * 1024 * 1024
+    }
+    result.update(index['stats'])
+    return result
+
+
+def main():
+    """Link cached modules or show cache statistics.
+
+    :returns: Exit code (2 if other modules need `terraform get -update`)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Shared cache of git Terraform modules.'
+    )
+    parser.add_argument('action', choices=('get', 'stats'),
+                        help='link cached modules into ' + MODULES_DIR +
+                        ', or show cache statistics')
+    parser.add_argument('-l', '--link', dest='link', default=None,
+                        choices=LINKS, help='how to link modules (default: $' +
+                        LINK_ENV + " or '" + HARDLINK + "')")
+    parser.add_argument('-F', '--format', dest='fmt', default=TEXT,
+                        choices=FORMATS,
+                        help="stats output format (default: '%(default)s')")
+    args = parser.parse_args()
+
+    if args.action == 'get':
+        try:
+            return 0 if link_modules(link=args.link) else 2
+        except ValueError as err:
+            print(err, file=sys.stderr)
+            return 1
+    try:
+        result = stats()
+    except ValueError:
+        print('${0} not a number'.format(SIZE_ENV), file=sys.stderr)
+        return 1
+    if args.fmt == JSON:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return 0
+    print('Cache:     {0}'.format(result['cache'] or '(disabled)'))
+    print('Trees:     {0} ({1:.1f} MiB of {2:.0f} MiB)'.format(
+        result['trees'], result['size'] / 1024 / 1024,
+        result['limit'] / 1024 / 1024))
+    print('Repos:     {0} ({1:.1f} MiB)'.format(
+        result['repos'], result['repos_size'] / 1024 / 1024))
+    for counter in COUNTERS:
+        print('{0:<10} {1}'.format(counter.capitalize() + ':',
+                                   result[counter]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
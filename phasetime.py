@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Record and summarise timings of the phases of tfplan, tfapply and tfremote.
+
+Each phase of tfplan, tfapply and tfremote (and each run of the Python
+helpers they call) appends a record to the JSON-lines file named by
+$TFTOOLS_TIMINGS (see TIMINGS_ENV; nothing is recorded if it is unset or
+empty, and the scripts default it to TIMINGS_DEFAULT), e.g.:
+
+    {"time": 1430483696.123, "command": "tfplan", "phase": "plan",
+     "deployment": "test1", "duration": 12.345, "exit": 2, "bytes": 1234}
+
+where 'time' is when the phase ended (seconds since the epoch), 'exit' is
+its exit code, and 'bytes' is the size of its input or output (or null).
+When the file reaches TIMINGS_SIZE, it is renamed (see ROTATED_SUFFIX,
+replacing the previous one), so at most about twice that is kept.
+`phasetime.py summary` shows percentiles of phase durations across runs.
+
+If $TFTOOLS_PROFILE is set (see PROFILE_ENV), the Python helpers that use
+main_timed() are also run under cProfile, and each run's profile is written
+to the directory it names (or, if it is '1', to DEPLOY/artifacts/profiles
+next to the plan artifacts, where `artifacts.py gc` expires them with the
+plans), for `python -m pstats PROFILE`.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import errno
+import json
+import math
+import os
+import sys
+import time
+
+import artifacts
+
+# Environment variables: timings file, profile directory (or '1'), and the
+# command and deployment recorded by helpers (exported by the scripts)
+TIMINGS_ENV = 'TFTOOLS_TIMINGS'
+PROFILE_ENV = 'TFTOOLS_PROFILE'
+COMMAND_ENV = 'TFTOOLS_COMMAND'
+DEPLOYMENT_ENV = 'TFTOOLS_DEPLOYMENT'
+
+TIMINGS_DEFAULT = '.terraform/timings.jsonl'
+
+# Timings file size at which it is rotated, and suffix of the rotated file
+TIMINGS_SIZE = 1024 * 1024
+ROTATED_SUFFIX = '.1'
+
+PERCENTILES = (50, 90, 99)
+
+# Output formats
+TEXT, JSON = 'text', 'json'
+FORMATS = (TEXT, JSON)
+
+# Bytes processed by the current helper run (see processed())
+BYTES = [None]
+
+
+def record(phase, duration, status=0, nbytes=None, deployment=None,
+           command=None):
+    """Append timing record to timings file (errors are ignored).
+
+    :param phase: phase name
+    :type phase: str
+    :param duration: duration (seconds)
+    :type duration: float
+    :param status: exit code
+    :type status: int
+    :param nbytes: bytes processed (or None)
+    :type nbytes: int
+    :param deployment: deployment (default: $TFTOOLS_DEPLOYMENT)
+    :type deployment: str
+    :param command: command (default: $TFTOOLS_COMMAND or script name)
+    :type command: str
+    """
+    timings = os.environ.get(TIMINGS_ENV)
+    if not timings:
+        return
+    if deployment is None:
+        deployment = os.environ.get(DEPLOYMENT_ENV) or None
+    if command is None:
+        command = (os.environ.get(COMMAND_ENV) or
+                   os.path.basename(sys.argv[0]))
+    line = json.dumps({
+        'time': round(time.time(), 3), 'command': command, 'phase': phase,
+        'deployment': deployment, 'duration': round(duration, 3),
+        'exit': status, 'bytes': nbytes
+    }, sort_keys=True) + '\n'
+    try:
+        if os.path.dirname(timings):
+            try:
+                os.makedirs(os.path.dirname(timings))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        # a single write of a short line in append mode is not interleaved
+        # with records written concurrently (e.g. by tfmulti.py runs)
+        timings_fd = os.open(timings, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                             0o644)
+        try:
+            os.write(timings_fd, line.encode('utf-8'))
+            timings_stat = os.fstat(timings_fd)
+            # (unless another run has just rotated it)
+            if (timings_stat.st_size >= TIMINGS_SIZE and
+                    os.stat(timings).st_ino == timings_stat.st_ino):
+                os.rename(timings, timings + ROTATED_SUFFIX)
+        finally:
+            os.close(timings_fd)
+    except (IOError, OSError):
+        pass
+
+
+def processed(nbytes):
+    """Count bytes processed by the current helper run.
+
+    :param nbytes: bytes processed
+    :type nbytes: int
+    """
+    BYTES[0] = (BYTES[0] or 0) + nbytes
+
+
+def profile_name(phase):
+    """Get profile filename for a helper run, if profiling is enabled.
+
+    :param phase: phase (helper) name
+    :type phase: str
+    :returns: profile filename
+    :returns: None if $TFTOOLS_PROFILE is not set
+    :rtype: str
+    """
+    directory = os.environ.get(PROFILE_ENV)
+    if not directory:
+        return None
+    if directory == '1':
+        deployment = os.environ.get(DEPLOYMENT_ENV)
+        if deployment:
+            directory = artifacts.store_path(deployment, artifacts.PROFILES)
+        else:
+            directory = os.path.join('.terraform', artifacts.PROFILES)
+    return os.path.join(directory, '{0}-{1}-{2}.prof'.format(
+        phase, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+
+def main_timed(phase, function, name=None):
+    """Run a helper main() function, recording its timing (and profile).
+
+    :param phase: phase (helper) name
+    :type phase: str
+    :param function: main function (returning exit code)
+    :type function: function
+    :param name: profile name (default: phase)
+    :type name: str
+    :returns: exit code of main
+    :rtype: int
+    """
+    profiler = None
+    if os.environ.get(PROFILE_ENV):
+        import cProfile
+        profiler = cProfile.Profile()
+    status = 1  # unless main returns or exits
+    start = time.time()
+    try:
+        if profiler is None:
+            status = function()
+        else:
+            status = profiler.runcall(function)
+        return status
+    except SystemExit as err:
+        status = err.code
+        raise
+    finally:
+        duration = time.time() - start
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            status = 1  # sys.exit(message)
+        record(phase, duration, status, BYTES[0])
+        if profiler is not None:
+            # after main, which may have set the deployment (for the path)
+            profile = profile_name(name or phase)
+            try:
+                if not os.path.isdir(os.path.dirname(profile)):
+                    os.makedirs(os.path.dirname(profile))
+                profiler.dump_stats(profile)
+            except (IOError, OSError) as err:
+                print('{0}: profile not written: {1}'.format(phase, err),
+                      file=sys.stderr)
+
+
+def read_timings(timings, since=None):
+    """Read timing records (from the rotated timings file too).
+
+    :param timings: timings filename
+    :type timings: str
+    :param since: only records after this time (seconds since the epoch)
+    :type since: float
+    :returns: timing records (invalid lines are skipped)
+    :rtype: list(dict)
+    :raises ValueError: if timings file cannot be read
+    """
+    records = []
+    found = False  # (either file)
+    for filename in (timings + ROTATED_SUFFIX, timings):
+        try:
+            with open(filename) as timings_file:
+                for line in timings_file:
+                    try:
+                        timing = json.loads(line)
+                        if not isinstance(timing, dict):
+                            continue
+                        if since is None or timing.get('time', 0) >= since:
+                            float(timing['duration'])
+                            records.append(timing)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            found = True
+        except IOError as err:
+            if filename == timings and not found:
+                raise ValueError(err)
+    return records
+
+
+def percentile(values, percent):
+    """Get (nearest-rank) percentile of sorted values.
+
+    :param values: sorted values (not empty)
+    :type values: list(float)
+    :param percent: percentile
+    :type percent: int
+    :returns: percentile value
+    :rtype: float
+    """
+    rank = int(math.ceil(percent / 100 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summary(records):
+    """Summarise durations of each phase.
+
+    :param records: timing records
+    :type records: list(dict)
+    :returns: summary for each (command, phase), in order of first record,
+              with 'command', 'phase', 'count', failures ('failed'), 'pNN'
+              and 'max' durations, and 'bytes' (median, or None)
+    :rtype: list(dict)
+    """
+    phases = {}
+    order = []
+    for timing in records:
+        key = (timing.get('command'), timing.get('phase'))
+        if key not in phases:
+            phases[key] = []
+            order.append(key)
+        phases[key].append(timing)
+
+    result = []
+    for key in order:
+        durations = sorted(float(timing['duration']) for timing in phases[key])
+        sizes = sorted(timing['bytes'] for timing in phases[key]
+                       if isinstance(timing.get('bytes'), int))
+        phase = {'command': key[0], 'phase': key[1], 'count': len(durations),
+                 'failed': sum(1 for timing in phases[key]
+                               if timing.get('exit') not in (0, 2)),
+                 'max': durations[-1],
+                 'bytes': percentile(sizes, 50) if sizes else None}
+        for percent in PERCENTILES:
+            phase['p{0}'.format(percent)] = percentile(durations, percent)
+        result.append(phase)
+    return result
+
+
+def main():
+    """Summarise phase timings.
+
+    :returns: Exit code (1 if timings file cannot be read)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Summarise durations of tfplan/tfapply/tfremote phases.'
+    )
+    parser.add_argument('action', choices=('summary',),
+                        help='show percentiles of phase durations')
+    parser.add_argument('-f', '--file', dest='timings',
+                        default=os.environ.get(TIMINGS_ENV) or
+                        TIMINGS_DEFAULT,
+                        help='timings file (default: $' + TIMINGS_ENV +
+                        " or '" + TIMINGS_DEFAULT + "')", metavar='FILE')
+    parser.add_argument('-c', '--command', dest='command', default=None,
+                        help='only phases of COMMAND (e.g. tfplan)')
+    parser.add_argument('-d', '--deployment', dest='deployment',
+                        default=None, help='only phases for DEPLOY',
+                        metavar='DEPLOY')
+    parser.add_argument('--days', dest='days', default=None, type=float,
+                        help='only runs in the last DAYS days')
+    parser.add_argument('-F', '--format', dest='fmt', default=TEXT,
+                        choices=FORMATS,
+                        help="output format (default: '%(default)s')")
+    args = parser.parse_args()
+
+    since = None
+    if args.days is not None:
+        since = time.time() - args.days * 24 * 3600
+    try:
+        records = read_timings(args.timings, since)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    records = [timing for timing in records
+               if args.command in (None, timing.get('command')) and
+               args.deployment in (None, timing.get('deployment'))]
+    phases = summary(records)
+
+    if args.fmt == JSON:
+        print(json.dumps(phases, indent=2, sort_keys=True))
+        return 0
+    columns = ['p{0}'.format(percent) for percent in PERCENTILES] + ['max']
+    print('{0:<24} {1:>5} {2:>6} {3} {4:>10}'.format(
+        'PHASE', 'RUNS', 'FAILED',
+        ' '.join('{0:>8}'.format(column) for column in columns), 'BYTES'))
+    for phase in phases:
+        print('{0:<24} {1:>5} {2:>6} {3} {4:>10}'.format(
+            '{0}:{1}'.format(phase['command'], phase['phase']),
+            phase['count'], phase['failed'],
+            ' '.join('{0:8.3f}'.format(phase[column]) for column in columns),
+            '-' if phase['bytes'] is None else phase['bytes']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fingerprint the inputs of a Terraform plan, to reuse unchanged plans.
+
+The fingerprint has a SHA-256 digest for each input of `terraform plan`:
+the .tf files, the deployment .tfvars and .tfenv files (and the .env files
+sourced with them), the .userdata files they reference, the files in local
+module sources, the tfplan -target and -destroy options, and the serial and
+lineage of the state. Remote module sources are only fingerprinted by their
+source address, so a plan using a moving ref (e.g. a branch) is reused even
+if the ref has moved; use tfplan -refresh=true to plan anyway.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import stateindex
+import userdata_decode
+
+# Environment variable for maximum age (seconds) of a reused plan
+TTL_ENV = 'TFPLAN_TTL'
+TTL_DEFAULT = 3600
+
+# Fingerprint file is the plan filename with this suffix instead of .plan
+SUFFIX = '.fingerprint'
+
+USERDATA = re.compile(br'filename\s*=\s*"([^"]*\.userdata)"')
+SOURCE = re.compile(br'source\s*=\s*"([^"]+)"')
+
+
+def file_digest(filename):
+    """Compute digest of file contents.
+
+    :param filename: file to digest
+    :type filename: str
+    :returns: hex digest (None if file does not exist)
+    :rtype: str
+    """
+    try:
+        return userdata_decode.file_digest(filename, hashlib.sha256())
+    except IOError:
+        return None
+
+
+def tree_digest(directory):
+    """Compute digest of names and contents of all files below directory.
+
+    :param directory: directory to digest
+    :type directory: str
+    :returns: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for (path, dirs, files) in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for name in sorted(files):
+            filename = os.path.join(path, name)
+            digest.update(json.dumps(
+                [os.path.relpath(filename, directory), file_digest(filename)]
+            ).encode())
+    return digest.hexdigest()
+
+
+def fingerprint(deployment, options=(), statefile=None):
+    """Fingerprint the inputs of a plan.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param options: tfplan -target and -destroy options
+    :type options: list(str)
+    :param statefile: state file (default: DEPLOY/terraform.tfstate)
+    :type statefile: str
+    :returns: digests of plan inputs, keyed by file (or 'options', 'state')
+    :rtype: dict
+    """
+    if statefile is None:
+        statefile = os.path.join(deployment, stateindex.STATE_NAME)
+    inputs = sorted(glob.glob('*.tf')) + sorted(glob.glob('*.env')) + [
+        deployment + '.tfvars', deployment + '.tfenv'
+    ]
+    prints = {}
+    for filename in inputs:
+        prints[filename] = file_digest(filename)
+
+    for filename in sorted(glob.glob('*.tf')):
+        with open(filename, 'rb') as tf_file:
+            config = tf_file.read()
+        for name in USERDATA.findall(config):
+            name = name.decode('utf-8')
+            prints[name] = file_digest(name)
+        for source in SOURCE.findall(config):
+            source = source.decode('utf-8')
+            if source.startswith(('./', '../', '/')) and os.path.isdir(source):
+                prints[source] = tree_digest(source)
+
+    prints['options'] = hashlib.sha256(json.dumps(
+        sorted(option for option in options
+               if option.startswith(('-target=', '-destroy')))
+    ).encode()).hexdigest()
+    try:
+        index = stateindex.index_file(statefile)
+        prints['state'] = '{0} {1}'.format(index['serial'], index['lineage'])
+    except ValueError:  # no (valid) state
+        prints['state'] = None
+    return prints
+
+
+def fingerprint_name(plan):
+    """Get fingerprint filename for a plan (following latest.plan symlink).
+
+    :param plan: plan filename
+    :type plan: str
+    :returns: fingerprint filename
+    :rtype: str
+    """
+    return re.sub(r'\.plan$', '', os.path.realpath(plan)) + SUFFIX
+
+
+def check(plan, prints, ttl):
+    """Check whether a plan can be reused.
+
+    :param plan: plan filename
+    :type plan: str
+    :param prints: current fingerprint
+    :type prints: dict
+    :param ttl: maximum age of plan (seconds)
+    :type ttl: int
+    :returns: reasons why the plan cannot be reused (empty if it can)
+    :rtype: list(str)
+    """
+    try:
+        if time.time() - os.stat(plan).st_mtime > ttl:
+            return ['plan is older than {0} seconds'.format(ttl)]
+    except OSError:
+        return ['no previous plan']
+    try:
+        with open(fingerprint_name(plan)) as print_file:
+            recorded = json.load(print_file)
+    except (IOError, OSError, ValueError):
+        return ['no plan fingerprint']
+    return sorted(name for name in set(prints) | set(recorded)
+                  if prints.get(name) != recorded.get(name))
+
+
+def reuse(plan, deployment, options=(), statefile=None):
+    """Check whether a plan can be reused, with TTL from the environment.
+
+    :param plan: plan filename
+    :type plan: str
+    :param deployment: deployment name
+    :type deployment: str
+    :param options: tfplan -target and -destroy options
+    :type options: list(str)
+    :param statefile: state file (default: DEPLOY/terraform.tfstate)
+    :type statefile: str
+    :returns: reasons why the plan cannot be reused (empty if it can)
+    :rtype: list(str)
+    :raises ValueError: if $TFPLAN_TTL is not a number
+    """
+    try:
+        ttl = int(os.environ.get(TTL_ENV, TTL_DEFAULT))
+    except ValueError:
+        raise ValueError('{0} must be a number of seconds'.format(TTL_ENV))
+    if ttl <= 0:
+        return ['{0} is {1}'.format(TTL_ENV, ttl)]
+    return check(plan, fingerprint(deployment, options, statefile), ttl)
+
+
+def save(plan, prints):
+    """Write fingerprint for a plan.
+
+    :param plan: plan filename
+    :type plan: str
+    :param prints: fingerprint
+    :type prints: dict
+    :raises IOError: if fingerprint file cannot be written
+    """
+    with open(fingerprint_name(plan), 'w') as print_file:
+        json.dump(prints, print_file, indent=0, sort_keys=True)
+
+
+def main():
+    """Write plan fingerprint, or check it to reuse a plan.
+
+    :returns: Exit code (0 unless the plan cannot be reused)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Write or check fingerprint of Terraform plan inputs.'
+    )
+    parser.add_argument('-s', '--state', dest='statefile', default=None,
+                        help='state file (default: DEPLOY/' +
+                        stateindex.STATE_NAME + ')', metavar='FILE')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('-w', '--write', dest='write', default=None,
+                        help='write fingerprint for PLAN', metavar='PLAN')
+    action.add_argument('-c', '--check', dest='check', default=None,
+                        help='check that PLAN can be reused (exit 1 if not)',
+                        metavar='PLAN')
+    parser.add_argument('deployment', help='deployment (with .tfvars file)',
+                        metavar='DEPLOY')
+    (args, options) = parser.parse_known_args()
+    deployment = re.sub(r'\.tfvars$', '', args.deployment)
+
+    if args.write is not None:
+        try:
+            save(args.write, fingerprint(deployment, options, args.statefile))
+        except IOError as err:
+            print(err, file=sys.stderr)
+            return 1
+        return 0
+
+    try:
+        changed = reuse(args.check, deployment, options, args.statefile)
+    except ValueError as err:
+        parser.error(str(err))
+    if changed:
+        print('Not reusing plan: ' + ', '.join(changed), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run pre-flight checks (staged .tf files and pre-commit hooks) for tfplan.
+
+Each pre-commit hook is run only for the staged files it has not already
+passed: a content-hash key (hook, hook configuration, filename and staged
+blob ID) for each passed file is cached in the Git directory (see
+CACHE_NAME), so unchanged files are not checked again. As with pre-commit,
+hooks check the staged contents: unstaged changes of the files to check are
+saved as a patch (see PATCH_NAME) while hooks run, and then restored (if
+they conflict with changes made by fixers, those changes are discarded).
+Read-only hooks are
+run in parallel (one `pre-commit run HOOK --files ...` each), and if a hook
+fails for several files, it is run again for each of them to find which
+failed. Hooks that fix files (see FIXERS) are then run one at a time, and
+fail for the files they change.
+
+Results are output as text (one 'CHECK: FILE' line per failure) or JSON.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+try:
+    import yaml
+except ImportError:  # pre-commit (which requires PyYAML) is not installed
+    yaml = None
+
+import getremote
+
+CONFIG = '.pre-commit-config.yaml'
+
+# Hooks run by default (those tfplan relies on)
+HOOKS = 'private|conflict'
+
+# Hooks that modify the files they check (never run at the same time)
+FIXERS = 'fixer|trailing-whitespace|autopep8|sorter'
+
+# Cache file for passed checks, in Git directory; maximum number of entries
+CACHE_NAME = 'preflight-cache.json'
+CACHE_ENTRIES = 20000
+
+# Unstaged changes saved while hooks run, in Git directory
+PATCH_NAME = 'preflight-unstaged.patch'
+
+# Name of (built-in) check for unstaged/untracked .tf files
+STAGED = 'staged'
+
+# Output formats
+TEXT, JSON = 'text', 'json'
+FORMATS = (TEXT, JSON)
+
+HOOK_ID = re.compile(r'^\s*-\s*id:\s*([^\s#]+)', re.MULTILINE)
+UNSTAGED_TF = re.compile(r'^([U?]|.[DMU]).*\.tf$')
+
+
+def git(*args):
+    """Run git command and get its output.
+
+    :param args: git arguments
+    :type args: str
+    :returns: output
+    :rtype: str
+    :raises ValueError: if git fails (e.g. not in a Git repository)
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ('git',) + args, stderr=devnull
+            ).decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise ValueError('git {0} failed: {1}'.format(args[0], err))
+
+
+def hook_configs(config=CONFIG):
+    """Get hook configurations from pre-commit configuration.
+
+    :param config: pre-commit configuration filename
+    :type config: str
+    :returns: configuration (JSON text) of each hook, keyed by hook ID
+    :rtype: dict
+    """
+    try:
+        with open(config) as config_file:
+            text = config_file.read()
+    except IOError:
+        return {}
+    if yaml is None:  # hook IDs only, configuration is the whole file
+        return dict((hook, text) for hook in HOOK_ID.findall(text))
+    hooks = {}
+    for repo in yaml.safe_load(text) or []:
+        for hook in repo.get('hooks', []):
+            hooks.setdefault(hook['id'], []).append(
+                [repo.get('repo'), repo.get('sha'), hook])
+    return dict((hook, json.dumps(value, sort_keys=True))
+                for (hook, value) in hooks.items())
+
+
+def file_digest(filename):
+    """Compute digest of file contents.
+
+    :param filename: file to digest
+    :type filename: str
+    :returns: hex digest (None if file cannot be read)
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as input_file:
+            for data in iter(lambda: input_file.read(1024 * 1024), b''):
+                digest.update(data)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def check_key(hook, config, filename, digest):
+    """Make cache key for a check of a file by a hook.
+
+    :param hook: hook ID
+    :type hook: str
+    :param config: hook configuration
+    :type config: str
+    :param filename: checked file
+    :type filename: str
+    :param digest: digest of file contents (staged blob ID)
+    :type digest: str
+    :returns: hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(
+        json.dumps([hook, config, filename, digest]).encode()
+    ).hexdigest()
+
+
+def load_cache(cache_name):
+    """Load cached passed check keys.
+
+    :param cache_name: cache filename
+    :type cache_name: str
+    :returns: passed check keys (in order of last use)
+    :rtype: collections.OrderedDict
+    """
+    keys = []
+    try:
+        with open(cache_name) as cache_file:
+            keys = json.load(cache_file)
+    except (IOError, ValueError):
+        pass
+    if not isinstance(keys, list):
+        keys = []
+    return collections.OrderedDict((key, None) for key in keys)
+
+
+def save_cache(cache_name, keys):
+    """Save passed check keys (errors are ignored).
+
+    :param cache_name: cache filename
+    :type cache_name: str
+    :param keys: passed check keys (in order of last use)
+    :type keys: collections.OrderedDict
+    """
+    getremote.save_json(cache_name, list(keys)[-CACHE_ENTRIES:])
+
+
+def staged_blobs():
+    """Get blob IDs of staged files (added, copied or modified).
+
+    :returns: blob ID of each staged file (but not submodules)
+    :rtype: dict
+    """
+    fields = git('diff', '--cached', '--raw', '--no-abbrev', '--no-renames',
+                 '--diff-filter=ACM', '-z').split('\0')
+    # ':OLD_MODE NEW_MODE OLD_BLOB NEW_BLOB STATUS', filename
+    return dict((name, meta.split()[3])
+                for (meta, name) in zip(fields[::2], fields[1::2])
+                if meta.startswith(':') and meta.split()[1] != '160000')
+
+
+def stash_unstaged(patch_name, filenames):
+    """Save unstaged changes of files as patch, and check out staged files.
+
+    :param patch_name: patch filename
+    :type patch_name: str
+    :param filenames: files to check out
+    :type filenames: list(str)
+    :returns: files checked out (with unstaged changes)
+    :rtype: list(str)
+    :raises ValueError: if a patch of an interrupted run exists
+    """
+    if os.path.exists(patch_name):
+        raise ValueError("unstaged changes of an interrupted run are saved "
+                         "in '{0}' (use git apply)".format(patch_name))
+    unstaged = [name for name in git('diff', '--name-only', '-z', '--',
+                                     *filenames).split('\0') if name]
+    if not unstaged:
+        return []
+    try:
+        with open(patch_name, 'wb') as patch_file:
+            subprocess.check_call(
+                ['git', 'diff', '--binary', '--no-color', '--no-ext-diff',
+                 '--no-textconv', '--'] + unstaged, stdout=patch_file)
+    except (IOError, OSError, subprocess.CalledProcessError) as err:
+        raise ValueError('git diff failed: {0}'.format(err))
+    git('checkout', '--', *unstaged)
+    return unstaged
+
+
+def restore_unstaged(patch_name, filenames):
+    """Apply patch of unstaged changes (discarding conflicting fixes).
+
+    :param patch_name: patch filename
+    :type patch_name: str
+    :param filenames: files checked out by stash_unstaged()
+    :type filenames: list(str)
+    :raises ValueError: if the patch cannot be applied
+    """
+    try:
+        git('apply', '--whitespace=nowarn', patch_name)
+    except ValueError:
+        git('checkout', '--', *filenames)
+        try:
+            git('apply', '--whitespace=nowarn', patch_name)
+        except ValueError:
+            raise ValueError("cannot restore unstaged changes saved in "
+                             "'{0}' (use git apply)".format(patch_name))
+    os.remove(patch_name)
+
+
+def run_hook(job):
+    """Run pre-commit hook on files.
+
+    A hook that fixes files fails for those it changes (running it again for
+    each file would only find them already fixed).
+
+    :param job: hook ID, filenames, and whether hook fixes files
+    :type job: tuple(str, list(str), bool)
+    :returns: hook ID, filenames that failed, and hook output
+    :rtype: tuple(str, list(str), str)
+    """
+    (hook, filenames, fixer) = job
+    digests = {}
+    if fixer:
+        digests = dict((name, file_digest(name)) for name in filenames)
+    command = ['pre-commit', 'run', hook, '--files'] + filenames
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+    except OSError as err:
+        return hook, filenames, str(err)
+    out = process.communicate()[0].decode('utf-8', 'replace')
+    if process.returncode == 0:
+        return hook, [], out
+    if fixer:
+        changed = [name for name in filenames
+                   if file_digest(name) != digests[name]]
+        return hook, changed or filenames, out
+    if len(filenames) == 1:
+        return hook, filenames, out
+    failed = []
+    for filename in filenames:  # find which files failed
+        failed.extend(run_hook((hook, [filename], False))[1])
+    return hook, failed, out
+
+
+def preflight(hook_pattern=HOOKS, jobs=None):
+    """Run pre-flight checks.
+
+    :param hook_pattern: regular expression for pre-commit hook IDs to run
+    :type hook_pattern: str
+    :param jobs: number of read-only hooks run at once (default: all)
+    :type jobs: int
+    :returns: result with 'passed' flag, 'failed' dict of filenames for each
+              failed check, 'output' of failed hooks, and numbers of files
+              'checked' and 'cached' (skipped because already passed)
+    :rtype: dict
+    :raises ValueError: if not in a Git repository
+    """
+    result = {'passed': True, 'failed': {}, 'output': {},
+              'checked': 0, 'cached': 0}
+    unstaged = [line[3:] for line in git('status', '--porcelain').splitlines()
+                if UNSTAGED_TF.match(line)]
+    if unstaged:
+        result['failed'][STAGED] = unstaged
+
+    git_dir = git('rev-parse', '--git-dir').strip()
+    if os.path.exists(os.path.join(git_dir, 'hooks', 'pre-commit')):
+        configs = hook_configs()
+        hooks = sorted(hook for hook in configs
+                       if re.search(hook_pattern, hook))
+    else:  # pre-commit not installed, so there are no hooks to run
+        hooks = []
+    digests = staged_blobs()
+    staged = sorted(digests)
+
+    cache_name = os.path.join(git_dir, CACHE_NAME)
+    passed = load_cache(cache_name)
+    keys = {}
+    todo = []
+    for hook in hooks:
+        files = []
+        for name in staged:
+            key = check_key(hook, configs[hook], name, digests[name])
+            if key in passed:
+                del passed[key]  # moved to end (most recently used)
+                passed[key] = None
+                result['cached'] += 1
+            else:
+                keys[hook, name] = key
+                files.append(name)
+        if files:
+            todo.append((hook, files))
+            result['checked'] += len(files)
+
+    checks = [(hook, files, False) for (hook, files) in todo
+              if not re.search(FIXERS, hook)]
+    fixes = [(hook, files, True) for (hook, files) in todo
+             if re.search(FIXERS, hook)]
+    fixed = set()  # (possibly) changed since digests were taken
+    patch_name = os.path.join(git_dir, PATCH_NAME)
+    stashed = stash_unstaged(patch_name, sorted(
+        set(name for (_, files) in todo for name in files))) if todo else []
+    pool = ThreadPool(min(jobs or len(checks), len(checks))) if checks else None
+    try:
+        # fixers only run after all the read-only hooks are done
+        for (hook, failed, out) in itertools.chain(
+                pool.imap_unordered(run_hook, checks) if pool else [],
+                (run_hook(job) for job in fixes)):
+            if failed:
+                result['failed'][hook] = sorted(failed)
+                result['output'][hook] = out
+            for name in dict(todo)[hook]:
+                if name not in failed and name not in fixed:
+                    passed[keys[hook, name]] = None
+            if re.search(FIXERS, hook):
+                fixed.update(failed)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if stashed:
+            restore_unstaged(patch_name, stashed)
+    save_cache(cache_name, passed)
+    result['passed'] = not result['failed']
+    return result
+
+
+def report(result, fmt=TEXT):
+    """Output pre-flight check failures.
+
+    :param result: result from preflight()
+    :type result: dict
+    :param fmt: output format (TEXT or JSON)
+    :type fmt: str
+    """
+    if fmt == JSON:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    for (check, failed) in sorted(result['failed'].items()):
+        if check in result['output']:
+            print(result['output'][check].rstrip())
+        for name in failed:
+            print('{0}: {1}'.format(check, name))
+    if STAGED in result['failed']:
+        print('unstaged .tf files; use `git add *.tf` or `git stash -u` '
+              'first')
+
+
+def main():
+    """Run pre-flight checks and output failures.
+
+    :returns: Exit code (0 if all checks passed, 1 otherwise)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Run pre-flight checks (staged .tf files and pre-commit '
+        'hooks) on files changed since they last passed.'
+    )
+    parser.add_argument('-H', '--hooks', dest='hooks', default=HOOKS,
+                        help="regular expression for pre-commit hooks to run "
+                        "(default: '%(default)s', '.' for all hooks)",
+                        metavar='REGEX')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=None, type=int,
+                        help='read-only hooks run at once (default: all)')
+    parser.add_argument('-F', '--format', dest='fmt', default=TEXT,
+                        choices=FORMATS,
+                        help="output format (default: '%(default)s')")
+    args = parser.parse_args()
+    try:
+        result = preflight(args.hooks, args.jobs)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    report(result, args.fmt)
+    return 0 if result['passed'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
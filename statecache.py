@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache copies of Atlas remote state, keyed by remote name and version.
+
+tfremote saves a copy of the local copy of remote state (see TF_STATE)
+after each pull, push and config, in a directory for each remote name under
+$TFREMOTE_STATE_CACHE (see CACHE_ENV and CACHE_DEFAULT):
+
+    ORG/DEPLOY/SERIAL_LINEAGE_SHA256.tfstate
+
+where the SHA-256 checksum of the copy is checked before it is used. Only
+the start of the remote state is fetched to get its version (serial and
+lineage, see remote_version()), so that tfremote can skip transferring
+state that the local copy or the cache already has.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import errno
+import hashlib
+import os
+import re
+import socket
+import sys
+import tempfile
+
+# Python 2/3 compatibility
+try:
+    # noinspection PyCompatibility
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    # noinspection PyCompatibility
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from urllib import urlencode
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from urlparse import urlparse
+
+TF_STATE = str('.terraform/terraform.tfstate')
+
+# Environment variable for cache directory (empty to disable the cache)
+CACHE_ENV = 'TFREMOTE_STATE_CACHE'
+CACHE_DEFAULT = '.terraform/state-cache'
+
+# Cached versions kept for each remote name (newest serials)
+CACHE_KEEP = 3
+
+# Atlas state API (as used by terraform), with address and access token
+# from the environment (atlas.env); ATLAS_ADDRESS can be a local test server
+ADDRESS_ENV = 'ATLAS_ADDRESS'
+ADDRESS_DEFAULT = 'https://atlas.hashicorp.com'
+TOKEN_ENV = 'ATLAS_TOKEN'
+STATE_PATH = '/api/v1/terraform/state/'
+
+# Bytes of state read to get its version (the top-level 'serial' and
+# 'lineage' are written before 'remote' and 'modules')
+PROBE_SIZE = 4096
+
+# Connect and read timeout (seconds) for remote state version
+HTTP_TIMEOUT = 10
+
+# Buffer size for copying state
+CHUNK_SIZE = 64 * 1024
+
+SERIAL = re.compile(r'"serial"\s*:\s*([0-9]+)')
+LINEAGE = re.compile(r'"lineage"\s*:\s*"([^"\\]*)"')
+
+# Cache entry filename (lineage is a UUID, or empty for older state)
+ENTRY = re.compile(r'^([0-9]+)_([0-9A-Za-z-]*)_([0-9a-f]{64})\.tfstate$')
+SAFE_LINEAGE = re.compile(r'^[0-9A-Za-z-]*$')
+UNSAFE_NAME = re.compile(r'[^0-9A-Za-z_-]')
+
+
+def version(data):
+    """Get version of state from the start of a state file.
+
+    :param data: start of state file
+    :type data: bytes
+    :returns: lineage (None if not set) and serial
+    :rtype: tuple(str, int)
+    :raises ValueError: if serial is not found
+    """
+    text = data.decode('utf-8', 'replace')
+    end = text.find('"modules"')
+    if end >= 0:
+        text = text[:end]
+    serial = SERIAL.search(text)
+    if serial is None:
+        raise ValueError('no serial in state')
+    lineage = LINEAGE.search(text)
+    return (lineage.group(1) if lineage else None, int(serial.group(1)))
+
+
+def file_version(statefile):
+    """Get version of state file.
+
+    :param statefile: state filename
+    :type statefile: str
+    :returns: lineage (None if not set) and serial
+    :rtype: tuple(str, int)
+    :raises ValueError: if state cannot be read or has no serial
+    """
+    try:
+        with open(statefile, 'rb') as state:
+            data = state.read(PROBE_SIZE)
+            try:
+                return version(data)
+            except ValueError:
+                return version(data + state.read())
+    except IOError as err:
+        raise ValueError(err)
+
+
+def state_url(name, env):
+    """Get Atlas state API URL for remote name.
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :param env: environment with ATLAS_TOKEN (and ATLAS_ADDRESS)
+    :type env: dict
+    :returns: URL (with access token)
+    :rtype: str
+    """
+    url = (env.get(ADDRESS_ENV) or ADDRESS_DEFAULT).rstrip('/')
+    url += STATE_PATH + name
+    if env.get(TOKEN_ENV):
+        url += '?' + urlencode({str('access_token'): str(env[TOKEN_ENV])})
+    return url
+
+
+def remote_version(name, env, timeout=HTTP_TIMEOUT):
+    """Get version of remote state, fetching only the start of it.
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :param env: environment with ATLAS_TOKEN (and ATLAS_ADDRESS)
+    :type env: dict
+    :param timeout: connect and read timeout (seconds)
+    :type timeout: float
+    :returns: lineage (None if not set) and serial
+    :rtype: tuple(str, int)
+    :raises ValueError: if the request fails, or there is no remote state
+    """
+    parts = urlparse(state_url(name, env))
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("Not an http(s): {0}: '{1}'".format(
+            ADDRESS_ENV, env.get(ADDRESS_ENV)))
+    connection_class = (HTTPSConnection if parts.scheme == 'https' else
+                        HTTPConnection)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    connection = connection_class(parts.hostname, parts.port,
+                                  timeout=timeout)
+    try:
+        # the server may ignore the range and send all the state; only the
+        # start of it is read before the connection is closed
+        connection.request(str('GET'), str(path), headers={
+            str('Range'): str('bytes=0-{0}'.format(PROBE_SIZE - 1))})
+        response = connection.getresponse()
+        if response.status == 404:
+            raise ValueError("no remote state for '{0}'".format(name))
+        if response.status not in (200, 206):
+            raise ValueError("{0} {1}: '{2}'".format(
+                response.status, response.reason, name))
+        data = response.read(PROBE_SIZE)
+    except (HTTPException, socket.error) as err:
+        raise ValueError("{0}: '{1}'".format(
+            str(err) or type(err).__name__, name))
+    finally:
+        connection.close()
+    return version(data)
+
+
+def cache_dir(name):
+    """Get cache directory for remote name.
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :returns: directory (None if the cache is disabled)
+    :rtype: str
+    """
+    directory = os.environ.get(CACHE_ENV, CACHE_DEFAULT)
+    if not directory:
+        return None
+    return os.path.join(directory, *[UNSAFE_NAME.sub('_', part) or '_'
+                                     for part in name.split('/')])
+
+
+def entries(name):
+    """Get cache entries for remote name (checksums are not checked).
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :returns: (serial, lineage, SHA-256 digest, filename) for each entry,
+              newest serial first
+    :rtype: list(tuple(int, str, str, str))
+    """
+    directory = cache_dir(name)
+    try:
+        names = os.listdir(directory) if directory else []
+    except OSError:
+        names = []
+    result = []
+    for filename in names:
+        match = ENTRY.match(filename)
+        if match is not None:
+            result.append((int(match.group(1)), match.group(2) or None,
+                           match.group(3), os.path.join(directory, filename)))
+    return sorted(result, key=lambda entry: (entry[0], entry[3]),
+                  reverse=True)
+
+
+def checksum(filename):
+    """Get SHA-256 digest of file.
+
+    :param filename: filename
+    :type filename: str
+    :returns: hex digest
+    :rtype: str
+    :raises ValueError: if file cannot be read
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as state:
+            for data in iter(lambda: state.read(CHUNK_SIZE), b''):
+                digest.update(data)
+    except IOError as err:
+        raise ValueError(err)
+    return digest.hexdigest()
+
+
+def temp_copy(source, directory):
+    """Copy file to a temporary file, getting its digest.
+
+    :param source: source filename
+    :type source: str
+    :param directory: directory for temporary file
+    :type directory: str
+    :returns: temporary filename and SHA-256 hex digest of the copy
+    :rtype: tuple(str, str)
+    :raises ValueError: if file cannot be copied
+    """
+    digest = hashlib.sha256()
+    try:
+        (temp_fd, temp_name) = tempfile.mkstemp(dir=directory or os.curdir)
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                with open(source, 'rb') as state:
+                    for data in iter(lambda: state.read(CHUNK_SIZE), b''):
+                        digest.update(data)
+                        temp_file.write(data)
+        except (IOError, OSError):
+            os.remove(temp_name)
+            raise
+    except (IOError, OSError) as err:
+        raise ValueError(err)
+    return (temp_name, digest.hexdigest())
+
+
+def is_cached(name, statefile):
+    """Check if state file is the same as the cached copy of its version.
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :param statefile: state filename
+    :type statefile: str
+    :returns: True if state is in cache
+    :rtype: bool
+    """
+    try:
+        (lineage, serial) = file_version(statefile)
+        digests = [entry[2] for entry in entries(name)
+                   if entry[:2] == (serial, lineage)]
+        return bool(digests) and checksum(statefile) in digests
+    except ValueError:
+        return False
+
+
+def save(name, statefile):
+    """Save copy of state file in cache, keeping the newest CACHE_KEEP.
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :param statefile: state filename
+    :type statefile: str
+    :returns: cache entry filename (None if the cache is disabled, or the
+              state lineage cannot be used in a filename)
+    :rtype: str
+    :raises ValueError: if state cannot be read or cache cannot be written
+    """
+    directory = cache_dir(name)
+    (lineage, serial) = file_version(statefile)
+    if directory is None or not SAFE_LINEAGE.match(lineage or ''):
+        return None
+    try:
+        os.makedirs(directory, 0o700)  # state may have secrets
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise ValueError(err)
+    (temp_name, digest) = temp_copy(statefile, directory)
+    entry = os.path.join(directory, '{0}_{1}_{2}.tfstate'.format(
+        serial, lineage or '', digest))
+    try:
+        os.rename(temp_name, entry)
+        for old in entries(name)[CACHE_KEEP:]:
+            if old[3] != entry:
+                os.remove(old[3])
+    except OSError as err:
+        raise ValueError(err)
+    return entry
+
+
+def restore(name, state_version, statefile):
+    """Restore cached copy of state version (if its checksum is correct).
+
+    :param name: remote name (ORG/DEPLOY)
+    :type name: str
+    :param state_version: lineage and serial
+    :type state_version: tuple(str, int)
+    :param statefile: state filename to write
+    :type statefile: str
+    :returns: cache entry filename (None if not cached)
+    :rtype: str
+    :raises ValueError: if state file cannot be written
+    """
+    (lineage, serial) = state_version
+    for entry in entries(name):
+        if entry[:2] != (serial, lineage):
+            continue
+        try:
+            if not os.path.isdir(os.path.dirname(statefile) or os.curdir):
+                os.makedirs(os.path.dirname(statefile))
+            (temp_name, digest) = temp_copy(entry[3],
+                                            os.path.dirname(statefile))
+            if digest == entry[2]:
+                os.rename(temp_name, statefile)
+                return entry[3]
+            print("state cache: bad checksum for '{0}'".format(entry[3]),
+                  file=sys.stderr)
+            os.remove(temp_name)
+            os.remove(entry[3])
+        except OSError as err:
+            raise ValueError(err)
+    return None
+
+
+def main():
+    """List cached state versions.
+
+    :returns: Exit code
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='List cached versions of Atlas remote state.'
+    )
+    parser.add_argument('names', nargs='+', metavar='NAME',
+                        help='remote name (ORG/DEPLOY)')
+    parser.add_argument('-c', '--check', dest='check', action='store_true',
+                        help='check checksums of cached copies')
+    args = parser.parse_args()
+
+    status = 0
+    for name in args.names:
+        for (serial, lineage, digest, filename) in entries(name):
+            result = ''
+            if args.check:
+                try:
+                    result = ('ok' if checksum(filename) == digest else
+                              'BAD')
+                except ValueError as err:
+                    result = str(err)
+                if result != 'ok':
+                    status = 1
+            print('{0}\t{1}\t{2}\t{3}\t{4}'.format(
+                name, serial, lineage or '-', os.path.getsize(filename),
+                result).rstrip())
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Index resources in a Terraform state file and query the index.
+
+The state file (DEPLOY/terraform.tfstate) is memory-mapped and scanned with
+the getremote tokenizer; only modules[].resources are descended into, and
+only far enough to find each resource's type and primary ID (attributes are
+skipped without decoding them). The index maps each resource address, type,
+module path and primary ID to the byte offset and length of the resource in
+the state file, and is saved next to the state file (see INDEX_SUFFIX), to
+be rebuilt only when the state file changes.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import fnmatch
+import json
+import mmap
+import os
+import re
+import sys
+
+import getremote
+
+STATE_NAME = str('terraform.tfstate')
+
+# Index file is the state filename with this suffix
+INDEX_SUFFIX = str('.index')
+
+# Included in index, so that changes in index format force a rebuild
+INDEX_VERSION = 1
+
+# Index entry fields
+ADDRESS, TYPE, MODULE, ID, OFFSET, LENGTH = range(6)
+
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"'.encode())
+NESTED = re.compile(getremote.NESTED.pattern.encode())
+SCALAR = re.compile(br'[^\s,:{}\[\]"]+')
+SPACE = re.compile(br'\s*')
+
+# Counted resource keys end in the index, e.g. 'aws_instance.web.1'
+COUNT_INDEX = re.compile(r'\.([0-9]+)$')
+
+
+def scan_error(pos, expected):
+    """Make exception for unexpected state file content.
+
+    :param pos: byte offset in state file
+    :type pos: int
+    :param expected: description of expected content
+    :type expected: str
+    :returns: exception to raise
+    :rtype: ValueError
+    """
+    return ValueError('Unknown format in Terraform state at byte {0} '
+                      '(expected {1})'.format(pos, expected))
+
+
+def decode_string(raw):
+    """Decode a JSON string (quickly, if there are no escapes in it).
+
+    :param raw: JSON string including quotes
+    :type raw: bytes
+    :returns: decoded string
+    :rtype: str
+    """
+    if b'\\' in raw:
+        return json.loads(raw.decode('utf-8'))
+    return raw[1:-1].decode('utf-8')
+
+
+def skip_value(image, pos):
+    """Skip over a JSON value without decoding it.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of value
+    :type pos: int
+    :returns: offset after value
+    :rtype: int
+    :raises ValueError: if value is not valid
+    """
+    char = image[pos:pos + 1]
+    if char == b'"':
+        match = STRING.match(image, pos)
+        if match is None:
+            raise scan_error(pos, 'string')
+        return match.end()
+
+    if char not in (b'{', b'['):
+        match = SCALAR.match(image, pos)
+        if match is None:
+            raise scan_error(pos, 'value')
+        return match.end()
+
+    depth = 0
+    while True:
+        char = image[pos:pos + 1]
+        if char in (b'{', b'['):
+            depth += 1
+        elif char in (b'}', b']'):
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        else:  # end of file or unterminated string
+            raise scan_error(pos, 'end of object or array')
+        pos = NESTED.match(image, pos + 1).end()
+
+
+def next_member(image, pos, first=False):
+    """Find the next member of a JSON object.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset after '{' or after previous member value
+    :type pos: int
+    :param first: True for first member (no ',' separator)
+    :type first: bool
+    :returns: member key (None after last member) and offset of its value
+              (offset after '}' after last member)
+    :rtype: tuple(str, int)
+    :raises ValueError: if object is not valid
+    """
+    pos = SPACE.match(image, pos).end()
+    if image[pos:pos + 1] == b'}':
+        return None, pos + 1
+    if not first:
+        if image[pos:pos + 1] != b',':
+            raise scan_error(pos, "',' or '}'")
+        pos = SPACE.match(image, pos + 1).end()
+    match = STRING.match(image, pos)
+    if match is None:
+        raise scan_error(pos, 'member name')
+    key = decode_string(match.group())
+    pos = SPACE.match(image, match.end()).end()
+    if image[pos:pos + 1] != b':':
+        raise scan_error(pos, "':'")
+    return key, SPACE.match(image, pos + 1).end()
+
+
+def next_element(image, pos, first=False):
+    """Find the next element of a JSON array.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset after '[' or after previous element
+    :type pos: int
+    :param first: True for first element (no ',' separator)
+    :type first: bool
+    :returns: offset of next element, or None after last element, and offset
+              (after ']' after last element)
+    :rtype: tuple(int, int)
+    :raises ValueError: if array is not valid
+    """
+    pos = SPACE.match(image, pos).end()
+    if image[pos:pos + 1] == b']':
+        return None, pos + 1
+    if not first:
+        if image[pos:pos + 1] != b',':
+            raise scan_error(pos, "',' or ']'")
+        pos = SPACE.match(image, pos + 1).end()
+    return pos, pos
+
+
+def enter(image, pos, char):
+    """Enter a JSON object or array.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of value
+    :type pos: int
+    :param char: b'{' or b'['
+    :type char: bytes
+    :returns: offset after char
+    :rtype: int
+    :raises ValueError: if value is not an object or array
+    """
+    pos = SPACE.match(image, pos).end()
+    if image[pos:pos + 1] != char:
+        raise scan_error(pos, "'{0}'".format(char.decode()))
+    return pos + 1
+
+
+def members(image, pos, wanted):
+    """Decode only wanted members of a JSON object.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of object
+    :type pos: int
+    :param wanted: member keys to decode, mapped to functions that decode
+                   them (called with image and offset, returning value and
+                   end offset)
+    :type wanted: dict
+    :returns: wanted member values found, and offset after object
+    :rtype: tuple(dict, int)
+    """
+    found = {}
+    (key, pos) = next_member(image, enter(image, pos, b'{'), True)
+    while key is not None:
+        if key in wanted:
+            (found[key], pos) = wanted[key](image, pos)
+        else:
+            pos = skip_value(image, pos)
+        (key, pos) = next_member(image, pos)
+    return found, pos
+
+
+def decode_value(image, pos):
+    """Decode a (small) JSON value.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of value
+    :type pos: int
+    :returns: decoded value and offset after it
+    :rtype: tuple(object, int)
+    """
+    end = skip_value(image, pos)
+    if image[pos:pos + 1] == b'"':
+        return decode_string(image[pos:end]), end
+    return json.loads(image[pos:end].decode('utf-8')), end
+
+
+def resource_address(module, key):
+    """Make Terraform resource address (as used for -target).
+
+    :param module: module path (without 'root'), e.g. ['a', 'b']
+    :type module: list(str)
+    :param key: resource key in state, e.g. 'aws_instance.web.1'
+    :type key: str
+    :returns: resource address e.g. 'module.a.module.b.aws_instance.web[1]'
+    :rtype: str
+    """
+    if key.count('.') > (2 if key.startswith('data.') else 1):
+        key = COUNT_INDEX.sub(r'[\1]', key)
+    return ''.join('module.' + name + '.' for name in module) + key
+
+
+def index_resources(image, pos, module, entries):
+    """Index the resources of a module.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of module 'resources' object
+    :type pos: int
+    :param module: module path (without 'root')
+    :type module: list(str)
+    :param entries: index entries to extend
+    :type entries: list
+    :returns: offset after resources object
+    :rtype: int
+    """
+    primary = {'id': decode_value}
+    resource = {
+        'type': decode_value,
+        'primary': lambda image, pos: members(image, pos, primary)
+    }
+    (key, pos) = next_member(image, enter(image, pos, b'{'), True)
+    while key is not None:
+        (found, end) = members(image, pos, resource)
+        entries.append([
+            resource_address(module, key),
+            found.get('type') or COUNT_INDEX.sub('', key).split('.')[-2],
+            '.'.join(module),
+            (found.get('primary') or {}).get('id'),
+            pos,
+            end - pos
+        ])
+        (key, pos) = next_member(image, end)
+    return pos
+
+
+def index_module(image, pos, entries):
+    """Index a module in the state 'modules' array.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :param pos: offset of module object
+    :type pos: int
+    :param entries: index entries to extend
+    :type entries: list
+    :returns: offset after module object
+    :rtype: int
+    """
+    (key, pos) = next_member(image, enter(image, pos, b'{'), True)
+    module = None  # path without 'root'
+    resources = None
+    while key is not None:
+        if key == 'path':
+            (path, pos) = decode_value(image, pos)
+            if not isinstance(path, list):
+                raise TypeError()  # not a module path
+            module = path[1:]
+        elif key == 'resources' and module is not None:
+            pos = index_resources(image, pos, module, entries)
+        elif key == 'resources':
+            # Terraform writes path first, but JSON does not guarantee that
+            resources = pos
+            pos = skip_value(image, pos)
+        else:
+            pos = skip_value(image, pos)
+        (key, pos) = next_member(image, pos)
+    if resources is not None:
+        index_resources(image, resources, module or [], entries)
+    return pos
+
+
+def build_index(image):
+    """Build the resource index for a state file.
+
+    :param image: state file contents
+    :type image: mmap.mmap
+    :returns: state serial and lineage, and index entries
+    :rtype: tuple(int, str, list)
+    :raises ValueError: if the state file cannot be parsed
+    """
+    entries = []
+
+    def modules(image, pos):
+        """Index all modules."""
+        (element, pos) = next_element(image, enter(image, pos, b'['), True)
+        while element is not None:
+            pos = index_module(image, element, entries)
+            (element, pos) = next_element(image, pos)
+        return None, pos
+
+    (found, _) = members(image, 0, {'serial': decode_value,
+                                    'lineage': decode_value,
+                                    'modules': modules})
+    return found.get('serial'), found.get('lineage'), entries
+
+
+def index_file(statefile):
+    """Load the resource index for a state file, rebuilding it if necessary.
+
+    :param statefile: Filename for Terraform state file
+    :type statefile: str
+    :returns: index with serial, lineage and entries
+    :rtype: dict
+    :raises ValueError: if the state file is missing or cannot be parsed
+    """
+    try:
+        identity = [INDEX_VERSION] + getremote.state_identity(statefile)
+    except OSError as err:
+        raise ValueError(err)
+    try:
+        with open(statefile + INDEX_SUFFIX) as index_fp:
+            index = json.load(index_fp)
+        if index['identity'] == identity:
+            return index
+    except (OSError, IOError, ValueError, TypeError, KeyError):  # rebuild
+        pass
+
+    try:
+        with open(statefile, 'rb') as state_file:
+            if identity[3] == 0:
+                raise ValueError('Empty Terraform state')
+            image = mmap.mmap(state_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (serial, lineage, entries) = build_index(image)
+        finally:
+            image.close()
+    except (IOError, OSError) as err:
+        raise ValueError(err)
+    except (TypeError, AttributeError, IndexError):
+        raise ValueError('Unknown structure in Terraform state')
+
+    index = {'identity': identity, 'serial': serial, 'lineage': lineage,
+             'entries': entries}
+    getremote.save_json(statefile + INDEX_SUFFIX, index)
+    return index
+
+
+def module_path(module):
+    """Normalize module path, e.g. 'module.a.module.b' or 'a.b' to 'a.b'.
+
+    :param module: module path
+    :type module: str
+    :returns: module path as stored in index
+    :rtype: str
+    """
+    return re.sub(r'(^|\.)module\.', r'\1', module)
+
+
+def query(index, address=None, res_type=None, module=None, res_id=None):
+    """Find resources in index.
+
+    :param index: resource index from index_file()
+    :type index: dict
+    :param address: resource address (may include shell wildcards)
+    :type address: str
+    :param res_type: resource type, e.g. 'openstack_compute_instance_v2'
+    :type res_type: str
+    :param module: module path, e.g. 'module.x' or 'x' ('' for root module)
+    :type module: str
+    :param res_id: primary ID
+    :type res_id: str
+    :returns: index entries matching all given criteria
+    :rtype: list
+    """
+    if module is not None:
+        module = module_path(module)
+    return [
+        entry for entry in index['entries']
+        if (address is None or fnmatch.fnmatchcase(entry[ADDRESS], address))
+        and (res_type is None or entry[TYPE] == res_type)
+        and (module is None or entry[MODULE] == module)
+        and (res_id is None or entry[ID] == res_id)
+    ]
+
+
+def main():
+    """Print resources in Terraform state matching all given criteria.
+
+    :returns: Exit code (1 on error, 2 if no resources match)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Query resource index of Terraform state.'
+    )
+    parser.add_argument('-a', '--address', dest='address', default=None,
+                        help='resource address (shell wildcards allowed)')
+    parser.add_argument('-t', '--type', dest='res_type', default=None,
+                        help='resource type', metavar='TYPE')
+    parser.add_argument('-m', '--module', dest='module', default=None,
+                        help="module path ('' for root module)")
+    parser.add_argument('-i', '--id', dest='res_id', default=None,
+                        help='primary ID of resource', metavar='ID')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('-l', '--long', dest='output', action='store_const',
+                        const='long', default=None,
+                        help='print address, type and ID')
+    output.add_argument('--targets', dest='output', action='store_const',
+                        const='targets',
+                        help='print -target=ADDRESS options for terraform')
+    output.add_argument('--show', dest='output', action='store_const',
+                        const='show',
+                        help='print resources from state (as JSON)')
+    parser.add_argument('-s', '--state', dest='statefile', default=None,
+                        help='state file (default: DEPLOY/' + STATE_NAME +
+                        ')', metavar='FILE')
+    parser.add_argument('deployment', nargs='?', default=None,
+                        help='deployment (with .tfvars file)',
+                        metavar='DEPLOY')
+    args = parser.parse_args()
+    if args.statefile is None:
+        if args.deployment is None:
+            parser.error('DEPLOY or --state is required')
+        args.statefile = os.path.join(
+            re.sub(r'\.tfvars$', '', args.deployment), STATE_NAME)
+
+    try:
+        entries = query(index_file(args.statefile), args.address,
+                        args.res_type, args.module, args.res_id)
+        if args.output == 'show':
+            with open(args.statefile, 'rb') as state_file:
+                for entry in entries:
+                    state_file.seek(entry[OFFSET])
+                    print(json.dumps(
+                        {entry[ADDRESS]: json.loads(state_file.read(
+                            entry[LENGTH]).decode('utf-8'))},
+                        indent=2, sort_keys=True))
+        for entry in entries if args.output != 'show' else []:
+            if args.output == 'long':
+                print('\t'.join((entry[ADDRESS], entry[TYPE],
+                                 entry[ID] or '')))
+            elif args.output == 'targets':
+                print('-target=' + entry[ADDRESS])
+            else:
+                print(entry[ADDRESS])
+        return 0 if entries else 2
+
+    except ValueError as err:
+        if str(err).endswith("'"):
+            print(err, file=sys.stderr)
+        else:
+            print("{0}: '{1}'".format(err, args.statefile), file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
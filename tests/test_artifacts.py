@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Tests for artifacts.py store locking and expiry."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifacts  # noqa: E402 pylint: disable=C0413
+
+
+class StoreTest(unittest.TestCase):
+    """Runs are not lost to expiry, which put() does automatically."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.mkdir('test1')
+        with open('test.log', 'w') as log:
+            log.write('Plan: 1 to add\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def stamps(self):
+        """Get stamps of the index records."""
+        return [record['stamp'] for record in artifacts.read_index('test1')]
+
+    def test_put_during_collect(self):
+        artifacts.put('test1', 'plan', '20150501-000000', 0, 'test.log')
+        with artifacts.lock_store('test1'):
+            process = subprocess.Popen(
+                [sys.executable, artifacts.__file__, 'put', '--kind', 'plan',
+                 '--stamp', '20150502-000000', '--exit', '0', 'test1'],
+                close_fds=True)
+            time.sleep(0.5)  # waiting for the lock, as for a collect()
+            index = artifacts.store_path('test1', artifacts.INDEX_NAME)
+            shutil.copy(index, index + '.new')
+            os.rename(index + '.new', index)
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(self.stamps(), ['20150501-000000', '20150502-000000'])
+
+    def test_collect_on_put(self):
+        old = time.time() - (artifacts.RETENTION_DAYS + 1) * 86400
+        records = [artifacts.put('test1', 'plan', str(number), 0)
+                   for number in range(artifacts.RETENTION_KEEP + 2)]
+        with open(artifacts.store_path('test1', artifacts.INDEX_NAME),
+                  'w') as index_file:
+            for record in records:
+                record['time'] = int(old)
+                index_file.write(json.dumps(record) + '\n')
+        self.assertEqual(len(self.stamps()), artifacts.RETENTION_KEEP + 2)
+
+        # only collected again once COLLECT_INTERVAL has passed
+        artifacts.put('test1', 'apply', 'new', 0, 'test.log')
+        self.assertEqual(len(self.stamps()), artifacts.RETENTION_KEEP + 3)
+        collected = artifacts.store_path('test1', artifacts.COLLECTED_NAME)
+        os.utime(collected, (old, old))
+        artifacts.put('test1', 'apply', 'newer', 0, 'test.log')
+        self.assertEqual(self.stamps()[-3:], ['21', 'new', 'newer'])
+        self.assertEqual(len(self.stamps()), artifacts.RETENTION_KEEP)
+
+    def test_collect_profiles(self):
+        profiles = artifacts.store_path('test1', artifacts.PROFILES)
+        os.makedirs(profiles)
+        old = time.time() - (artifacts.RETENTION_DAYS + 1) * 86400
+        for number in range(5):
+            name = os.path.join(profiles, 'tfplan-{0}.prof'.format(number))
+            open(name, 'w').close()
+            os.utime(name, (old + number, old + number))
+        open(os.path.join(profiles, 'new.prof'), 'w').close()
+        open(os.path.join(profiles, 'other'), 'w').close()
+        # expired profiles are removed, but the last keep are kept
+        self.assertEqual(artifacts.collect('test1', keep=3), (0, 0, 0, 0, 3))
+        self.assertEqual(sorted(os.listdir(profiles)),
+                         ['new.prof', 'other', 'tfplan-3.prof',
+                          'tfplan-4.prof'])
+        self.assertEqual(artifacts.collect('test1', keep=0)[-1], 2)
+        self.assertEqual(sorted(os.listdir(profiles)), ['new.prof', 'other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Tests for chef-client-runlist runlists (with -n, off-instance)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# chef-client stand-in, failing for missing roles and broken recipes
+CHEF_CLIENT = """#!/bin/sh
+case $* in
+    *'role[missing'*|*'recipe[broken'*) exit 1 ;;
+esac
+"""
+
+
+class RunlistTest(unittest.TestCase):
+    """Runlists are converged once, or twice for recipes and roles."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.chef_client = os.path.join(self.tmp, 'chef-client')
+        with open(self.chef_client, 'w') as script:
+            script.write(CHEF_CLIENT)
+        os.chmod(self.chef_client, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def converges(self, instance, **meta):
+        """Get runlists converged for instance with metadata (and status)."""
+        filename = os.path.join(self.tmp, 'meta_data.json')
+        with open(filename, 'w') as meta_file:
+            json.dump({'meta': meta}, meta_file)
+        config = subprocess.check_output([
+            sys.executable, os.path.join(TOP, 'getconfig.py'), '-f', filename])
+        env = dict(os.environ)
+        env[str('CHEF_CLIENT')] = str(self.chef_client)
+        process = subprocess.Popen(
+            ['sh', os.path.join(TOP, 'chef-client-runlist'), '-n', instance],
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = process.communicate(config)[0].decode('utf-8')
+        runlists = []
+        for line in out.splitlines():
+            if line.startswith('chef-client-runlist: exit '):
+                runlists.append((line.split()[-1], int(line.split()[2])))
+        return runlists
+
+    def test_recipes_and_roles(self):
+        self.assertEqual(
+            self.converges('web1', recipes='a, b,a', roles='base,web1'),
+            [('recipe[a],recipe[b]', 0),
+             ('recipe[a],recipe[b],role[base],role[web1]', 0)])
+        self.assertEqual(
+            self.converges('web1', recipes='broken', roles='base'),
+            [('recipe[broken]', 1), ('role[base],role[web1]', 0)])
+
+    def test_single_converge(self):
+        self.assertEqual(self.converges('web1', recipes='a'),
+                         [('recipe[a],role[web1]', 0)])
+        self.assertEqual(self.converges('web1', roles='base'),
+                         [('role[base],role[web1]', 0)])
+        self.assertEqual(self.converges('web1', roles='base,,web1,base'),
+                         [('role[base],role[web1]', 0)])
+
+    def test_missing_instance_role(self):
+        self.assertEqual(self.converges('missing1', recipes='a'),
+                         [('recipe[a],role[missing1]', 1),
+                          ('recipe[a]', 0)])
+        self.assertEqual(self.converges('missing1', roles='base'),
+                         [('role[base],role[missing1]', 1),
+                          ('role[base]', 0)])
+        self.assertEqual(self.converges('missing1'),
+                         [('role[missing1]', 1), ('role[common]', 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""Tests for getconfig.py config drive reading and metadata output."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    # noinspection PyCompatibility
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    # noinspection PyCompatibility
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getconfig  # noqa: E402 pylint: disable=C0413
+
+META = {'name': 'web1', 'uuid': '1234',
+        'meta': {'name': 'web', 'roles': 'base', 'x-y': 'a', 'x_y': 'b'}}
+
+# metadata spanning several ISO blocks and many FAT clusters
+META_DATA = json.dumps({'meta': dict(('key{0}'.format(index), 'x' * 60)
+                                     for index in range(80))}).encode('utf-8')
+
+# (path component, ISO9660 name, FAT short name) down to the metadata file
+PATH = [('openstack', b'OPENSTACK', b'OPENST~1   '),
+        ('2013-10-17', b'2013_10_17', b'2013-1~1   '),
+        ('meta_data.json', b'META_DATA.JSON;1', b'META_D~1JSO')]
+
+
+def both(fmt, value):
+    """Pack an ISO9660 both-byte-order value."""
+    return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+
+def iso_record(name, extent, size, flags=0, system=b''):
+    """Make an ISO9660 directory record."""
+    record = bytearray(33 + len(name) + (1 - len(name) % 2))
+    record[2:18] = both('I', extent) + both('I', size)
+    record[25] = flags
+    record[28:32] = both('H', 1)
+    record[32] = len(name)
+    record[33:33 + len(name)] = name
+    record.extend(system)
+    record[0] = len(record)
+    return bytes(record)
+
+
+def iso_image(names='plain', block=2048):
+    """Make an ISO9660 image with plain, 'joliet' or 'rockridge' names.
+
+    The directories are in blocks 19 (root) to 21, and the metadata file
+    starts at block 24.
+    """
+    image = bytearray(block * 32)
+    for (index, (part, name, _)) in enumerate(PATH):
+        extent = 19 + index
+        system = b''
+        if names == 'joliet':
+            name = part.encode('utf-16-be')
+        elif names == 'rockridge':
+            system = (b'NM' + struct.pack('<BBB', 5 + len(part), 1, 0) +
+                      part.encode('ascii'))
+        if index + 1 < len(PATH):
+            child = iso_record(name, extent + 1, block, 2, system)
+        else:
+            child = iso_record(name, 24, len(META_DATA), 0, system)
+        root_sp = b''
+        if index == 0 and names == 'rockridge':
+            root_sp = b'SP\x07\x01\xbe\xef\x00'
+        directory = (iso_record(b'\0', extent, block, 2, root_sp) +
+                     iso_record(b'\1', max(extent - 1, 19), block, 2) +
+                     child)
+        image[extent * block:extent * block + len(directory)] = directory
+    image[24 * block:24 * block + len(META_DATA)] = META_DATA
+
+    descriptors = [(1, b'')]
+    if names == 'joliet':
+        descriptors.insert(0, (2, b'%/E'))  # (shares the Joliet tree)
+    for (index, (vd_type, escape)) in enumerate(descriptors + [(255, b'')]):
+        offset = (16 + index) * block
+        image[offset:offset + 7] = struct.pack('<B', vd_type) + b'CD001\1'
+        image[offset + 88:offset + 88 + len(escape)] = escape
+        image[offset + 128:offset + 132] = both('H', block)
+        image[offset + 156:offset + 190] = iso_record(b'\0', 19, block, 2)
+    return bytes(image)
+
+
+def fat_image(bits, cluster_size=512):
+    """Make a FAT12/16/32 image with VFAT names and scattered clusters."""
+    (sector, fats) = (512, 2)
+    clusters = {12: 1000, 16: 5000, 32: 70000}[bits]
+    (reserved, root_entries) = (32, 0) if bits == 32 else (1, 512)
+    fat_size = -(-(clusters + 2) * bits // 8 // sector) + 1
+    fat = reserved * sector
+    data = (reserved + fats * fat_size) * sector + root_entries * 32
+    total = data // sector + clusters * cluster_size // sector
+    image = bytearray(total * sector)
+    free = random.Random(bits).sample(range(2, 200), 198)
+
+    def set_fat(cluster, value):
+        """Set the FAT entry for cluster."""
+        if bits == 12:
+            offset = fat + cluster * 3 // 2
+            word = struct.unpack_from('<H', bytes(image), offset)[0]
+            if cluster & 1:
+                word = word & 0x000f | value << 4
+            else:
+                word = word & 0xf000 | value
+            struct.pack_into('<H', image, offset, word)
+        else:
+            struct.pack_into('<H' if bits == 16 else '<I', image,
+                             fat + cluster * bits // 8, value)
+
+    def write_chain(contents):
+        """Write contents in a new chain of clusters, returning the first."""
+        chain = [free.pop() for _ in range(
+            max(1, -(-len(contents) // cluster_size)))]
+        for (index, cluster) in enumerate(chain):
+            start = data + (cluster - 2) * cluster_size
+            image[start:start + cluster_size] = contents[
+                index * cluster_size:(index + 1) * cluster_size].ljust(
+                    cluster_size, b'\0')
+            set_fat(cluster, chain[index + 1] if index + 1 < len(chain)
+                    else (1 << min(bits, 28)) - 1)
+        return chain[0]
+
+    def entries(name, short, cluster, size, attr):
+        """Make VFAT long name entries and the short name entry."""
+        checksum = 0
+        for char in bytearray(short):
+            checksum = ((checksum >> 1) + ((checksum & 1) << 7) + char) & 255
+        chars = (name.encode('utf-16-le') + b'\0\0').ljust(
+            -(-(len(name) + 1) // 13) * 26, b'\xff')
+        result = b''
+        for index in range(len(chars) // 26):
+            part = chars[index * 26:(index + 1) * 26]
+            entry = bytearray(32)
+            entry[0] = index + 1 + (0x40 if (index + 1) * 26 == len(chars)
+                                    else 0)
+            (entry[1:11], entry[14:26], entry[28:32]) = (
+                part[0:10], part[10:22], part[22:26])
+            (entry[11], entry[13]) = (0x0f, checksum)
+            result = bytes(entry) + result
+        entry = bytearray(32)
+        (entry[0:11], entry[11]) = (short, attr)
+        struct.pack_into('<H4xHI', entry, 20, cluster >> 16, cluster & 0xffff,
+                         size)
+        return result + bytes(entry)
+
+    cluster = write_chain(META_DATA)
+    listing = entries(PATH[-1][0], PATH[-1][2], cluster, len(META_DATA), 0x20)
+    for (part, _, short) in reversed(PATH[:-1]):
+        cluster = write_chain(entries('.', b'.          ', 0, 0, 0x10)[-32:] +
+                              listing)
+        listing = entries(part, short, cluster, 0, 0x10)
+    listing = (b'CONFIG-2   ' + b'\x08' + b'\0' * 20) + listing
+    if bits == 32:
+        root_cluster = write_chain(listing)
+    else:
+        root = (reserved + fats * fat_size) * sector
+        image[root:root + len(listing)] = listing
+
+    struct.pack_into('<HBHBHHxH', image, 11, sector,
+                     cluster_size // sector, reserved, fats, root_entries,
+                     total if total < 0x10000 else 0,
+                     0 if bits == 32 else fat_size)
+    struct.pack_into('<I', image, 32, total if total >= 0x10000 else 0)
+    if bits == 32:
+        struct.pack_into('<II', image, 36, fat_size, 0)
+        struct.pack_into('<I', image, 44, root_cluster)
+    image[510:512] = b'\x55\xaa'
+    image[fat + fat_size * sector:fat + 2 * fat_size * sector] = image[
+        fat:fat + fat_size * sector]
+    return bytes(image)
+
+
+class OutputTest(unittest.TestCase):
+    """KEYs are output in each format without silently lost values."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'meta_data.json')
+        with open(self.filename, 'w') as meta_data:
+            json.dump(META, meta_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def getconfig(self, *args):
+        """Run getconfig.py -f FILE ARGS, returning (exit code, stdout)."""
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen([sys.executable, getconfig.__file__,
+                                     '-f', self.filename] + list(args),
+                                    stdout=subprocess.PIPE, stderr=devnull)
+        out = proc.communicate()[0].decode('utf-8')
+        return (proc.returncode, out)
+
+    def test_outformat(self):
+        self.assertEqual(getconfig.outformat('a', "it's"), r"a='it'\''s'")
+        self.assertEqual(getconfig.outformat('a', 'x"$', getconfig.ENV),
+                         r'a="x\"\$"')
+
+    def test_json_nested(self):
+        (code, out) = self.getconfig('-F', 'json', 'meta', 'name', 'name')
+        self.assertEqual(code, 0)
+        self.assertEqual(json.loads(out),
+                         {'meta': META['meta'], 'name': 'web1'})
+        (code, out) = self.getconfig('-F', 'json', 'meta.roles')
+        self.assertEqual(json.loads(out), {'roles': 'base'})
+
+    def test_collision(self):
+        self.assertEqual(self.getconfig('meta.roles', 'uuid'),
+                         (0, "roles='base'\nuuid='1234'\n"))
+        self.assertEqual(self.getconfig('meta.name', 'name')[0], 1)
+        self.assertEqual(self.getconfig('-F', 'env', 'meta.x-y',
+                                        'meta.x_y')[0], 1)
+        self.assertEqual(self.getconfig('-F', 'json', 'meta.name',
+                                        'name'),
+                         (0, '{"meta.name": "web", "name": "web1"}\n'))
+
+    def test_legacy_file(self):
+        drive = os.path.join(self.tmp, 'drive')
+        os.makedirs(os.path.dirname(os.path.join(drive, getconfig.META_NAME)))
+        shutil.copy(self.filename, os.path.join(drive, getconfig.META_NAME))
+        with open(os.path.join(self.tmp, 'name'), 'w') as meta_data:
+            json.dump({'name': 'other', 'uuid': '5678'}, meta_data)
+        env = dict(os.environ)
+        env.update({str(getconfig.DRIVE_ENV): str(drive),
+                    str(getconfig.URL_ENV): str(''),
+                    str(getconfig.CACHE_ENV): str('')})
+
+        def run(*args):
+            """Run getconfig.py ARGS in the temporary directory."""
+            proc = subprocess.Popen([sys.executable, getconfig.__file__] +
+                                    list(args), cwd=self.tmp, env=env,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            (out, err) = proc.communicate()
+            return (proc.returncode, out.decode('utf-8'), err.decode('utf-8'))
+
+        # two KEYs, even with a file named like the first one
+        self.assertEqual(run('name', 'uuid'),
+                         (0, "name='web1'\nuuid='1234'\n", ''))
+        self.assertEqual(run('./name', 'uuid'), (0, "uuid='5678'\n", ''))
+        (code, _, err) = run('meta_data.json', 'uuid')
+        self.assertEqual(code, 1)
+        self.assertIn("-f meta_data.json", err)
+
+
+class ImageTestCase(unittest.TestCase):
+    """Config drive image (with mounting recorded, and no metadata cache)."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.drive = os.path.join(self.tmp, 'config-2.img')
+        self.environ = os.environ.get(getconfig.CACHE_ENV)
+        os.environ[getconfig.CACHE_ENV] = ''
+        self.mount_metadata = getconfig.mount_metadata
+        self.mounted = []
+        getconfig.mount_metadata = lambda drive: self.mounted.append(drive) or {}
+
+    def tearDown(self):
+        getconfig.mount_metadata = self.mount_metadata
+        if self.environ is None:
+            del os.environ[getconfig.CACHE_ENV]
+        else:
+            os.environ[getconfig.CACHE_ENV] = self.environ
+        shutil.rmtree(self.tmp)
+
+    def write(self, image):
+        """Write the config drive image."""
+        with open(self.drive, 'wb') as drive:
+            drive.write(image)
+
+
+class DriveTest(ImageTestCase):
+    """Config drive images are read directly, or else mounted."""
+
+    def test_iso9660(self):
+        for names in ('plain', 'joliet', 'rockridge'):
+            self.write(iso_image(names))
+            self.assertEqual(getconfig.read_drive(self.drive), META_DATA,
+                             names)
+
+    def test_fat(self):
+        for bits in (12, 16, 32):
+            self.write(fat_image(bits))
+            self.assertEqual(getconfig.read_drive(self.drive), META_DATA,
+                             'FAT{0}'.format(bits))
+        self.assertEqual(getconfig.drive_metadata(self.drive),
+                         json.loads(META_DATA.decode('utf-8')))
+        self.assertEqual(self.mounted, [])
+
+    def test_mount_fallback(self):
+        self.write(fat_image(12).replace(META_DATA[:20], b'{' * 20))
+        self.assertEqual(getconfig.drive_metadata(self.drive), {})
+        self.write(b'\0' * 4096)
+        self.assertEqual(getconfig.drive_metadata(self.drive), {})
+        self.assertEqual(self.mounted, [self.drive, self.drive])
+
+
+class CacheTest(ImageTestCase):
+    """Parsed metadata is cached by drive identity (in a private directory)."""
+
+    def setUp(self):
+        ImageTestCase.setUp(self)
+        self.cache = os.path.join(self.tmp, 'cache')
+        os.environ[getconfig.CACHE_ENV] = self.cache
+        self.read_drive = getconfig.read_drive
+        self.reads = []
+        getconfig.read_drive = lambda drive: (self.reads.append(drive) or
+                                              self.read_drive(drive))
+        self.write(fat_image(16))
+        self.meta = json.loads(META_DATA.decode('utf-8'))
+
+    def tearDown(self):
+        getconfig.read_drive = self.read_drive
+        ImageTestCase.tearDown(self)
+
+    def drives(self, count):
+        """Make copies of the config drive image."""
+        drives = []
+        for index in range(count):
+            drives.append(os.path.join(self.tmp, 'drive{0}.img'.format(index)))
+            shutil.copy(self.drive, drives[-1])
+        return drives
+
+    def entry(self, drive):
+        """Get cache entry for drive."""
+        return os.path.join(self.cache, hashlib.sha256(json.dumps(
+            getconfig.drive_identity(drive)).encode()).hexdigest() + '.json')
+
+    def test_hit(self):
+        for _ in range(2):
+            self.assertEqual(getconfig.drive_metadata(self.drive), self.meta)
+        self.assertEqual(self.reads, [self.drive])
+        self.assertEqual(os.listdir(self.cache),
+                         [os.path.basename(self.entry(self.drive))])
+        self.assertEqual(os.stat(self.cache).st_mode & 0o777, 0o700)
+
+    def test_identity_change(self):
+        self.assertEqual(getconfig.drive_metadata(self.drive), self.meta)
+        os.utime(self.drive, (1000, 1000))  # e.g. rewritten
+        self.assertEqual(getconfig.drive_metadata(self.drive), self.meta)
+        drive = self.drives(1)[0]
+        self.assertEqual(getconfig.drive_metadata(drive), self.meta)
+        self.assertEqual(self.reads, [self.drive, self.drive, drive])
+
+    def test_evict(self):
+        drives = self.drives(getconfig.CACHE_ENTRIES + 1)
+        for (index, drive) in enumerate(drives[:-1]):
+            getconfig.drive_metadata(drive)
+            os.utime(self.entry(drive), (index, index))
+        getconfig.drive_metadata(drives[0])  # hit, now most recently used
+        getconfig.drive_metadata(drives[-1])
+        self.assertEqual(len(os.listdir(self.cache)), getconfig.CACHE_ENTRIES)
+        self.assertFalse(os.path.exists(self.entry(drives[1])))
+        del self.reads[:]
+        getconfig.drive_metadata(drives[0])
+        getconfig.drive_metadata(drives[1])
+        self.assertEqual(self.reads, [drives[1]])
+
+    def test_not_private(self):
+        os.mkdir(self.cache, 0o700)
+        os.chmod(self.cache, 0o750)
+        self.assertIsNone(getconfig.cache_dir())
+        self.assertEqual(getconfig.drive_metadata(self.drive), self.meta)
+        self.assertEqual(os.listdir(self.cache), [])
+        os.chmod(self.cache, 0o700)
+        self.assertEqual(getconfig.cache_dir(), self.cache)
+        if os.getuid() == 0:  # owned by another user
+            os.chown(self.cache, 1, -1)
+            self.assertIsNone(getconfig.cache_dir())
+            self.assertEqual(getconfig.drive_metadata(self.drive), self.meta)
+            self.assertEqual(os.listdir(self.cache), [])
+            self.assertEqual(self.reads, [self.drive, self.drive])
+
+
+class MetadataServer(ThreadingMixIn, HTTPServer):
+    """Metadata service stand-in (status and delay can be changed)."""
+
+    daemon_threads = True
+    status = 200
+    delay = 0
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    """Serve META_DATA (or the server status) for META_NAME."""
+
+    protocol_version = str('HTTP/1.1')
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Send metadata response."""
+        time.sleep(self.server.delay)
+        status = self.server.status
+        if self.path != '/' + '/'.join(getconfig.META_NAME.split(os.sep)):
+            status = 404
+        body = META_DATA if status == 200 else b'Not Found'
+        self.send_response(status)
+        self.send_header(str('Content-Length'), str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.served.set()
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        """Do not log requests."""
+
+
+class MetadataTest(ImageTestCase):
+    """The first of the service or unmounted drive is used, else mounted."""
+
+    def setUp(self):
+        ImageTestCase.setUp(self)
+        getconfig.mount_metadata = self.mount
+        self.server = MetadataServer(('127.0.0.1', 0), MetadataHandler)
+        self.server.served = threading.Event()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        with getconfig.CONNECTIONS_LOCK:
+            for connection in getconfig.CONNECTIONS.values():
+                connection.close()
+            getconfig.CONNECTIONS.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        ImageTestCase.tearDown(self)
+
+    def mount(self, drive):
+        """Record mount (and whether it was in a racing thread)."""
+        self.mounted.append((drive, threading.current_thread().name))
+        return {'mounted': True}
+
+    def metadata(self):
+        """Get metadata from the drive and the stand-in service."""
+        return getconfig.metadata(drive=self.drive, url=self.url)
+
+    def test_service(self):
+        meta = json.loads(META_DATA.decode('utf-8'))
+        self.assertEqual(self.metadata(), meta)
+        self.write(b'\0' * 4096)  # would need mounting
+        self.assertEqual(self.metadata(), meta)
+        self.assertEqual(self.mounted, [])
+
+    def test_drive(self):
+        self.drive = os.path.join(self.tmp, 'config-2')
+        os.makedirs(os.path.join(self.drive,
+                                 os.path.dirname(getconfig.META_NAME)))
+        with open(os.path.join(self.drive, getconfig.META_NAME), 'w') as meta:
+            meta.write('{"meta": {"a": 1}}')
+        self.server.delay = 1
+        start = time.time()
+        self.assertEqual(self.metadata(), {'meta': {'a': 1}})
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.mounted, [])
+        self.server.served.wait(5)  # (for the abandoned service query)
+
+    def test_mount_after_race(self):
+        self.server.status = 404
+        self.write(b'\0' * 4096)
+        self.assertEqual(self.metadata(), {'mounted': True})
+        self.assertEqual(self.mounted, [(self.drive, 'MainThread')])
+
+        os.remove(self.drive)  # no drive to mount
+        self.assertRaises(ValueError, self.metadata)
+        self.assertEqual(len(self.mounted), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Tests for getremote.py state scanning and remote name cache."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getremote  # noqa: E402 pylint: disable=C0413
+
+REMOTE = {'type': 'atlas', 'config': {'name': 'example/test1'}}
+
+# modules with strings that look like structure (and a 'remote' key)
+MODULES = [{'path': ['root'], 'outputs': {'remote': '{"x": [1, ',
+                                          'quoted': 'a \\" } ] b'}}]
+
+
+def state_text(*items):
+    """Make state JSON text with keys in the given order."""
+    return '{' + ', '.join('{0}: {1}'.format(json.dumps(key),
+                                             json.dumps(value))
+                           for (key, value) in items) + '}'
+
+
+class RemoteTextTest(unittest.TestCase):
+    """The 'remote' value is found without reading the rest of the state."""
+
+    def remote_text(self, text, chunk_size=getremote.CHUNK_SIZE):
+        """Get remote_text() of state text."""
+        return getremote.remote_text(io.StringIO(text), chunk_size)
+
+    def test_remote(self):
+        for items in ([('version', 1), ('remote', REMOTE),
+                       ('modules', MODULES)],
+                      [('version', 1), ('modules', MODULES),
+                       ('remote', REMOTE)],
+                      [('remote', REMOTE)]):
+            text = state_text(*items)
+            for chunk_size in (1, 7, getremote.CHUNK_SIZE):
+                self.assertEqual(json.loads(self.remote_text(text,
+                                                             chunk_size)),
+                                 REMOTE, (items[-1][0], chunk_size))
+
+    def test_stops_reading(self):
+        text = state_text(('remote', REMOTE), ('modules', MODULES))
+        # the rest of the state is not even valid JSON
+        self.assertEqual(json.loads(self.remote_text(text[:-20] + '"', 1)),
+                         REMOTE)
+
+    def test_no_remote(self):
+        self.assertIsNone(self.remote_text(state_text(('version', 1),
+                                                      ('modules', MODULES))))
+        self.assertIsNone(self.remote_text('{}'))
+        self.assertIsNone(json.loads(self.remote_text(
+            state_text(('remote', None)))))
+
+    def test_errors(self):
+        self.assertRaises(TypeError, self.remote_text, '[]')
+        self.assertRaises(ValueError, self.remote_text,
+                          state_text(('version', 1), ('modules', MODULES))[:-1])
+
+
+class NameTest(unittest.TestCase):
+    """Remote names are cached until the state changes."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.statefile = os.path.join(self.tmp, 'terraform.tfstate')
+        self.cache = self.statefile + getremote.CACHE_SUFFIX
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, remote_name, mtime=1000):
+        """Write state with remote name (None for local state)."""
+        items = [('version', 1), ('modules', MODULES)]
+        if remote_name is not None:
+            items.insert(1, ('remote', {'type': 'atlas',
+                                        'config': {'name': remote_name}}))
+        with open(self.statefile, 'w') as statefile:
+            statefile.write(state_text(*items))
+        os.utime(self.statefile, (mtime, mtime))
+
+    def test_cache(self):
+        self.write('example/test1')
+        self.assertEqual(getremote.name(self.statefile), 'example/test1')
+        with open(self.cache) as cache_file:
+            (identity, remote_name) = json.load(cache_file)
+        self.assertEqual(remote_name, 'example/test1')
+
+        # same identity: cached name is used without reading the state
+        with open(self.cache, 'w') as cache_file:
+            json.dump([identity, 'example/cached'], cache_file)
+        self.assertEqual(getremote.name(self.statefile), 'example/cached')
+
+        # changed state (same size, new mtime): read again
+        self.write('example/test2', 2000)
+        self.assertEqual(getremote.name(self.statefile), 'example/test2')
+        self.write(None, 3000)
+        for _ in range(2):  # local state is cached too
+            self.assertIsNone(getremote.name(self.statefile))
+
+    def test_saved_remote_state(self):
+        # tfremote config saves remote state as STATEFILE.remote
+        saved = self.statefile + '.remote'
+        with open(saved, 'w') as saved_file:
+            saved_file.write('saved state\n')
+        self.write('example/test1')
+        self.assertEqual(getremote.name(self.statefile), 'example/test1')
+        with open(saved) as saved_file:
+            self.assertEqual(saved_file.read(), 'saved state\n')
+
+    def test_errors(self):
+        self.assertRaises(ValueError, getremote.name, self.statefile)
+        self.write('not-a-name')
+        self.assertRaises(ValueError, getremote.name, self.statefile)
+        self.assertFalse(os.path.exists(self.cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Tests for modcache.py (with local git repositories as module sources)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modcache  # noqa: E402 pylint: disable=C0413
+
+GIT_USER = ['-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+
+class ModuleCacheTest(unittest.TestCase):
+    """Git modules are linked from the cache, fetching only new commits."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict((name, os.environ.get(name)) for name in
+                            (modcache.CACHE_ENV, modcache.SIZE_ENV,
+                             modcache.LINK_ENV))
+        os.environ[modcache.CACHE_ENV] = os.path.join(self.tmp, 'cache')
+        os.environ.pop(modcache.SIZE_ENV, None)
+        os.environ.pop(modcache.LINK_ENV, None)
+        # lib: a module; vpc: a module using lib from its local submodule
+        self.lib = self.repo('lib', {'main.tf': 'variable "lib" {}\n'})
+        self.lib_source = 'git::file://{0}?ref=v1'.format(self.lib)
+        self.vpc = self.repo('vpc', {
+            'main.tf': 'module "local" {\n  source = "./sub"\n}\n',
+            'sub/main.tf': 'module "inner" {{\n  source = "{0}"\n}}\n'.format(
+                self.lib_source)})
+
+    def tearDown(self):
+        for (name, value) in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.tmp)
+
+    def git(self, repo, *args):
+        """Run git command in repository, returning its output."""
+        return subprocess.check_output(
+            ['git', '-C', repo] + GIT_USER + list(args)).decode('utf-8')
+
+    def commit(self, repo, files, tag=None):
+        """Write files and commit them (tagged), returning the commit ID."""
+        for (name, text) in files.items():
+            filename = os.path.join(repo, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as tf_file:
+                tf_file.write(text)
+        self.git(repo, 'add', '.')
+        self.git(repo, 'commit', '-q', '-m', 'test')
+        if tag is not None:
+            self.git(repo, 'tag', '-a', '-m', tag, tag)
+        return self.git(repo, 'rev-parse', 'HEAD').strip()
+
+    def repo(self, name, files):
+        """Make module repository with files (tagged v1)."""
+        repo = os.path.join(self.tmp, name)
+        os.mkdir(repo)
+        self.git(repo, 'init', '-q')
+        self.commit(repo, files, 'v1')
+        return repo
+
+    def config(self, name, **sources):
+        """Make configuration directory with modules (name=source)."""
+        directory = os.path.join(self.tmp, name)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        with open(os.path.join(directory, 'main.tf'), 'w') as tf_file:
+            for module in sorted(sources):
+                tf_file.write('module "{0}" {{\n  source = "{1}"\n}}\n'.format(
+                    module, sources[module]))
+        return directory
+
+    def get(self, directory):
+        """Run modcache.py get in directory, returning (exit code, output)."""
+        process = subprocess.Popen([sys.executable, modcache.__file__, 'get'],
+                                   cwd=directory, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        out = process.communicate()[0].decode('utf-8', 'replace')
+        return (process.returncode, out)
+
+    def module_dir(self, directory, path, source):
+        """Get module directory (linked or not)."""
+        return os.path.join(directory, modcache.MODULES_DIR,
+                            modcache.module_key(path, source))
+
+    def linked(self, directory, path, source):
+        """Get linked module directory and its commit (from the marker)."""
+        target = self.module_dir(directory, path, source)
+        with open(target + modcache.MARKER) as marker:
+            return (target, marker.read().strip())
+
+    def counters(self):
+        """Get counters of the cache statistics."""
+        result = modcache.stats()
+        return dict((counter, result[counter])
+                    for counter in modcache.COUNTERS)
+
+    def test_tag(self):
+        commit = self.git(self.vpc, 'rev-parse', 'v1^{commit}').strip()
+        source = 'git::file://{0}?ref=v1'.format(self.vpc)
+        config = self.config('config', vpc=source)
+        (status, out) = self.get(config)
+        self.assertEqual(status, 0, out)
+        (target, linked) = self.linked(config, ['vpc'], source)
+        self.assertEqual(linked, commit)
+        self.assertTrue(os.path.isfile(os.path.join(target, 'sub', 'main.tf')))
+        self.assertEqual(self.counters(), {'hits': 0, 'fetches': 2,
+                                           'checks': 2, 'evictions': 0})
+
+        # tags resolved before are used without contacting the source
+        os.rename(self.vpc, self.vpc + '.moved')
+        os.rename(self.lib, self.lib + '.moved')
+        other = self.config('other', vpc=source)
+        (status, out) = self.get(other)
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.linked(other, ['vpc'], source)[1], commit)
+        self.assertEqual(self.counters(), {'hits': 2, 'fetches': 2,
+                                           'checks': 2, 'evictions': 0})
+
+    def test_branch_move(self):
+        self.git(self.vpc, 'checkout', '-q', '-b', 'dev')
+        source = 'git::file://{0}?ref=dev'.format(self.vpc)
+        head = 'git::file://{0}'.format(self.vpc)
+        config = self.config('config', vpc=source, head=head)
+        first = self.git(self.vpc, 'rev-parse', 'HEAD').strip()
+        self.assertEqual(self.get(config)[0], 0)
+        self.assertEqual(self.linked(config, ['vpc'], source)[1], first)
+        self.assertEqual(self.linked(config, ['head'], head)[1], first)
+        self.assertEqual(self.counters(), {'hits': 2, 'fetches': 2,
+                                           'checks': 3, 'evictions': 0})
+
+        # moving refs are checked each time, and only a new commit fetched
+        second = self.commit(self.vpc, {'main.tf': 'variable "vpc" {}\n'})
+        (status, out) = self.get(config)
+        self.assertEqual(status, 0, out)
+        (target, linked) = self.linked(config, ['vpc'], source)
+        self.assertEqual(linked, second)
+        self.assertEqual(self.linked(config, ['head'], head)[1], second)
+        with open(os.path.join(target, 'main.tf')) as tf_file:
+            self.assertEqual(tf_file.read(), 'variable "vpc" {}\n')
+        self.assertEqual(self.counters(), {'hits': 3, 'fetches': 3,
+                                           'checks': 5, 'evictions': 0})
+
+        self.assertEqual(self.get(config)[0], 0)
+        self.assertEqual(self.counters(), {'hits': 5, 'fetches': 3,
+                                           'checks': 7, 'evictions': 0})
+
+    def test_subdir(self):
+        source = 'git::file://{0}//sub?ref=v1'.format(self.vpc)
+        config = self.config('config', vpc=source)
+        (status, out) = self.get(config)
+        self.assertEqual(status, 0, out)
+        (target, _) = self.linked(config, ['vpc'], source)
+        self.assertTrue(os.path.isfile(os.path.join(target, 'sub', 'main.tf')))
+        # modules of the subdirectory (not of the repository root)
+        (inner, linked) = self.linked(config, ['vpc', 'inner'],
+                                      self.lib_source)
+        self.assertEqual(linked, self.git(self.lib, 'rev-parse',
+                                          'v1^{commit}').strip())
+        self.assertTrue(os.path.isfile(os.path.join(inner, 'main.tf')))
+        self.assertFalse(os.path.exists(self.module_dir(
+            config, ['vpc', 'local', 'inner'], self.lib_source)))
+
+    def test_nested(self):
+        source = 'git::file://{0}?ref=v1'.format(self.vpc)
+        config = self.config('config', vpc=source, lib=self.lib_source)
+        (status, out) = self.get(config)
+        self.assertEqual(status, 0, out)
+        # git module of a local module of a git module
+        (inner, linked) = self.linked(config, ['vpc', 'local', 'inner'],
+                                      self.lib_source)
+        self.assertEqual(linked, self.linked(config, ['lib'],
+                                             self.lib_source)[1])
+        self.assertTrue(os.path.isfile(os.path.join(inner, 'main.tf')))
+        self.assertEqual(self.counters(), {'hits': 1, 'fetches': 2,
+                                           'checks': 2, 'evictions': 0})
+
+        # other remote sources are left to terraform get -update
+        self.config('config', vpc=source, other='example.com/module.zip')
+        self.assertEqual(self.get(config)[0], 2)
+
+    def test_eviction(self):
+        os.environ[modcache.SIZE_ENV] = '0'
+        first = self.git(self.lib, 'rev-parse', 'HEAD').strip()
+        old = self.config('old', lib=self.lib_source)
+        self.assertEqual(self.get(old)[0], 0)
+        (old_target, _) = self.linked(old, ['lib'], self.lib_source)
+
+        # trees in use are kept (even over the limit), others evicted
+        second = self.commit(self.lib, {'main.tf': 'variable "v2" {}\n'},
+                             'v2')
+        source = 'git::file://{0}?ref=v2'.format(self.lib)
+        new = self.config('new', lib=source)
+        (status, out) = self.get(new)
+        self.assertEqual(status, 0, out)
+        self.assertIn('Evicted module tree {0}'.format(first[:12]), out)
+        trees = os.path.join(os.environ[modcache.CACHE_ENV], modcache.TREES)
+        self.assertEqual(os.listdir(trees), [second])
+        self.assertEqual(self.counters()['evictions'], 1)
+        # hard links of the evicted tree are still there
+        with open(os.path.join(old_target, 'main.tf')) as tf_file:
+            self.assertEqual(tf_file.read(), 'variable "lib" {}\n')
+
+        # and an evicted tree is fetched again
+        self.assertEqual(self.get(old)[0], 0)
+        self.assertEqual(self.counters()['fetches'], 3)
+        self.assertEqual(os.listdir(trees), [first])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Tests for mount-volume (with loop devices, as root)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import unittest
+
+MOUNT_VOLUME = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'mount-volume')
+
+# mkfs wrapper, logging when each run starts and ends (and failing for the
+# device in $MKFS_FAIL)
+MKFS = """#!/bin/sh
+for DEV; do :; done
+echo "start $DEV" >> {log}
+echo "formatting $DEV"
+sleep 0.5
+if [ "$DEV" = "$MKFS_FAIL" ]; then
+    echo "mkfs failed for $DEV"
+    STATUS=1
+else
+    {mkfs} "$@"
+    STATUS=$?
+fi
+echo "end $DEV" >> {log}
+exit $STATUS
+"""
+
+
+def losetup(image):
+    """Set up loop device for image file (None if that is not possible)."""
+    if os.getuid() != 0:
+        return None
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['losetup', '-f', '--show', image],
+                stderr=devnull).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def which(command):
+    """Find command in PATH (and sbin directories)."""
+    directories = os.environ['PATH'].split(os.pathsep) + ['/sbin', '/usr/sbin']
+    for directory in directories:
+        if os.access(os.path.join(directory, command), os.X_OK):
+            return os.path.join(directory, command)
+    raise OSError('{0} not found'.format(command))
+
+
+class LoopTestCase(unittest.TestCase):
+    """Volumes are loop devices, with device nodes in a temporary dir."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.loops = []
+        # device nodes named like /dev/disk/by-path/pci-0000:00:05.0
+        self.dev = self.device('pci-0000:00:05.0')
+        self.fstab = os.path.join(self.tmp, 'fstab')
+        open(self.fstab, 'w').close()
+
+    def tearDown(self):
+        for loop in self.loops:
+            subprocess.call(['losetup', '-d', loop])
+        shutil.rmtree(self.tmp)
+
+    def device(self, name):
+        """Make block device node (for a new loop device) in temp dir."""
+        image = os.path.join(self.tmp, name + '.img')
+        with open(image, 'wb') as image_file:
+            image_file.truncate(8 * 1024 * 1024)
+        loop = losetup(image)
+        if loop is None:
+            self.skipTest('no loop device (needs root and losetup)')
+        self.loops.append(loop)
+        dev = os.path.join(self.tmp, name)
+        os.mknod(dev, stat.S_IFBLK | 0o600, os.stat(loop).st_rdev)
+        return dev
+
+    def mount_volume(self, *args, **env):
+        """Run mount-volume -n ARGS, returning (exit code, output)."""
+        env = dict(os.environ, **env)
+        env[str('FSTAB')] = str(self.fstab)
+        process = subprocess.Popen(['sh', MOUNT_VOLUME, '-n'] + list(args),
+                                   env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        out = process.communicate()[0].decode('utf-8', 'replace')
+        return (process.returncode, out)
+
+    def fstab_mountpoints(self):
+        """Get mountpoints in fstab."""
+        with open(self.fstab) as fstab:
+            return [line.split('\t')[1] for line in fstab]
+
+
+class MountVolumeTest(LoopTestCase):
+    """Device paths with ':' work in both argument forms."""
+
+    def test_two_args(self):
+        mnt = os.path.join(self.tmp, 'data')
+        (status, out) = self.mount_volume(self.dev, mnt)
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.fstab_mountpoints(), [mnt])
+        self.assertTrue(os.path.isdir(mnt))
+
+    def test_pair(self):
+        mnt = os.path.join(self.tmp, 'data')
+        (status, out) = self.mount_volume(self.dev + ':' + mnt)
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.fstab_mountpoints(), [mnt])
+
+    def test_usage(self):
+        self.assertEqual(self.mount_volume()[0], 0)
+        self.assertEqual(self.mount_volume(self.dev)[0], 1)
+        self.assertEqual(self.fstab_mountpoints(), [])
+
+
+class SeveralTest(LoopTestCase):
+    """Several volumes are formatted at once, and fstab replaced once."""
+
+    def setUp(self):
+        LoopTestCase.setUp(self)
+        self.devs = [self.dev] + [self.device('pci-0000:00:0{0}.0'.format(
+            number)) for number in (6, 7)]
+        self.mnts = [os.path.join(self.tmp, name) for name in 'abc']
+        self.pairs = [dev + ':' + mnt for (dev, mnt) in zip(self.devs,
+                                                            self.mnts)]
+        with open(self.fstab, 'w') as fstab:
+            fstab.write('/dev/vda\t/\text4\tdefaults\t0 0\n')
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.mkdir(bin_dir)
+        self.log = os.path.join(self.tmp, 'mkfs.log')
+        with open(os.path.join(bin_dir, 'mkfs'), 'w') as mkfs:
+            mkfs.write(MKFS.format(log=self.log, mkfs=which('mkfs')))
+        os.chmod(os.path.join(bin_dir, 'mkfs'), 0o755)
+        self.path = bin_dir + os.pathsep + os.environ['PATH']
+
+    def mkfs_runs(self):
+        """Get mkfs log lines."""
+        try:
+            with open(self.log) as log:
+                return log.read().splitlines()
+        except IOError:
+            return []
+
+    def fstab_lines(self):
+        """Get fstab lines."""
+        with open(self.fstab) as fstab:
+            return fstab.read().splitlines()
+
+    def test_several(self):
+        inode = os.stat(self.fstab).st_ino
+        (status, out) = self.mount_volume(*self.pairs, PATH=self.path)
+        self.assertEqual(status, 0, out)
+
+        # mkfs runs in parallel, output shown in order
+        runs = self.mkfs_runs()
+        self.assertEqual(sorted(runs[:3]),
+                         sorted('start ' + dev for dev in self.devs))
+        self.assertEqual(sorted(runs[3:]),
+                         sorted('end ' + dev for dev in self.devs))
+        self.assertEqual([out.index(dev) for dev in self.devs],
+                         sorted(out.index(dev) for dev in self.devs))
+
+        # all entries added in one replacement of fstab
+        self.assertNotEqual(os.stat(self.fstab).st_ino, inode)
+        self.assertFalse(os.path.exists(self.fstab + '.new'))
+        lines = self.fstab_lines()
+        self.assertEqual(self.fstab_mountpoints(), ['/'] + self.mnts)
+        sources = [line.split('\t')[0] for line in lines[1:]]
+        self.assertEqual(len(set(sources)), 3, lines)
+        self.assertEqual([line.split('\t')[2] for line in lines[1:]],
+                         ['ext4'] * 3)
+        for mnt in self.mnts:
+            self.assertTrue(os.path.isdir(mnt))
+
+        # formatted volumes are not formatted again
+        os.remove(self.log)
+        with open(self.fstab, 'w') as fstab:
+            fstab.write(lines[0] + '\n')
+        (status, out) = self.mount_volume(*self.pairs, PATH=self.path)
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.mkfs_runs(), [])
+        self.assertEqual(self.fstab_lines(), lines)
+
+    def test_mkfs_failed(self):
+        (status, out) = self.mount_volume(*self.pairs, PATH=self.path,
+                                          MKFS_FAIL=self.devs[1])
+        self.assertEqual(status, 1, out)
+        self.assertIn("mkfs of '{0}' failed".format(self.devs[1]), out)
+        self.assertEqual(len(self.mkfs_runs()), 6)
+        self.assertEqual(self.fstab_mountpoints(), ['/'])
+        self.assertFalse(os.path.exists(self.fstab + '.new'))
+
+    def test_checked_first(self):
+        for pairs in (self.pairs + [self.devs[0] + ':/other'],
+                      self.pairs + [self.devs[0] + 'x:' + self.mnts[0]],
+                      self.pairs + ['/nonexistent:/other'],
+                      self.pairs + ['/:/other']):
+            (status, out) = self.mount_volume(*pairs, PATH=self.path)
+            self.assertEqual(status, 1, out)
+            self.assertEqual(self.mkfs_runs(), [])
+            self.assertEqual(self.fstab_mountpoints(), ['/'])
+
+        # (an existing mountpoint)
+        with open(self.fstab, 'a') as fstab:
+            fstab.write('/dev/vdb\t{0}\text4\tdefaults\t0 0\n'.format(
+                self.mnts[2]))
+        (status, out) = self.mount_volume(*self.pairs, PATH=self.path)
+        self.assertEqual(status, 1, out)
+        self.assertIn('already present', out)
+        self.assertEqual(self.mkfs_runs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Tests for phasetime.py timing records, profiles and summaries."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import glob
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifacts  # noqa: E402 pylint: disable=C0413
+import phasetime  # noqa: E402 pylint: disable=C0413
+
+
+class TimingTestCase(unittest.TestCase):
+    """Timings (and profiles) are written in a temporary directory."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.environ = dict((name, os.environ.get(name)) for name in
+                            (phasetime.TIMINGS_ENV, phasetime.PROFILE_ENV,
+                             phasetime.COMMAND_ENV, phasetime.DEPLOYMENT_ENV))
+        for name in self.environ:
+            os.environ.pop(name, None)
+        self.timings = os.path.join('.terraform', 'timings.jsonl')
+
+    def tearDown(self):
+        for (name, value) in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        phasetime.BYTES[0] = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def records(self, filename=None):
+        """Read timing records (as written)."""
+        with open(filename or self.timings) as timings_file:
+            return [json.loads(line) for line in timings_file]
+
+
+class RecordTest(TimingTestCase):
+    """Records are appended as JSON lines, and rotated."""
+
+    def test_unset(self):
+        phasetime.record('plan', 1.0)
+        os.environ[str(phasetime.TIMINGS_ENV)] = str('')
+        phasetime.record('plan', 1.0)
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_record(self):
+        os.environ[str(phasetime.TIMINGS_ENV)] = str(self.timings)
+        phasetime.record('plan', 1.23456, 2, 1234)
+        os.environ[str(phasetime.COMMAND_ENV)] = str('tfplan')
+        os.environ[str(phasetime.DEPLOYMENT_ENV)] = str('test1')
+        phasetime.record('get', 0.5)
+        phasetime.record('get', 0.5, 1, deployment='other', command='x')
+        # one line per record, with sorted keys
+        with open(self.timings) as timings_file:
+            lines = timings_file.read().split('\n')
+        records = self.records()
+        self.assertEqual(lines, [json.dumps(timing, sort_keys=True)
+                                 for timing in records] + [''])
+        for timing in records:
+            self.assertAlmostEqual(timing.pop('time'), time.time(), delta=60)
+        self.assertEqual(records, [
+            {'command': os.path.basename(sys.argv[0]), 'phase': 'plan',
+             'deployment': None, 'duration': 1.235, 'exit': 2,
+             'bytes': 1234},
+            {'command': 'tfplan', 'phase': 'get', 'deployment': 'test1',
+             'duration': 0.5, 'exit': 0, 'bytes': None},
+            {'command': 'x', 'phase': 'get', 'deployment': 'other',
+             'duration': 0.5, 'exit': 1, 'bytes': None}])
+
+    def test_rotate(self):
+        size = phasetime.TIMINGS_SIZE
+        os.environ[str(phasetime.TIMINGS_ENV)] = str(self.timings)
+        try:
+            # records are about 115 bytes, so rotated after each 4
+            phasetime.TIMINGS_SIZE = 400
+            for number in range(10):
+                phasetime.record('phase{0}'.format(number), 1.0, command='x')
+        finally:
+            phasetime.TIMINGS_SIZE = size
+        rotated = self.records(self.timings + phasetime.ROTATED_SUFFIX)
+        current = self.records()
+        self.assertEqual([timing['phase'] for timing in rotated + current],
+                         ['phase{0}'.format(number) for number in range(4, 10)])
+        self.assertEqual(phasetime.read_timings(self.timings),
+                         rotated + current)
+
+        os.remove(self.timings)
+        self.assertEqual(phasetime.read_timings(self.timings), rotated)
+        os.remove(self.timings + phasetime.ROTATED_SUFFIX)
+        self.assertRaises(ValueError, phasetime.read_timings, self.timings)
+
+
+class MainTimedTest(TimingTestCase):
+    """Helper runs are timed, and profiled with TFTOOLS_PROFILE."""
+
+    def test_timed(self):
+        os.environ[str(phasetime.TIMINGS_ENV)] = str(self.timings)
+
+        def function():
+            """Process some bytes."""
+            phasetime.processed(10)
+            phasetime.processed(5)
+            return 2
+        self.assertEqual(phasetime.main_timed('helper', function), 2)
+        try:
+            phasetime.main_timed('helper', lambda: sys.exit('failed'))
+        except SystemExit as err:
+            self.assertEqual(err.code, 'failed')
+        self.assertEqual([(timing['phase'], timing['exit'], timing['bytes'])
+                          for timing in self.records()],
+                         [('helper', 2, 15), ('helper', 1, 15)])
+        self.assertFalse(os.path.exists(os.path.join('.terraform',
+                                                     artifacts.PROFILES)))
+
+    def test_profile(self):
+        os.environ[str(phasetime.PROFILE_ENV)] = str('1')
+
+        def function():
+            """Set deployment (as tfplan does)."""
+            os.environ[str(phasetime.DEPLOYMENT_ENV)] = str('test1')
+            return sum(range(1000))
+        self.assertEqual(phasetime.main_timed('helper', function, 'name'),
+                         sum(range(1000)))
+        profiles = glob.glob(artifacts.store_path('test1', artifacts.PROFILES,
+                                                  'name-*.prof'))
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(pstats.Stats(profiles[0]).total_calls > 0)
+        # (no timings file unless TFTOOLS_TIMINGS is set)
+        self.assertFalse(os.path.exists(self.timings))
+
+        del os.environ[str(phasetime.DEPLOYMENT_ENV)]
+        os.environ[str(phasetime.PROFILE_ENV)] = str('profiles-dir')
+        phasetime.main_timed('helper', lambda: 0)
+        self.assertEqual(len(glob.glob('profiles-dir/helper-*.prof')), 1)
+
+
+class SummaryTest(unittest.TestCase):
+    """Percentiles of durations are nearest-rank, for each phase."""
+
+    def test_percentile(self):
+        self.assertEqual(phasetime.percentile([5.0], 50), 5.0)
+        self.assertEqual(phasetime.percentile([1.0, 2.0], 50), 1.0)
+        self.assertEqual(phasetime.percentile([1.0, 2.0], 90), 2.0)
+        self.assertEqual(phasetime.percentile([1.0, 2.0, 3.0], 0), 1.0)
+
+    def test_summary(self):
+        records = [{'command': 'tfplan', 'phase': 'plan',
+                    'duration': float(101 - number),
+                    'exit': 1 if number % 10 == 0 else 2,
+                    'bytes': number} for number in range(1, 101)]
+        records.insert(1, {'command': 'tfplan', 'phase': 'get',
+                           'duration': 3.0, 'exit': 0, 'bytes': None})
+        records.append({'command': 'tfapply', 'phase': 'plan',
+                        'duration': 7.0, 'exit': 0})
+        self.assertEqual(phasetime.summary(records), [
+            {'command': 'tfplan', 'phase': 'plan', 'count': 100,
+             'failed': 10, 'p50': 50.0, 'p90': 90.0, 'p99': 99.0,
+             'max': 100.0, 'bytes': 50},
+            {'command': 'tfplan', 'phase': 'get', 'count': 1, 'failed': 0,
+             'p50': 3.0, 'p90': 3.0, 'p99': 3.0, 'max': 3.0, 'bytes': None},
+            {'command': 'tfapply', 'phase': 'plan', 'count': 1,
+             'failed': 0, 'p50': 7.0, 'p90': 7.0, 'p99': 7.0, 'max': 7.0,
+             'bytes': None}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Tests for planfingerprint.py (reuse of plans with unchanged inputs)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import planfingerprint  # noqa: E402 pylint: disable=C0413
+
+MAIN_TF = """module "net" {
+  source = "./modules/net"
+}
+
+module "remote" {
+  source = "git::https://example.com/remote.git?ref=v1"
+}
+
+data "template_file" "init" {
+  filename = "web.userdata"
+}
+"""
+
+FILES = {
+    'main.tf': MAIN_TF,
+    'common.env': 'A=1\n',
+    'dep.tfvars': 'a = "b"\n',
+    'dep.tfenv': 'B=2\n',
+    'web.userdata': 'Content-Type: multipart/mixed\n',
+    'modules/net/main.tf': 'variable "x" {}\n',
+    'modules/net/files/script.sh': 'true\n',
+}
+
+
+class FingerprintTest(unittest.TestCase):
+    """A plan is only reused while all its inputs are unchanged."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.ttl = os.environ.pop(planfingerprint.TTL_ENV, None)
+        for (name, text) in FILES.items():
+            self.write(name, text)
+        self.write_state(3, 'abc-123')
+        self.plan = os.path.join('dep', '20200101-000000.plan')
+        self.write(self.plan, 'plan')
+        os.symlink(os.path.basename(self.plan),
+                   os.path.join('dep', 'latest.plan'))
+        self.save()
+
+    def tearDown(self):
+        if self.ttl is not None:
+            os.environ[planfingerprint.TTL_ENV] = self.ttl
+        else:
+            os.environ.pop(planfingerprint.TTL_ENV, None)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text, mode='w'):
+        """Write (or append to) file."""
+        if os.path.dirname(name) and not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        with open(name, mode) as output_file:
+            output_file.write(text)
+
+    def write_state(self, serial, lineage):
+        """Write deployment state."""
+        self.write(os.path.join('dep', 'terraform.tfstate'), json.dumps(
+            {'version': 3, 'serial': serial, 'lineage': lineage,
+             'modules': [{'path': ['root'], 'resources': {}}]}))
+
+    def save(self, options=()):
+        """Write fingerprint for the plan."""
+        planfingerprint.save(self.plan, planfingerprint.fingerprint(
+            'dep', options))
+
+    def reuse(self, options=()):
+        """Check whether the plan can be reused (via latest.plan)."""
+        return planfingerprint.reuse(os.path.join('dep', 'latest.plan'),
+                                     'dep', options)
+
+    def test_files(self):
+        self.assertEqual(self.reuse(), [])
+        for name in ('main.tf', 'common.env', 'dep.tfvars', 'dep.tfenv',
+                     'web.userdata'):
+            self.write(name, '\n', 'a')
+            self.assertEqual(self.reuse(), [name])
+            self.save()
+            self.assertEqual(self.reuse(), [], name)
+
+        # new inputs
+        for name in ('other.tf', 'other.env'):
+            self.write(name, '')
+            self.assertEqual(self.reuse(), [name])
+            self.save()
+        os.remove('dep.tfenv')
+        self.assertEqual(self.reuse(), ['dep.tfenv'])
+        self.save()
+
+        # a userdata file only matters when it is referenced
+        self.write('other.userdata', '')
+        self.assertEqual(self.reuse(), [])
+        self.write('other.tf', 'data "template_file" "x" {\n'
+                   '  filename = "other.userdata"\n}\n')
+        self.save()
+        self.write('other.userdata', 'x')
+        self.assertEqual(self.reuse(), ['other.userdata'])
+
+    def test_modules(self):
+        for (name, text) in (('modules/net/main.tf', '\n'),
+                             ('modules/net/files/script.sh', 'false\n'),
+                             ('modules/net/new.tf', '')):
+            self.write(name, text, 'a')
+            self.assertEqual(self.reuse(), ['./modules/net'], name)
+            self.save()
+        os.rename('modules/net/new.tf', 'modules/net/renamed.tf')
+        self.assertEqual(self.reuse(), ['./modules/net'])
+        self.save()
+
+        # hidden files are not module inputs (and remote sources unchecked)
+        self.write('modules/net/.terraform/x', 'x')
+        self.assertEqual(self.reuse(), [])
+
+    def test_options(self):
+        for options in (['-target=a.b'], ['-destroy'],
+                        ['-target=a.b', '-target=c.d']):
+            self.assertEqual(self.reuse(options), ['options'])
+            self.save(options)
+            self.assertEqual(self.reuse(options), [])
+            self.assertEqual(self.reuse(options[::-1]), [])
+            self.assertEqual(self.reuse(options + ['-refresh=false']), [])
+            self.assertEqual(self.reuse(), ['options'])
+
+    def test_state(self):
+        self.write_state(10, 'abc-123')
+        self.assertEqual(self.reuse(), ['state'])
+        self.save()
+        self.write_state(10, 'other')
+        self.assertEqual(self.reuse(), ['state'])
+        self.save()
+        os.remove(os.path.join('dep', 'terraform.tfstate'))
+        self.assertEqual(self.reuse(), ['state'])
+
+    def test_ttl(self):
+        old = time.time() - planfingerprint.TTL_DEFAULT - 60
+        os.utime(self.plan, (old, old))
+        self.assertEqual(self.reuse(), ['plan is older than 3600 seconds'])
+        os.environ[planfingerprint.TTL_ENV] = str(
+            planfingerprint.TTL_DEFAULT + 120)
+        self.assertEqual(self.reuse(), [])
+        for ttl in ('0', '-1'):
+            os.environ[planfingerprint.TTL_ENV] = str(ttl)
+            self.assertEqual(self.reuse(), ['TFPLAN_TTL is ' + ttl])
+        os.environ[planfingerprint.TTL_ENV] = str('1h')
+        self.assertRaises(ValueError, self.reuse)
+
+    def test_missing(self):
+        os.remove(planfingerprint.fingerprint_name(self.plan))
+        self.assertEqual(self.reuse(), ['no plan fingerprint'])
+        os.remove(self.plan)
+        self.assertEqual(self.reuse(), ['no previous plan'])
+
+    def test_main(self):
+        command = [sys.executable, planfingerprint.__file__]
+        self.assertEqual(subprocess.call(
+            command + ['-w', self.plan, '-target=a.b', 'dep.tfvars']), 0)
+        process = subprocess.Popen(
+            command + ['-c', self.plan, '-target=a.b', 'dep'],
+            stderr=subprocess.PIPE)
+        self.assertEqual(process.communicate()[1], b'')
+        self.assertEqual(process.returncode, 0)
+        process = subprocess.Popen(command + ['-c', self.plan, 'dep'],
+                                   stderr=subprocess.PIPE)
+        self.assertEqual(process.communicate()[1],
+                         b'Not reusing plan: options\n')
+        self.assertEqual(process.returncode, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
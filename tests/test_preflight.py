@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Tests for preflight.py hook runs (with a stand-in pre-commit)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import preflight  # noqa: E402 pylint: disable=C0413
+
+CONFIG = """-   repo: local
+    hooks:
+    -   id: check-bad
+    -   id: check-together
+    -   id: trailing-whitespace
+    -   id: end-of-file-fixer
+"""
+
+# `pre-commit run HOOK --files FILE...` stand-in: check-bad fails for files
+# containing 'BAD', check-together fails only for several files at once, and
+# the fixers strip trailing spaces/add final newlines (runs are logged)
+PRE_COMMIT = r"""#!{python}
+import os, sys, time
+(hook, names) = (sys.argv[2], sys.argv[4:])
+open('runs', 'a').write('start ' + hook + '\n')
+time.sleep(0.1)
+status = 0
+if hook == 'check-bad':
+    status = any('BAD' in open(name).read() for name in names)
+elif hook == 'check-together':
+    status = len(names) > 1
+else:
+    for name in names:
+        text = open(name).read()
+        if hook == 'trailing-whitespace':
+            fixed = '\n'.join(line.rstrip() for line in text.split('\n'))
+        else:
+            fixed = text.rstrip('\n') + '\n'
+        if fixed != text:
+            open(name, 'w').write(fixed)
+            status = 1
+open('runs', 'a').write('end ' + hook + '\n')
+sys.exit(status)
+"""
+
+
+class HookTest(unittest.TestCase):
+    """Fixers run one at a time and fail only for the files they change."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = os.environ['PATH']
+        self.tmp = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'pre-commit'), 'w') as script:
+            script.write(PRE_COMMIT.replace('{python}', sys.executable))
+        os.chmod(os.path.join(bin_dir, 'pre-commit'), 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+        repo = os.path.join(self.tmp, 'repo')
+        os.mkdir(repo)
+        os.chdir(repo)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git', 'init', '-q'], stdout=devnull)
+        open(os.path.join('.git', 'hooks', 'pre-commit'), 'w').close()
+        files = {preflight.CONFIG: CONFIG, 'a.txt': 'ok  \nok',
+                 'b.txt': 'BAD\n', 'c.txt': 'ok\n'}
+        for (name, text) in files.items():
+            with open(name, 'w') as output:
+                output.write(text)
+        subprocess.check_call(['git', 'add'] + sorted(files))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text, add=False):
+        """Write file (and stage it)."""
+        with open(name, 'w') as output:
+            output.write(text)
+        if add:
+            subprocess.check_call(['git', 'add', name])
+
+    def read(self, name):
+        """Read file."""
+        with open(name) as input_file:
+            return input_file.read()
+
+    def runs(self):
+        """Get hook runs as (hook, start, end) log line numbers (and clear
+        the log)."""
+        with open('runs') as runs_file:
+            lines = runs_file.read().splitlines()
+        os.remove('runs')
+        (runs, started) = ([], {})
+        for (number, line) in enumerate(lines):
+            (event, hook) = line.split(' ')
+            if event == 'start':
+                started.setdefault(hook, []).append(number)
+            else:
+                runs.append((hook, started[hook].pop(0), number))
+        return sorted(runs)
+
+    def test_hooks(self):
+        result = preflight.preflight('.')
+        self.assertEqual(result['failed'], {
+            'check-bad': ['b.txt'],
+            'trailing-whitespace': ['a.txt'],
+            'end-of-file-fixer': ['a.txt'],
+        })
+        self.assertEqual(self.read('a.txt'), 'ok\nok\n')
+
+        # until the fixes are staged, the staged file still fails
+        result = preflight.preflight('.')
+        self.assertEqual(result['checked'], 3)
+        self.assertEqual(sorted(result['failed']), [
+            'check-bad', 'end-of-file-fixer', 'trailing-whitespace'])
+        self.assertEqual(self.read('a.txt'), 'ok\nok\n')
+
+        # nothing is cached as passed for files changed by a fixer
+        subprocess.check_call(['git', 'add', 'a.txt'])
+        result = preflight.preflight('.')
+        self.assertEqual(result['checked'], 5)
+        self.assertEqual(result['failed'], {'check-bad': ['b.txt']})
+
+    def test_fixers_serial(self):
+        for name in 'defgh':
+            self.write(name + '.txt', 'ok \n', True)
+        result = preflight.preflight('.')
+        self.assertEqual(result['failed']['trailing-whitespace'],
+                         ['a.txt', 'd.txt', 'e.txt', 'f.txt', 'g.txt',
+                          'h.txt'])
+        runs = self.runs()
+        fixers = [run for run in runs if re.search(preflight.FIXERS, run[0])]
+        self.assertEqual(len(fixers), 2)
+        # fixers start when all other runs have ended, and end before others
+        for (_, start, end) in fixers:
+            self.assertEqual(end, start + 1, runs)
+            self.assertTrue(all(other_end < start
+                                for (hook, _, other_end) in runs
+                                if not re.search(preflight.FIXERS, hook)))
+
+    def test_cache(self):
+        preflight.preflight('.')
+        subprocess.check_call(['git', 'add', 'a.txt'])
+        result = preflight.preflight('.')
+        self.assertEqual((result['checked'], result['cached']), (5, 11))
+        os.remove('runs')
+
+        # only the (staged) changed file is checked again
+        self.write('c.txt', 'changed\n', True)
+        result = preflight.preflight('.')
+        self.assertEqual((result['checked'], result['cached']), (5, 11))
+        self.assertEqual([run[0] for run in self.runs()], [
+            'check-bad', 'check-bad', 'check-bad', 'check-together',
+            'end-of-file-fixer', 'trailing-whitespace'])
+        self.write('c.txt', 'BAD\n', True)
+        result = preflight.preflight('.')
+        self.assertEqual(result['failed'], {'check-bad': ['b.txt', 'c.txt']})
+
+        # and all files for a hook with a changed configuration (all hooks
+        # without PyYAML), and the changed configuration file for the others
+        self.write(preflight.CONFIG, CONFIG.replace(
+            'id: check-together', 'id: check-together\n        args: [-x]'),
+                   True)
+        result = preflight.preflight('.')
+        self.assertEqual(result['checked'],
+                         4 + 2 + 3 if preflight.yaml else 4 * 4)
+
+    def test_staged(self):
+        # unstaged changes are not checked, and are kept
+        self.write('b.txt', 'ok\n')
+        self.write('c.txt', 'BAD\n')
+        result = preflight.preflight('check')
+        self.assertEqual(result['failed'], {'check-bad': ['b.txt']})
+        self.assertEqual(self.read('b.txt'), 'ok\n')
+        self.assertEqual(self.read('c.txt'), 'BAD\n')
+        self.assertFalse(os.path.exists(
+            os.path.join('.git', preflight.PATCH_NAME)))
+
+        # fixes conflicting with unstaged changes are discarded
+        self.write('a.txt', 'ok  \nchanged')
+        result = preflight.preflight('trailing')
+        self.assertEqual(result['failed'], {'trailing-whitespace': ['a.txt']})
+        self.assertEqual(self.read('a.txt'), 'ok  \nchanged')
+
+        # and a patch left by an interrupted run is not overwritten
+        open(os.path.join('.git', preflight.PATCH_NAME), 'w').close()
+        self.assertRaises(ValueError, preflight.preflight, 'trailing')
+
+if __name__ == '__main__':
+    unittest.main()
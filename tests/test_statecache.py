@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Tests for statecache.py (with an Atlas state API stand-in)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    # noinspection PyCompatibility
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    # noinspection PyCompatibility
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import statecache  # noqa: E402 pylint: disable=C0413
+
+LINEAGE = '0e5c7e9a-4b4f-4a0e-9f3b-6f1c2d3e4f50'
+
+
+def state(serial, name='example/test1', lineage=LINEAGE):
+    """Make remote state (large enough for the probe not to read it all).
+
+    The top-level keys are in the order terraform writes them.
+    """
+    return ('{{\n    "version": 1,\n    "serial": {0},\n    "lineage": {1},'
+            '\n    "remote": {2},\n    "modules": {3}\n}}\n'.format(
+                serial, json.dumps(lineage),
+                json.dumps({'type': 'atlas', 'config': {'name': name}}),
+                json.dumps([{'path': ['root'],
+                             'outputs': {'padding': 'x' * 8192}}]))
+            ).encode('utf-8')
+
+
+class AtlasServer(ThreadingMixIn, HTTPServer):
+    """Atlas state API stand-in, with states by name and requests made."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), AtlasHandler)
+        self.states = {}
+        self.ranges = True  # send 206 for a range request (else 200)
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        """Get ATLAS_ADDRESS for the server."""
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+    def stop(self):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
+
+
+class AtlasHandler(BaseHTTPRequestHandler):
+    """Serve states (or the start of them) for the state API."""
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Send state response."""
+        (path, _, query) = self.path.partition('?')
+        self.server.requests.append((path, query,
+                                     self.headers.get('Range')))
+        name = path[len(statecache.STATE_PATH):]
+        body = self.server.states.get(name)
+        status = 200
+        if not path.startswith(statecache.STATE_PATH) or body is None:
+            (status, body) = (404, b'Not Found')
+        match = re.match(r'^bytes=0-([0-9]+)$', self.headers.get('Range', ''))
+        if status == 200 and match and self.server.ranges:
+            (status, body) = (206, body[:int(match.group(1)) + 1])
+        self.send_response(status)
+        self.send_header(str('Content-Length'), str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (IOError, OSError):  # client read only the start
+            pass
+
+    def finish(self):
+        """Finish request (even if the client closed the connection)."""
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except (IOError, OSError):
+            pass
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        """Do not log requests."""
+
+
+class RemoteVersionTest(unittest.TestCase):
+    """Remote state versions are read from the start of the state."""
+
+    def setUp(self):
+        self.server = AtlasServer()
+        self.env = {statecache.ADDRESS_ENV: self.server.address,
+                    statecache.TOKEN_ENV: 'secret'}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_partial(self):
+        self.server.states['example/test1'] = state(5)
+        self.assertEqual(statecache.remote_version('example/test1', self.env),
+                         (LINEAGE, 5))
+        self.assertEqual(self.server.requests, [
+            (statecache.STATE_PATH + 'example/test1', 'access_token=secret',
+             'bytes=0-{0}'.format(statecache.PROBE_SIZE - 1))])
+
+    def test_full(self):
+        self.server.states['example/test1'] = state(6)
+        self.server.ranges = False
+        self.assertEqual(statecache.remote_version('example/test1', self.env),
+                         (LINEAGE, 6))
+
+    def test_missing(self):
+        self.assertRaises(ValueError, statecache.remote_version,
+                          'example/test1', self.env)
+        self.server.states['example/test1'] = b'{"modules": []}'
+        self.assertRaises(ValueError, statecache.remote_version,
+                          'example/test1', self.env)
+
+
+class CacheTest(unittest.TestCase):
+    """Cached copies are saved, checked and restored by version."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = os.environ.get(statecache.CACHE_ENV)
+        os.environ[statecache.CACHE_ENV] = os.path.join(self.tmp, 'cache')
+        self.statefile = os.path.join(self.tmp, 'terraform.tfstate')
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ[statecache.CACHE_ENV]
+        else:
+            os.environ[statecache.CACHE_ENV] = self.environ
+        shutil.rmtree(self.tmp)
+
+    def write(self, data):
+        """Write the state file."""
+        with open(self.statefile, 'wb') as statefile:
+            statefile.write(data)
+
+    def test_save_restore(self):
+        for serial in range(1, statecache.CACHE_KEEP + 3):
+            self.write(state(serial))
+            statecache.save('example/test1', self.statefile)
+        self.assertTrue(statecache.is_cached('example/test1', self.statefile))
+        self.assertEqual([entry[0] for entry in
+                          statecache.entries('example/test1')],
+                         list(range(statecache.CACHE_KEEP + 2, 2, -1)))
+
+        os.remove(self.statefile)
+        self.assertTrue(statecache.restore('example/test1', (LINEAGE, 4),
+                                           self.statefile))
+        with open(self.statefile, 'rb') as statefile:
+            self.assertEqual(statefile.read(), state(4))
+        self.assertFalse(statecache.is_cached('example/test2',
+                                              self.statefile))
+        self.assertIsNone(statecache.restore('example/test1', (LINEAGE, 1),
+                                             self.statefile))
+        self.assertIsNone(statecache.restore('example/test1', (None, 4),
+                                             self.statefile))
+
+    def test_bad_checksum(self):
+        self.write(state(1))
+        entry = statecache.save('example/test1', self.statefile)
+        with open(entry, 'ab') as cached:
+            cached.write(b' ')
+        self.assertIsNone(statecache.restore('example/test1', (LINEAGE, 1),
+                                             self.statefile))
+        self.assertEqual(statecache.entries('example/test1'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
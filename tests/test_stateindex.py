@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Tests for stateindex.py (index of resources in Terraform state)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stateindex  # noqa: E402 pylint: disable=C0413
+
+
+def resource(res_type, res_id):
+    """Make resource in state, with some attributes to skip."""
+    return collections.OrderedDict([
+        ('type', res_type),
+        ('depends_on', ['a', 'b']),
+        ('primary', collections.OrderedDict([
+            ('id', res_id),
+            ('attributes', {'id': res_id, 'name': 'x "y" {z}',
+                            'tags.%': '0'}),
+            ('meta', {}),
+            ('tainted', False)
+        ])),
+        ('deposed', []),
+        ('provider', 'provider.openstack')
+    ])
+
+
+def module(path, resources, path_first=True):
+    """Make module in state."""
+    items = [('path', path), ('outputs', {'out': {'value': [1, 2]}}),
+             ('resources', collections.OrderedDict(resources))]
+    return collections.OrderedDict(items if path_first else items[::-1])
+
+
+def state(serial=3, lineage='abc-123', **kwargs):
+    """Make state with root module and module.net (path first or not)."""
+    return collections.OrderedDict([
+        ('version', 3),
+        ('terraform_version', '0.11.7'),
+        ('serial', serial),
+        ('lineage', lineage),
+        ('modules', [
+            module(['root'], [
+                ('openstack_compute_instance_v2.web.0',
+                 resource('openstack_compute_instance_v2', 'id-web-0')),
+                ('openstack_compute_instance_v2.web.1',
+                 resource('openstack_compute_instance_v2', 'id-web-1')),
+                ('data.template_file.init',
+                 resource('template_file', 'id-init'))
+            ]),
+            module(['root', 'net'], [
+                ('openstack_networking_network_v2.net',
+                 resource('openstack_networking_network_v2', 'id-net')),
+                ('openstack_compute_instance_v2.web',
+                 resource('openstack_compute_instance_v2', 'id-net-web'))
+            ], **kwargs)
+        ])
+    ])
+
+
+ADDRESSES = [
+    ('openstack_compute_instance_v2.web[0]',
+     'openstack_compute_instance_v2', '', 'id-web-0'),
+    ('openstack_compute_instance_v2.web[1]',
+     'openstack_compute_instance_v2', '', 'id-web-1'),
+    ('data.template_file.init', 'template_file', '', 'id-init'),
+    ('module.net.openstack_networking_network_v2.net',
+     'openstack_networking_network_v2', 'net', 'id-net'),
+    ('module.net.openstack_compute_instance_v2.web',
+     'openstack_compute_instance_v2', 'net', 'id-net-web')
+]
+
+
+class StateIndexTest(unittest.TestCase):
+    """Resources are indexed with their offset in the state file."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.statefile = os.path.join(self.tmp, stateindex.STATE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, value, **kwargs):
+        """Write state file (json.dump arguments as keywords)."""
+        with open(self.statefile, 'w') as state_file:
+            json.dump(value, state_file, **kwargs)
+
+    def check(self, index, value):
+        """Check index entries against the state."""
+        self.assertEqual(
+            [tuple(entry[stateindex.ADDRESS:stateindex.ID + 1])
+             for entry in index['entries']], ADDRESSES)
+        self.assertEqual((index['serial'], index['lineage']),
+                         (value['serial'], value['lineage']))
+        # resource at each offset, by address (checked above)
+        resources = dict(
+            (stateindex.resource_address(module_state['path'][1:], key), res)
+            for module_state in value['modules']
+            for (key, res) in module_state['resources'].items())
+        found = {}
+        with open(self.statefile, 'rb') as state_file:
+            for entry in index['entries']:
+                state_file.seek(entry[stateindex.OFFSET])
+                found[entry[stateindex.ADDRESS]] = json.loads(state_file.read(
+                    entry[stateindex.LENGTH]).decode('utf-8'))
+        self.assertEqual(found, resources)
+
+    def test_compact(self):
+        value = state()
+        self.write(value, separators=(',', ':'))
+        self.check(stateindex.index_file(self.statefile), value)
+
+    def test_indented(self):
+        for indent in (2, 4):
+            value = state(serial=indent)
+            self.write(value, indent=indent)
+            self.check(stateindex.index_file(self.statefile), value)
+
+    def test_resources_first(self):
+        value = state(path_first=False)
+        self.write(value, indent=2)
+        self.check(stateindex.index_file(self.statefile), value)
+
+    def test_rebuild(self):
+        self.write(state(), indent=2)
+        index = stateindex.index_file(self.statefile)
+        with open(self.statefile + stateindex.INDEX_SUFFIX) as index_fp:
+            self.assertEqual(json.load(index_fp), index)
+
+        # saved index is used while the state file is unchanged
+        saved = dict(index, entries=index['entries'][:1])
+        with open(self.statefile + stateindex.INDEX_SUFFIX, 'w') as index_fp:
+            json.dump(saved, index_fp)
+        self.assertEqual(stateindex.index_file(self.statefile), saved)
+
+        # and rebuilt (and saved) when it changes
+        value = state(serial=4)
+        value['modules'][1]['resources'].pop(
+            'openstack_compute_instance_v2.web')
+        self.write(value, indent=2)
+        index = stateindex.index_file(self.statefile)
+        self.assertEqual(index['serial'], 4)
+        self.assertEqual(
+            [entry[stateindex.ADDRESS] for entry in index['entries']],
+            [address[0] for address in ADDRESSES[:4]])
+        with open(self.statefile + stateindex.INDEX_SUFFIX) as index_fp:
+            self.assertEqual(json.load(index_fp), index)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, stateindex.index_file, self.statefile)
+        for text in ('', '{"modules": [{"resources": {"a.b": ', '[1, 2]',
+                     '{"modules": [{"path": 1, "resources": {}}]}'):
+            with open(self.statefile, 'w') as state_file:
+                state_file.write(text)
+            self.assertRaises(ValueError, stateindex.index_file,
+                              self.statefile)
+
+    def test_query(self):
+        self.write(state(), indent=2)
+        index = stateindex.index_file(self.statefile)
+
+        def addresses(**kwargs):
+            """Query index for addresses."""
+            return [entry[stateindex.ADDRESS]
+                    for entry in stateindex.query(index, **kwargs)]
+        self.assertEqual(addresses(), [entry[0] for entry in ADDRESSES])
+        self.assertEqual(addresses(res_type='openstack_compute_instance_v2'),
+                         [ADDRESSES[0][0], ADDRESSES[1][0], ADDRESSES[4][0]])
+        for name in ('net', 'module.net'):
+            self.assertEqual(addresses(module=name),
+                             [ADDRESSES[3][0], ADDRESSES[4][0]])
+        self.assertEqual(addresses(module=''),
+                         [entry[0] for entry in ADDRESSES[:3]])
+        self.assertEqual(addresses(res_id='id-net-web'), [ADDRESSES[4][0]])
+        self.assertEqual(addresses(res_type='openstack_compute_instance_v2',
+                                   module=''),
+                         [ADDRESSES[0][0], ADDRESSES[1][0]])
+        self.assertEqual(addresses(address='*.web[[]*'),
+                         [ADDRESSES[0][0], ADDRESSES[1][0]])
+        self.assertEqual(addresses(module='other'), [])
+
+    def test_main(self):
+        self.write(state(), indent=2)
+        process = subprocess.Popen(
+            [sys.executable, stateindex.__file__, '-s', self.statefile,
+             '-m', 'net', '--show'], stdout=subprocess.PIPE)
+        out = process.communicate()[0].decode('utf-8')
+        self.assertEqual(process.returncode, 0)
+        self.assertIn('"module.net.openstack_networking_network_v2.net"', out)
+        process = subprocess.Popen(
+            [sys.executable, stateindex.__file__, '-s', self.statefile,
+             '-i', 'none'], stdout=subprocess.PIPE)
+        process.communicate()
+        self.assertEqual(process.returncode, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
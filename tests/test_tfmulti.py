@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Tests for tfmulti.py (with tfplan and tfapply stand-ins)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tfmulti  # noqa: E402 pylint: disable=C0413
+
+# Exit codes of stand-in, by 'COMMAND DEPLOY' ('plan prepare' for -prepare)
+EXITS_ENV = str('TFMULTI_TEST_EXITS')
+
+# tfplan/tfapply stand-in, logging its runs to 'runs' (and doing nothing)
+STAND_IN = """
+import json, os, sys
+command = sys.argv[1]
+name = 'prepare' if '-prepare' in sys.argv else sys.argv[-1].split('/')[0]
+with open('runs', 'a') as runs:
+    runs.write(' '.join([os.environ.get('TFMULTI_LOCKED', '-'),
+                         os.environ.get('TFPLAN_PREPARED', '-')] +
+                        sys.argv[1:]) + '\\n')
+print(command + ' ' + name)
+sys.exit(json.loads(os.environ['TFMULTI_TEST_EXITS']).get(
+    command + ' ' + name, 0))
+"""
+
+
+class MultiTest(unittest.TestCase):
+    """Deployments are planned (and applied) with combined exit code."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.environ = dict((name, os.environ.get(name)) for name in
+                            (EXITS_ENV, tfmulti.LOCKED_ENV))
+        os.environ.pop(tfmulti.LOCKED_ENV, None)
+        for name in ('a', 'b', 'c', 'terraform'):
+            open(name + '.tfvars', 'w').close()
+        with open('stand-in.py', 'w') as stand_in:
+            stand_in.write(STAND_IN)
+        self.commands = (tfmulti.TFPLAN, tfmulti.TFAPPLY)
+        tfmulti.TFPLAN = [sys.executable, 'stand-in.py', 'plan']
+        tfmulti.TFAPPLY = [sys.executable, 'stand-in.py', 'apply']
+
+    def tearDown(self):
+        (tfmulti.TFPLAN, tfmulti.TFAPPLY) = self.commands
+        for (name, value) in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def tfmulti(self, args, exits=None):
+        """Run tfmulti main (stand-in exit codes as given).
+
+        :returns: exit code, results by deployment and stand-in runs
+        """
+        os.environ[EXITS_ENV] = str(json.dumps(exits or {}))
+        (argv, stdout) = (sys.argv, sys.stdout)
+        sys.argv = ['tfmulti.py'] + args
+        sys.stdout = io.StringIO()
+        try:
+            status = tfmulti.main()
+            out = sys.stdout.getvalue()
+        finally:
+            (sys.argv, sys.stdout) = (argv, stdout)
+        results = dict(line.split(': ', 1) for line in
+                       out.split('\n\n')[-1].splitlines())
+        try:
+            with open('runs') as runs_file:
+                runs = sorted(runs_file.read().splitlines())
+            os.remove('runs')
+        except IOError:
+            runs = []
+        return (status, results, runs)
+
+    def test_plan(self):
+        (status, results, runs) = self.tfmulti(['-A', '-j', '2'])
+        self.assertEqual(status, tfmulti.NO_CHANGES)
+        self.assertEqual(results, {'a': 'no changes', 'b': 'no changes',
+                                   'c': 'no changes'})
+        # prepare runs once (not locked), each plan with deployment locked
+        self.assertEqual(runs, ['- - plan -prepare a', 'a 1 plan a',
+                                'b 1 plan b', 'c 1 plan c'])
+
+        (status, results, runs) = self.tfmulti(['a', 'b.tfvars', '-destroy'],
+                                               {'plan b': 2})
+        self.assertEqual(status, tfmulti.CHANGES)
+        self.assertEqual(results, {'a': 'no changes',
+                                   'b': 'changes planned'})
+        self.assertEqual(runs, ['- - plan -prepare -destroy a',
+                                'a 1 plan -destroy a', 'b 1 plan -destroy b'])
+
+        (status, results, _) = self.tfmulti(['-A'], {'plan b': 2,
+                                                     'plan c': 1})
+        self.assertEqual(status, tfmulti.ERROR)
+        self.assertEqual(results['c'], 'plan failed (exit 1)')
+
+    def test_apply(self):
+        (status, results, runs) = self.tfmulti(
+            ['--apply', '-A'], {'plan a': 2, 'plan b': 2, 'plan c': 0})
+        self.assertEqual(status, tfmulti.CHANGES)
+        self.assertEqual(results, {'a': 'changes applied',
+                                   'b': 'changes applied',
+                                   'c': 'no changes'})
+        # applied with deployment locked, without TFPLAN_PREPARED
+        self.assertIn('a - apply a/latest.plan', runs)
+        self.assertIn('b - apply b/latest.plan', runs)
+        self.assertEqual(len(runs), 6)
+
+        (status, results, runs) = self.tfmulti(
+            ['--apply', 'a', 'b', '-destroy'], {'plan a': 2, 'plan b': 2,
+                                                'apply b': 1})
+        self.assertEqual(status, tfmulti.ERROR)
+        self.assertEqual(results, {'a': 'changes applied',
+                                   'b': 'apply failed (exit 1)'})
+        self.assertIn('b - apply b/destroy.plan', runs)
+
+    def test_remote(self):
+        os.mkdir('.terraform')
+        with open(os.path.join('.terraform', 'terraform.tfstate'),
+                  'w') as statefile:
+            json.dump({'remote': {'type': 'atlas',
+                                  'config': {'name': 'example/b'}}},
+                      statefile)
+        (status, results, runs) = self.tfmulti(['-A'], {'plan b': 2})
+        self.assertEqual(status, tfmulti.ERROR)
+        self.assertEqual(results, {
+            'a': "remote state 'example/b' configured",
+            'b': 'changes planned',
+            'c': "remote state 'example/b' configured"})
+        self.assertEqual(runs, ['- - plan -prepare b', 'b 1 plan b'])
+
+    def test_locked(self):
+        lock_file = tfmulti.lock('b')
+        try:
+            (status, results, runs) = self.tfmulti(['-A'])
+        finally:
+            lock_file.close()
+        self.assertEqual(status, tfmulti.ERROR)
+        self.assertEqual(results['b'], 'locked by another plan/apply')
+        self.assertEqual(results['a'], 'no changes')
+        self.assertNotIn('b 1 plan b', runs)
+        # and locks are released when done
+        for name in ('a', 'b', 'c'):
+            lock_file = tfmulti.lock(name)
+            self.assertIsNotNone(lock_file)
+            lock_file.close()
+
+    def test_prepare_failed(self):
+        (status, results, runs) = self.tfmulti(['a', 'b'],
+                                               {'plan prepare': 1})
+        self.assertEqual(status, tfmulti.ERROR)
+        self.assertEqual(results, {'a': 'not planned (prepare failed)',
+                                   'b': 'not planned (prepare failed)'})
+        self.assertEqual(runs, ['- - plan -prepare a'])
+
+    def test_combined_status(self):
+        for (codes, status) in (([], 0), ([0, 0], 0), ([0, 2, 0], 2),
+                                ([2, 1, 0], 1), ([1], 1)):
+            self.assertEqual(tfmulti.combined_status(codes), status, codes)
+
+
+if __name__ == '__main__':
+    unittest.main()
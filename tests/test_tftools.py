@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Tests for tftools.py commands."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import statecache  # noqa: E402 pylint: disable=C0413
+import tfmulti  # noqa: E402 pylint: disable=C0413
+import tftools  # noqa: E402 pylint: disable=C0413
+from test_statecache import AtlasServer, state  # noqa: E402 pylint: disable=C0413
+
+# terraform stand-in, logging its arguments (and doing nothing else)
+TERRAFORM = """#!/bin/sh
+echo "$*" >> {log}
+"""
+
+
+def which(command):
+    """Find command in PATH."""
+    for directory in os.environ['PATH'].split(os.pathsep):
+        if os.access(os.path.join(directory, command), os.X_OK):
+            return os.path.join(directory, command)
+    raise OSError('{0} not found'.format(command))
+
+
+class CheckoutTestCase(unittest.TestCase):
+    """Commands run in a Git checkout (with only the commands in bin)."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(self.bin)
+        for command in ('git', 'sh'):
+            os.symlink(which(command), os.path.join(self.bin, command))
+        os.mkdir(os.path.join(self.tmp, 'repo'))
+        os.chdir(os.path.join(self.tmp, 'repo'))
+        with open('test1.tfvars', 'w') as tfvars:
+            tfvars.write('a = "b"\n')
+        open('main.tf', 'w').close()
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'test')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        """Run git command."""
+        subprocess.check_call(('git',) + args)
+
+    def tftools(self, *args):
+        """Run tftools.py ARGS, returning (exit code, output)."""
+        env = dict(os.environ)
+        env[str('PATH')] = str(self.bin)
+        env.pop(str(statecache.CACHE_ENV), None)
+        process = subprocess.Popen([sys.executable, tftools.__file__] +
+                                   list(args), env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        out = process.communicate()[0].decode('utf-8', 'replace')
+        return (process.returncode, out)
+
+
+class PlanTest(CheckoutTestCase):
+    """tfplan without terraform (or of a locked deployment) fails cleanly."""
+
+    def test_no_terraform(self):
+        (status, out) = self.tftools('plan', 'test1')
+        self.assertEqual(status, 127, out)
+        self.assertNotIn('Traceback', out)
+
+    def test_locked(self):
+        os.mkdir('test1')
+        open(os.path.join('test1', 'test.plan'), 'w').close()
+        lock_file = tfmulti.lock('test1')
+        try:
+            for args in (('plan', 'test1'), ('apply', 'test1/test.plan')):
+                (status, out) = self.tftools(*args)
+                self.assertEqual(status, 1, out)
+                self.assertIn("'test1' is locked by another plan/apply", out)
+            # (unless run by tfmulti holding the lock)
+            os.environ[tfmulti.LOCKED_ENV] = str('test1')
+            self.assertEqual(self.tftools('plan', 'test1')[0], 127)
+        finally:
+            os.environ.pop(tfmulti.LOCKED_ENV, None)
+            lock_file.close()
+        self.assertEqual(self.tftools('plan', 'test1')[0], 127)
+
+
+class RemoteTest(CheckoutTestCase):
+    """tfremote skips transfers of remote state it already has."""
+
+    def setUp(self):
+        CheckoutTestCase.setUp(self)
+        self.server = AtlasServer()
+        with open(tftools.ATLAS_ENV, 'w') as atlas_env:
+            atlas_env.write('ATLAS_ADDRESS={0}\nATLAS_TOKEN=secret\n'.format(
+                self.server.address))
+        self.log = os.path.join(self.tmp, 'terraform.log')
+        with open(os.path.join(self.bin, 'terraform'), 'w') as terraform:
+            terraform.write(TERRAFORM.format(log=self.log))
+        os.chmod(os.path.join(self.bin, 'terraform'), 0o755)
+
+    def tearDown(self):
+        self.server.stop()
+        CheckoutTestCase.tearDown(self)
+
+    def terraform_runs(self):
+        """Get terraform runs (and clear the log)."""
+        try:
+            with open(self.log) as log:
+                runs = log.read().splitlines()
+            os.remove(self.log)
+        except IOError:
+            runs = []
+        return runs
+
+    def write_state(self, serial):
+        """Write local copy of remote state."""
+        if not os.path.isdir(os.path.dirname(statecache.TF_STATE)):
+            os.makedirs(os.path.dirname(statecache.TF_STATE))
+        with open(statecache.TF_STATE, 'wb') as statefile:
+            statefile.write(state(serial))
+
+    def test_pull_push(self):
+        self.write_state(5)
+        self.server.states['example/test1'] = state(5)
+        (status, out) = self.tftools('remote', 'pull')
+        self.assertEqual(status, 0, out)
+        self.assertIn('unchanged, not pulled (state cache hit)', out)
+        (status, out) = self.tftools('remote', 'push')
+        self.assertEqual(status, 0, out)
+        self.assertIn('unchanged, not pushed (state cache hit)', out)
+        self.assertEqual(self.terraform_runs(), [])
+
+        # local changes (same serial) are pushed
+        with open(statecache.TF_STATE, 'ab') as statefile:
+            statefile.write(b'\n')
+        self.assertEqual(self.tftools('remote', 'push')[0], 0)
+        self.assertEqual(self.terraform_runs(), ['remote push'])
+
+        self.server.states['example/test1'] = state(6)
+        (status, out) = self.tftools('remote', 'pull')
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.terraform_runs(), ['remote pull'])
+
+    def test_status(self):
+        self.write_state(5)
+        self.server.states['example/test1'] = state(6)
+        (status, out) = self.tftools('remote', 'status')
+        self.assertEqual(status, 0, out)
+        self.assertIn('Remote serial 6', out)
+        self.assertIn('(state cache miss)', out)
+
+    def test_config_restore(self):
+        self.write_state(5)
+        statecache.save('example/test1', statecache.TF_STATE)
+        os.remove(statecache.TF_STATE)
+        self.server.states['example/test1'] = state(5)
+        (status, out) = self.tftools('remote', 'config', 'test1')
+        self.assertEqual(status, 0, out)
+        self.assertIn('restored from', out)
+        self.assertEqual(self.terraform_runs(), [])
+        with open(statecache.TF_STATE, 'rb') as statefile:
+            self.assertEqual(statefile.read(), state(5))
+
+        os.remove(statecache.TF_STATE)  # and no cached copy of serial 6
+        self.server.states['example/test1'] = state(6)
+        (status, out) = self.tftools('remote', 'config', 'test1')
+        self.assertEqual(status, 0, out)
+        self.assertEqual(self.terraform_runs(), [
+            'remote config -backend-config=name=example/test1 '
+            '-state=test1/terraform.tfstate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Tests for userdata_decode.py decoding and result cache."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import base64
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import userdata_decode  # noqa: E402 pylint: disable=C0413
+
+USERDATA = ('Content-Type: multipart/mixed; boundary="==x=="\n'
+            'MIME-Version: 1.0\n\n--==x==\n'
+            'Content-Type: text/x-shellscript; charset="us-ascii"\n'
+            'Content-Transfer-Encoding: base64\n\n'
+            'IyEvYmluL3NoCmVjaG8gaGkK\n\n--==x==--\n')
+
+
+def encode(data):
+    """Base64 encode data in lines of 76 characters."""
+    text = base64.b64encode(data).decode('ascii')
+    return ''.join(text[start:start + 76] + '\n'
+                   for start in range(0, len(text), 76))
+
+
+# Base64 of a text part in two blocks (the first ends with padding), and of
+# a binary part (which is not expanded)
+SCRIPT = b'#!/bin/sh\n' + b'echo first block\n' * 10
+CONFIG = b'#cloud-config\nname: caf\xc3\xa9\n'
+MULTI_BLOCK = (
+    'Content-Type: multipart/mixed; boundary="==cloud-multi======"\n'
+    'MIME-Version: 1.0\n\n--==cloud-multi======\n'
+    'Content-Type: text/x-shellscript; charset="us-ascii"\n'
+    'Content-Transfer-Encoding: base64\n\n' +
+    encode(SCRIPT[:-1]) + encode(SCRIPT[-1:] + CONFIG) +
+    '\n--==cloud-multi======\n'
+    'Content-Type: application/octet-stream\n'
+    'Content-Transfer-Encoding: base64\n\n'
+    'AAECAw==\n\n--==cloud-multi======--\n')
+EXPANDED = (
+    b'Content-Type: multipart/mixed; boundary="==cloud-multi===="\n'
+    b'MIME-Version: 1.0\n\n--==cloud-multi====\n'
+    b'Content-Type: text/x-shellscript; charset="us-ascii"\n'
+    b'Content-Transfer-Encoding: base64\n\n' + SCRIPT + CONFIG +
+    b'\n--==cloud-multi====\n'
+    b'Content-Type: application/octet-stream\n'
+    b'Content-Transfer-Encoding: base64\n\n'
+    b'AAECAw==\n\n--==cloud-multi====\n')
+
+# Quoted-printable text part (as writemime.py -O writes it), with a soft line
+# break, and of a binary part (which is not expanded)
+QUOTED = (
+    'Content-Type: multipart/mixed; boundary="==x=="\n'
+    'MIME-Version: 1.0\n\n--==x==\n'
+    'Content-Type: text/x-shellscript; charset="us-ascii"\n'
+    'Content-Transfer-Encoding: quoted-printable\n'
+    'Content-Disposition: attachment; filename="a=3D.sh"\n\n'
+    '#!/bin/sh\necho hi=0D\nX=3D1 ; echo long=\n line =\n\n'
+    '\n--==x==\n'
+    'Content-Type: application/octet-stream\n'
+    'Content-Transfer-Encoding: quoted-printable\n\n'
+    '=00A=3D\n--==x==--\n')
+QUOTED_EXPANDED = (
+    b'Content-Type: multipart/mixed; boundary="==cloud-multi===="\n'
+    b'MIME-Version: 1.0\n\n--==cloud-multi====\n'
+    b'Content-Type: text/x-shellscript; charset="us-ascii"\n'
+    b'Content-Transfer-Encoding: quoted-printable\n'
+    b'Content-Disposition: attachment; filename="a=3D.sh"\n\n'
+    b'#!/bin/sh\necho hi\r\nX=1 ; echo long line \n'
+    b'\n--==cloud-multi====\n'
+    b'Content-Type: application/octet-stream\n'
+    b'Content-Transfer-Encoding: quoted-printable\n\n'
+    b'=00A=3D\n--==cloud-multi====\n')
+
+
+class UserdataTestCase(unittest.TestCase):
+    """Userdata files in a temporary directory."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        """Write userdata file, returning its path."""
+        filename = os.path.join(self.tmp, name)
+        with open(filename, 'wb') as userdata:
+            userdata.write(data)
+        return filename
+
+    def run_decode(self, filename, cache=None):
+        """Run userdata_decode.py on a file (with a cache), returning output."""
+        env = dict(os.environ)
+        env.pop(str(userdata_decode.CACHE_ENV), None)
+        env[str('HOME')] = str(self.tmp)
+        env.pop(str('XDG_CACHE_HOME'), None)
+        if cache is not None:
+            env[str(userdata_decode.CACHE_ENV)] = str(cache)
+        return subprocess.check_output([sys.executable,
+                                        userdata_decode.__file__, filename],
+                                       env=env)
+
+
+class DecodeTest(UserdataTestCase):
+    """Text parts are expanded (Base64 by block, QP by line), gzip or not."""
+
+    def test_blocks(self):
+        filename = self.write('u.mime', MULTI_BLOCK.encode('ascii'))
+        self.assertEqual(self.run_decode(filename), EXPANDED)
+        # long lines are not Base64 lines (of a single block)
+        lines = MULTI_BLOCK.split('\n')
+        filename = self.write('u.mime', '\n'.join(
+            lines[:5] + [''.join(lines[5:7])] + lines[7:]).encode('ascii'))
+        self.assertNotEqual(self.run_decode(filename), EXPANDED)
+
+    def test_quoted_printable(self):
+        filename = self.write('u.mime', QUOTED.encode('ascii'))
+        self.assertEqual(self.run_decode(filename), QUOTED_EXPANDED)
+
+    def test_gzip(self):
+        data = io.BytesIO()
+        with gzip.GzipFile(fileobj=data, mode='wb') as gzip_file:
+            gzip_file.write(MULTI_BLOCK.encode('ascii'))
+        filename = self.write('u.mime.gz', data.getvalue())
+        self.assertEqual(self.run_decode(filename), EXPANDED)
+
+    def test_cache(self):
+        filename = self.write('u.mime', MULTI_BLOCK.encode('ascii'))
+        self.assertEqual(self.run_decode(filename, self.cache), EXPANDED)
+        cached = os.path.join(self.cache, userdata_decode.file_digest(filename))
+        os.utime(cached, (1000, 1000))
+        self.assertEqual(self.run_decode(filename, self.cache), EXPANDED)
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(cached)])
+        self.assertNotEqual(os.path.getmtime(cached), 1000)  # was a hit
+        self.assertEqual(os.stat(self.cache).st_mode & 0o777, 0o700)
+
+    def test_no_cache(self):
+        filename = self.write('u.mime', MULTI_BLOCK.encode('ascii'))
+        for cache in (None, ''):
+            self.assertEqual(self.run_decode(filename, cache), EXPANDED)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['u.mime'])
+
+
+class CacheTest(UserdataTestCase):
+    """Only the most recently used results are kept."""
+
+    def decode(self, index):
+        """Decode userdata revision INDEX (with the cache)."""
+        filename = self.write('u{0}.mime'.format(index), USERDATA.replace(
+            'MIME-Version', 'X-Index: {0}\nMIME-Version'.format(index)
+        ).encode('ascii'))
+        self.run_decode(filename, self.cache)
+        return userdata_decode.file_digest(filename)
+
+    def test_evict(self):
+        digests = [self.decode(index) for index in range(3)]
+        for (index, digest) in enumerate(digests):
+            os.utime(os.path.join(self.cache, digest), (index, index))
+        self.decode(0)  # cache hit makes it the most recently used
+        open(os.path.join(self.cache, 'tmpXYZ'), 'w').close()
+        userdata_decode.cache_evict(self.cache, 2)
+        self.assertEqual(sorted(os.listdir(self.cache)),
+                         sorted([digests[0], digests[2], 'tmpXYZ']))
+
+
+if __name__ == '__main__':
+    unittest.main()
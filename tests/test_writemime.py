@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Tests for writemime.py (run with each tox interpreter, including py27)."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import email
+import gzip
+import hashlib
+import io
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from email import encoders
+from email.mime.multipart import MIMEMultipart
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import userdata_decode  # noqa: E402 pylint: disable=C0413
+import writemime  # noqa: E402 pylint: disable=C0413
+
+
+def old_output(argv):
+    """Get output of writemime.py ARGV as written before streaming parts.
+
+    This is how main() wrote the whole message, as one MIMEMultipart string.
+    """
+    args = writemime.make_parser().parse_args(argv)
+    outer = MIMEMultipart(boundary='==cloud-multi' + ('==' * (len(argv) + 1)))
+    for arg_list, encoder in [(args.parts, None),
+                              (args.encoded_parts, encoders.encode_base64),
+                              (args.added_parts, None)]:
+        for arg in arg_list:
+            (path, mime) = writemime.part_get_mimetype(arg, args.deftype,
+                                                       args.delimiter)
+            writemime.add_part(outer, path, mime, encoder)
+    return outer.as_string().encode()
+
+
+class PartsTestCase(unittest.TestCase):
+    """Part files (text with CRLF, non-ASCII text, and binary)."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.files = {}
+        for (name, data) in (('a.sh', b'#!/bin/sh\necho hi\r\n'),
+                             ('b.txt', '#cloud-config\nname: café\n'
+                              .encode('utf-8')),
+                             ('c.bin', bytes(bytearray(range(256))) * 4),
+                             ('d.bin', bytes(bytearray(range(256))) *
+                              (writemime.CHUNK_SIZE // 100))):
+            self.files[name] = os.path.join(self.tmp, name)
+            with open(self.files[name], 'wb') as part_file:
+                part_file.write(data)
+        self.environ = os.environ.pop(writemime.CACHE_ENV, None)
+
+    def tearDown(self):
+        if self.environ is not None:
+            os.environ[writemime.CACHE_ENV] = self.environ
+        shutil.rmtree(self.tmp)
+
+    def writemime(self, *args):
+        """Run writemime.py ARGS in the part directory, returning output."""
+        return subprocess.check_output(
+            [sys.executable, writemime.__file__] + list(args), cwd=self.tmp)
+
+    def read(self, name):
+        """Read (output) file in the part directory."""
+        with open(os.path.join(self.tmp, name), 'rb') as output_file:
+            return output_file.read()
+
+
+class PartTest(PartsTestCase):
+    """Text parts are read from (py2) file objects opened by open_part()."""
+
+    def message(self, optimize=False, compress=False):
+        """Write message with all parts, returning it parsed."""
+        parts = [writemime.open_part(self.files['a.sh'], 'text/plain'),
+                 writemime.open_part(self.files['b.txt'] + ':text/cloud-config',
+                                     'text/plain'),
+                 writemime.open_part(self.files['c.bin'], 'text/plain')]
+        output = os.path.join(self.tmp, 'out')
+        limit = writemime.LIMIT_DEFAULT if optimize else None
+        try:
+            writemime.write_target(
+                output, compress, False,
+                [writemime.part_chunks(*part, optimize=optimize,
+                                       compress=compress) for part in parts],
+                '==test==', limit)
+        finally:
+            for part in parts:
+                part[0].close()
+        opener = gzip.open if compress else io.open
+        with opener(output, 'rb') as output_file:
+            data = output_file.read()
+        if sys.version_info[0] < 3:
+            return email.message_from_string(data)
+        return email.message_from_bytes(data)
+
+    def check(self, msg):
+        """Check that decoded parts have the part file contents."""
+        payloads = [part.get_payload(decode=True)
+                    for part in msg.get_payload()]
+        with open(self.files['b.txt'], 'rb') as part_file:
+            self.assertEqual(payloads[1], part_file.read())
+        with open(self.files['c.bin'], 'rb') as part_file:
+            self.assertEqual(payloads[2], part_file.read())
+        self.assertEqual(payloads[0].replace(b'\r', b''),
+                         b'#!/bin/sh\necho hi\n')
+
+    def test_parts(self):
+        self.check(self.message())
+
+    def test_optimize(self):
+        self.check(self.message(optimize=True))
+
+    def test_optimize_gzip(self):
+        self.check(self.message(optimize=True, compress=True))
+
+    def test_optimize_binary(self):
+        # mostly text: quoted-printable (with line breaks encoded) is smaller
+        mostly_text = b'\0#!/bin/sh\r\n' + ''.join(
+            'echo "line {0} = x"  \n'.format(number)
+            for number in range(20)).encode('ascii')
+        # (hash digests, as repeated byte ranges compress well even as QP)
+        binary = b''.join(hashlib.sha256(bytes(bytearray([number]))).digest()
+                          for number in range(32))
+        for (data, cte) in ((mostly_text, 'quoted-printable'),
+                            (binary, 'base64'), (b'', 'base64')):
+            for compress in (False, True):
+                text = ''.join(writemime.part_chunks(
+                    io.BytesIO(data), 'x.bin', 'application/octet-stream',
+                    optimize=True, compress=compress))
+                part = email.message_from_string(text)
+                self.assertEqual(part['Content-Transfer-Encoding'], cte)
+                self.assertEqual(part.get_payload(decode=True), data)
+                self.assertEqual(part.get_all('Content-Transfer-Encoding'),
+                                 [cte])
+        # (unless Base64 encoding is forced)
+        text = ''.join(writemime.part_chunks(
+            io.BytesIO(mostly_text), 'x.bin', 'application/octet-stream',
+            encoders.encode_base64, optimize=True))
+        self.assertEqual(email.message_from_string(text)[
+            'Content-Transfer-Encoding'], 'base64')
+
+
+# py2's email package drops the newline ending Base64 bodies, so the py3
+# output (which py2 now also writes) is the reference
+@unittest.skipIf(sys.version_info[0] < 3, 'old output differs on py2')
+class StreamTest(PartsTestCase):
+    """Streamed output is identical to the whole message written at once."""
+
+    def setUp(self):
+        PartsTestCase.setUp(self)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        PartsTestCase.tearDown(self)
+
+    def test_same_output(self):
+        for argv in (['a.sh', 'c.bin', 'd.bin'],
+                     ['-e', 'a.sh:text/x-shellscript', '-a', 'c.bin',
+                      '-d', 'text/x-test', 'a.sh', 'd.bin:application/x-test'],
+                     ['b.txt:text/cloud-config', 'a.sh']):
+            self.assertEqual(self.writemime(*argv), old_output(argv), argv)
+
+    def test_gzip(self):
+        output = gzip.GzipFile(fileobj=io.BytesIO(
+            self.writemime('-z', 'a.sh', 'd.bin')))
+        self.assertEqual(output.read(), old_output(['-z', 'a.sh', 'd.bin']))
+
+
+class CanonicalTest(PartsTestCase):
+    """Canonical output depends only on the part contents (and names)."""
+
+    def test_reproducible(self):
+        self.writemime('--canonical', '-z', '-o', 'out1', 'a.sh', 'd.bin')
+        os.mkdir(os.path.join(self.tmp, 'sub'))
+        for name in ('a.sh', 'd.bin'):
+            shutil.copy(self.files[name], os.path.join(self.tmp, 'sub'))
+            os.utime(os.path.join(self.tmp, 'sub', name), (1000, 1000))
+        time.sleep(1.1)  # gzip header time would differ
+        self.writemime('-z', '-d', 'text/plain', '--canonical', '-o',
+                       os.path.join(self.tmp, 'out2'), 'sub/a.sh',
+                       os.path.join(self.tmp, 'sub', 'd.bin'))
+        self.assertEqual(self.read('out1'), self.read('out2'))
+
+        # but not on the parts or their order
+        self.writemime('--canonical', '-z', '-o', 'out3', 'd.bin', 'a.sh')
+        self.assertNotEqual(self.read('out3'), self.read('out1'))
+
+    def test_decoded(self):
+        self.writemime('-o', 'out1', 'a.sh', 'b.txt', 'd.bin')
+        self.writemime('--canonical', '-o', 'out2', 'a.sh', 'b.txt', 'd.bin')
+        self.assertNotEqual(self.read('out1'), self.read('out2'))
+        decoded = []
+        for name in ('out1', 'out2'):
+            output = io.BytesIO()
+            with userdata_decode.open_userdata(
+                    os.path.join(self.tmp, name)) as input_file:
+                userdata_decode.decode(input_file, output)
+            decoded.append(output.getvalue())
+        self.assertEqual(decoded[0], decoded[1])
+
+
+class BatchTest(PartsTestCase):
+    """Batch outputs are identical to those of separate runs."""
+
+    LINES = ['-o u1.userdata a.sh b.txt d.bin',
+             '-o u2.userdata -e a.sh c.bin d.bin',
+             '# comment', '',
+             '--canonical -z -o u3.userdata a.sh d.bin',
+             "-O -o 'u4.userdata' a.sh b.txt c.bin"]
+
+    def test_batch(self):
+        with open(os.path.join(self.tmp, 'manifest'), 'w') as manifest:
+            manifest.write('\n'.join(self.LINES) + '\n')
+        for jobs in ('1', '2'):
+            self.writemime('--batch', 'manifest', '-j', jobs)
+            outputs = dict((name, self.read(name)) for name in
+                           os.listdir(self.tmp) if name.endswith('.userdata'))
+            self.assertEqual(len(outputs), 4)
+            for line in self.LINES:
+                if line and not line.startswith('#'):
+                    self.writemime(*shlex.split(line))
+            for (name, output) in outputs.items():
+                self.assertEqual(self.read(name), output, name)
+                os.remove(os.path.join(self.tmp, name))
+
+
+class CacheHitTest(PartsTestCase):
+    """Cached outputs are reused as they are, leaving targets untouched."""
+
+    def test_hit(self):
+        args = ('-c', 'cache', '-z', '-o', 'out.userdata', 'a.sh', 'd.bin')
+        self.writemime(*args)
+        output = self.read('out.userdata')
+        target = os.path.join(self.tmp, 'out.userdata')
+        os.utime(target, (1000, 1000))  # also unlike the target stamp
+        time.sleep(1.1)  # gzip header time of a new output would differ
+        for _ in range(2):
+            self.writemime(*args)
+            self.assertEqual(self.read('out.userdata'), output)
+            self.assertEqual(os.stat(target).st_mtime, 1000)
+
+        os.remove(target)
+        self.writemime(*args)
+        self.assertEqual(self.read('out.userdata'), output)
+
+        # not a hit for other parts or options
+        self.writemime(*args[:-1])
+        self.assertNotEqual(self.read('out.userdata'), output)
+        self.writemime(*args[:2] + args[3:])
+        self.assertNotEqual(self.read('out.userdata')[:2], output[:2])
+
+
+class CacheTest(unittest.TestCase):
+    """Only the most recently used cached outputs are kept."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def key(self, index):
+        """Get (hex digest) cache key INDEX."""
+        return hashlib.sha256(str(index).encode('ascii')).hexdigest()
+
+    def store(self, index):
+        """Store output for key INDEX (target 'tINDEX')."""
+        target = os.path.join(self.tmp, 't{0}'.format(index))
+        with open(target, 'w') as target_file:
+            target_file.write('output {0}\n'.format(index))
+        writemime.cache_store(self.cache, self.key(index), target)
+        return target
+
+    def test_evict(self):
+        targets = [self.store(index) for index in range(3)]
+        # make key 0 the most recently used, then store one more
+        for (index, target) in enumerate(targets):
+            os.utime(writemime.cache_paths(self.cache, self.key(index),
+                                           target)[0], (index, index))
+        self.assertTrue(writemime.cache_lookup(self.cache, self.key(0),
+                                               targets[0]))
+        open(os.path.join(self.cache, 'objects', 'tmpXYZ'), 'w').close()
+        writemime.cache_evict(self.cache, 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache,
+                                                        'objects'))),
+                         sorted([self.key(0), self.key(2), 'tmpXYZ']))
+        self.assertFalse(writemime.cache_lookup(self.cache, self.key(1),
+                                                targets[1]))
+        self.assertEqual(len(os.listdir(os.path.join(self.cache,
+                                                     'targets'))), 2)
+
+    def test_store_evicts(self):
+        for index in range(writemime.CACHE_ENTRIES + 5):
+            self.store(index)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache,
+                                                     'objects'))),
+                         writemime.CACHE_ENTRIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Plan (and optionally apply) several deployments in parallel.
+
+Each deployment is planned with tfplan (and applied with tfapply) in its
+own process, at most JOBS at a time, with the output of each line prefixed
+by the deployment name. The steps of tfplan that are shared by all
+deployments (checks, userdata files, and `terraform get`) are run once,
+before any deployment is planned (see the tfplan -prepare option).
+
+Each deployment is locked (see LOCK_DIR) while it is planned and applied,
+so that concurrent runs cannot plan or apply the same deployment at once
+(tfplan and tfapply take the same lock, unless run by tfmulti holding it).
+As tfplan and tfapply refuse to run for a deployment other than the one
+with active remote state, if remote state is configured only the matching
+deployment is planned, and the others fail without running tfplan.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import errno
+import fcntl
+import glob
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import getremote
+
+TFPLAN = [str('./tftools.py'), str('plan')]
+TFAPPLY = [str('./tftools.py'), str('apply')]
+
+# Lock files for deployments are DEPLOY.lock in this directory
+LOCK_DIR = str('.terraform/locks')
+
+# Set to the deployment for tfplan and tfapply run holding its lock
+LOCKED_ENV = str('TFMULTI_LOCKED')
+
+# Combined exit codes (as for terraform plan -detailed-exitcode)
+NO_CHANGES, ERROR, CHANGES = range(3)
+
+# Output modes: prefix each line with deployment as it is output, or output
+# all lines of a deployment (with a header line) together when it finishes
+PREFIX, GROUP = 'prefix', 'group'
+
+OUTPUT_LOCK = threading.Lock()
+
+
+def deployment_name(name):
+    """Get deployment name from DEPLOY or DEPLOY.tfvars argument.
+
+    :param name: argument
+    :type name: str
+    :returns: deployment name
+    :rtype: str
+    :raises ValueError: if there is no .tfvars file for deployment
+    """
+    if name.endswith('.tfvars'):
+        name = name[:-len('.tfvars')]
+    if not os.path.isfile(name + '.tfvars'):
+        raise ValueError("there is no '{0}.tfvars' file".format(name))
+    return name
+
+
+def lock(deployment):
+    """Lock deployment against concurrent plan/apply.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: open lock file (closing it releases the lock)
+    :returns: None if deployment is already locked
+    :rtype: file
+    """
+    try:
+        os.makedirs(LOCK_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    lock_file = open(os.path.join(LOCK_DIR, deployment + '.lock'), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as err:
+        lock_file.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+
+def output(lines):
+    """Write lines to stdout (without interleaving them with other threads).
+
+    :param lines: output lines
+    :type lines: list(str)
+    """
+    with OUTPUT_LOCK:
+        for line in lines:
+            print(line)
+        sys.stdout.flush()
+
+
+def run(command, deployment, mode=PREFIX, env=None):
+    """Run command, outputting its (combined) stdout and stderr.
+
+    :param command: command and arguments
+    :type command: list(str)
+    :param deployment: deployment name (for output prefix/header)
+    :type deployment: str
+    :param mode: output mode (PREFIX or GROUP)
+    :type mode: str
+    :param env: environment for command (default: inherited)
+    :type env: dict
+    :returns: exit code of command
+    :rtype: int
+    """
+    with open(os.devnull) as devnull:
+        process = subprocess.Popen(command, stdin=devnull,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=env)
+    lines = ['=== {0}: {1}'.format(deployment, ' '.join(command))]
+    prefix = deployment + ' | '
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        if mode == PREFIX:
+            output([prefix + line])
+        else:
+            lines.append(line)
+    process.stdout.close()
+    status = process.wait()
+    if mode == GROUP:
+        output(lines)
+    return status
+
+
+def plan_apply(job):
+    """Plan (and optionally apply) a deployment.
+
+    :param job: deployment, tfplan options, apply flag, and output mode
+    :type job: tuple(str, list(str), bool, str)
+    :returns: deployment, exit code and description of result
+    :rtype: tuple(str, int, str)
+    """
+    (deployment, options, apply_plan, mode) = job
+    env = dict(os.environ)
+    env[LOCKED_ENV] = str(deployment)
+    lock_file = lock(deployment)
+    if lock_file is None:
+        return deployment, ERROR, 'locked by another plan/apply'
+    with lock_file:
+        status = run(TFPLAN + options + [deployment], deployment, mode,
+                     dict(env, TFPLAN_PREPARED=str('1')))
+        if status == NO_CHANGES:
+            return deployment, status, 'no changes'
+        if status != CHANGES:
+            return deployment, ERROR, 'plan failed (exit {0})'.format(status)
+        if not apply_plan:
+            return deployment, status, 'changes planned'
+
+        plan = 'destroy.plan' if '-destroy' in options else 'latest.plan'
+        status = run(TFAPPLY + [os.path.join(deployment, plan)], deployment,
+                     mode, env)
+        if status:
+            return deployment, ERROR, 'apply failed (exit {0})'.format(status)
+        return deployment, CHANGES, 'changes applied'
+
+
+def combined_status(codes):
+    """Combine exit codes of all deployments.
+
+    :param codes: exit codes (NO_CHANGES, ERROR, or CHANGES)
+    :type codes: iterable(int)
+    :returns: ERROR if any failed, else CHANGES if any changes, else 0
+    :rtype: int
+    """
+    codes = set(codes)
+    for code in (ERROR, CHANGES):
+        if code in codes:
+            return code
+    return NO_CHANGES
+
+
+def main():
+    """Plan (and optionally apply) deployments in parallel.
+
+    :returns: Exit code (0 if no changes, 1 if any failed, 2 if any changes)
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Plan (and apply) several deployments in parallel.',
+        epilog='Other options (e.g. -destroy or -target=RESOURCE) are '
+        'passed to tfplan for every deployment.'
+    )
+    parser.add_argument('-A', '--all', dest='all', default=False,
+                        action='store_true',
+                        help='all deployments (with .tfvars files)')
+    parser.add_argument('--apply', dest='apply', default=False,
+                        action='store_true',
+                        help='apply plans with changes')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=4, type=int,
+                        help='deployments planned at once (default: '
+                        '%(default)s)')
+    parser.add_argument('-o', '--output', dest='mode', default=PREFIX,
+                        choices=(PREFIX, GROUP),
+                        help="output lines with deployment prefix as they "
+                        "are written, or grouped by deployment (default: "
+                        "'%(default)s')")
+    parser.add_argument('deployments', nargs='*', default=[],
+                        help='deployment (with .tfvars file)',
+                        metavar='DEPLOY')
+    (args, extra) = parser.parse_known_args()
+    options = [arg for arg in extra if arg.startswith('-')]
+    args.deployments.extend(arg for arg in extra if not arg.startswith('-'))
+    if args.all:
+        args.deployments.extend(
+            name for name in sorted(glob.glob('*.tfvars'))
+            if name != 'terraform.tfvars')
+    if not args.deployments:
+        parser.error('DEPLOY or --all is required')
+    if args.jobs < 1:
+        parser.error('JOBS must be at least 1')
+
+    try:
+        deployments = []
+        for name in args.deployments:
+            name = deployment_name(name)
+            if name not in deployments:
+                deployments.append(name)
+        remote = getremote.name()
+    except ValueError as err:
+        print('{0}: {1}'.format(parser.prog, err), file=sys.stderr)
+        return ERROR
+
+    results = []
+    jobs = []
+    for deployment in deployments:
+        if remote is not None and remote.split('/')[1] != deployment:
+            results.append((deployment, ERROR,
+                            "remote state '{0}' configured".format(remote)))
+        else:
+            jobs.append((deployment, options, args.apply, args.mode))
+
+    if jobs:
+        status = run(TFPLAN + ['-prepare'] + options + [jobs[0][0]],
+                     'prepare', args.mode)
+        if status:
+            results.extend((job[0], ERROR, 'not planned (prepare failed)')
+                           for job in jobs)
+            jobs = []
+
+    if jobs:
+        pool = ThreadPool(min(args.jobs, len(jobs)))
+        try:
+            results.extend(pool.imap_unordered(plan_apply, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    try:
+        if getremote.name() != remote:
+            results.append(('remote', ERROR, 'remote state changed while '
+                            'running - check all deployments'))
+    except ValueError as err:
+        results.append(('remote', ERROR, str(err)))
+
+    output([''] + ['{0}: {1}'.format(deployment, result)
+                   for (deployment, _, result) in sorted(results)])
+    return combined_status(status for (_, status, _) in results)
+
+if __name__ == '__main__':
+    sys.exit(main())
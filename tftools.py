@@ -0,0 +1,1221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Plan and apply Terraform deployments, and manage their remote state.
+
+`tftools.py plan`, `tftools.py apply` and `tftools.py remote` implement the
+tfplan, tfapply and tfremote commands (those scripts run them, and describe
+what they do). The Git branch, the Atlas remote name, and the environment
+for terraform (from the *.env and DEPLOY.tfenv files, or atlas.env) are
+resolved in this one process, rather than by running git, sed, getremote.py
+and sh for each command, and the helper modules (stateindex, preflight,
+planfingerprint, artifacts) are only imported when a command uses them.
+
+The environment files are parsed once per run into a snapshot, which is
+used for every terraform command of that run. Files using more of the shell
+than variable assignments (with quoting and $NAME expansion) are evaluated
+by sh instead, once. The snapshot is not cached on disk, as the environment
+files have credentials (and are git-crypt encrypted).
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+
+COMMANDS = {'plan': 'tfplan', 'apply': 'tfapply', 'remote': 'tfremote'}
+
+USAGE = {
+    'plan': ['Usage: tfplan [-destroy] [-target=RESOURCE]... DEPLOY[.tfvars]',
+             " (if DEPLOY is omitted, defaults to current branch '{0}')"],
+    'apply': ['Usage: tfapply PLAN[.plan]',
+              " (if PLAN is omitted, defaults to current branch '{0}')"],
+    'remote': ['Usage: tfremote config [ORG_OR_USER/]DEPLOY',
+               '                | push | pull | status | disable',
+               " (if DEPLOY is omitted, defaults to current branch '{0}')",
+               " (if ORG_OR_USER is omitted, defaults to '{1}/')"],
+}
+
+# Default Atlas organization (or user) for tfremote
+ORG_USER = 'example'
+
+ATLAS_ENV = 'atlas.env'
+
+# Variables passed to terraform from the caller's environment (the rest of
+# its environment is from the environment files); OPTIONAL_ENV only if set
+PASSED_ENV = ('HOME', 'PATH', 'PWD', 'SHELL', 'TERM', 'USER',
+              'OS_USERNAME', 'OS_PASSWORD')
+OPTIONAL_ENV = ('TF_LOG', 'TF_LOG_PATH')
+
+# Buffer size for copying terraform output to log
+CHUNK_SIZE = 64 * 1024
+
+UNSTAGED_TF = re.compile(r'^([U?]|.[DMU]).*\.tf$')
+UNCOMMITTED_TF = re.compile(r'^([^ ]|.[^ ]).*\.tf$')
+VARIABLE = re.compile(r'\$(?:([A-Za-z_][A-Za-z0-9_]*)|'
+                      r'\{([A-Za-z_][A-Za-z0-9_]*)\})')
+ASSIGNMENT = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)(?:=(.*))?$', re.DOTALL)
+
+# Environment snapshots, keyed by environment files
+ENVIRONMENTS = {}
+
+
+def usage(command, message=None):
+    """Print usage (with error message) and exit.
+
+    :param command: command ('plan', 'apply' or 'remote')
+    :type command: str
+    :param message: error message
+    :type message: str
+    :raises SystemExit: always (exit code 1)
+    """
+    if message:
+        print('{0}: {1}'.format(COMMANDS[command], message), file=sys.stderr)
+    for line in USAGE[command]:
+        print(line.format(git_branch(), ORG_USER), file=sys.stderr)
+    raise SystemExit(1)
+
+
+def git_dir():
+    """Find Git directory of current directory.
+
+    :returns: Git directory
+    :returns: None if not in a Git repository
+    :rtype: str
+    """
+    directory = os.getcwd()
+    while True:
+        dot_git = os.path.join(directory, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):  # worktree or submodule
+            with open(dot_git) as dot_git_file:
+                text = dot_git_file.read().strip()
+            if text.startswith('gitdir:'):
+                return os.path.join(directory, text[len('gitdir:'):].strip())
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def git_branch():
+    """Get (last component of) current Git branch name.
+
+    The branch is read from HEAD; only if it is detached is git run, to
+    find a branch or tag for the commit.
+
+    :returns: branch name ('' if none)
+    :rtype: str
+    """
+    try:
+        directory = git_dir()
+        if directory is None:
+            return ''
+        with open(os.path.join(directory, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+    except (IOError, OSError):
+        return ''
+    if head.startswith('ref:'):
+        return head[len('ref:'):].strip().split('/')[-1]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            name = subprocess.check_output(
+                ['git', 'describe', '--all', '--exact-match'], stderr=devnull
+            ).decode('utf-8', 'replace').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return name.split('/')[-1]
+
+
+def git_status(pattern):
+    """Get `git status --porcelain` lines matching a pattern.
+
+    :param pattern: line pattern
+    :type pattern: re.RegexObject
+    :returns: matching lines (none if not in a Git repository)
+    :rtype: list(str)
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.check_output(
+                ['git', 'status', '--porcelain'], stderr=devnull
+            ).decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [line for line in status.splitlines() if pattern.match(line)]
+
+
+def expand(text, pos, env):
+    """Expand a shell variable reference.
+
+    :param text: shell text
+    :type text: str
+    :param pos: position of '$' in text
+    :type pos: int
+    :param env: variables
+    :type env: dict
+    :returns: expansion, and position after the reference
+    :rtype: tuple(str, int)
+    :raises ValueError: if the reference is not $NAME or ${NAME}
+    """
+    match = VARIABLE.match(text, pos)
+    if match is not None:
+        return env.get(match.group(1) or match.group(2), ''), match.end()
+    if text[pos + 1:pos + 2] in ('', ' ', '\t', '\n', '"'):
+        return '$', pos + 1
+    raise ValueError('unsupported expansion')
+
+
+def shell_words(line, env):
+    """Split a line into words as sh does (for variable assignments only).
+
+    :param line: shell text
+    :type line: str
+    :param env: variables (for $NAME and ${NAME})
+    :type env: dict
+    :returns: words
+    :rtype: list(str)
+    :raises ValueError: for anything else sh would interpret differently,
+                        e.g. command substitution or unterminated quotes
+    """
+    words = []
+    word = None
+    pos = 0
+    while pos < len(line):
+        char = line[pos]
+        if char in ' \t\n':
+            if word is not None:
+                words.append(word)
+                word = None
+            pos += 1
+            continue
+        if char == '#' and word is None:
+            break
+        word = word or ''
+        if char == "'":
+            end = line.find("'", pos + 1)
+            if end < 0:
+                raise ValueError('unterminated quote')
+            word += line[pos + 1:end]
+            pos = end + 1
+        elif char == '"':
+            pos += 1
+            while line[pos:pos + 1] != '"':
+                char = line[pos:pos + 1]
+                if char in ('', '`'):
+                    raise ValueError('unterminated quote or substitution')
+                if char == '\\' and line[pos + 1:pos + 2] in '$`"\\':
+                    word += line[pos + 1]
+                    pos += 2
+                elif char == '$':
+                    (text, pos) = expand(line, pos, env)
+                    word += text
+                else:
+                    word += char
+                    pos += 1
+            pos += 1
+        elif char == '\\' and pos + 1 < len(line) and line[pos + 1] != '\n':
+            word += line[pos + 1]
+            pos += 2
+        elif char == '$':
+            (text, pos) = expand(line, pos, env)
+            word += text
+        elif char in '\\`;&|<>()~*?[':
+            raise ValueError('unsupported shell syntax')
+        else:
+            word += char
+            pos += 1
+    if word is not None:
+        words.append(word)
+    return words
+
+
+def shell_env(script, base):
+    """Evaluate environment script with sh.
+
+    :param script: shell script (export commands)
+    :type script: str
+    :param base: initial environment
+    :type base: dict
+    :returns: environment after evaluating script
+    :rtype: dict
+    """
+    import json
+    output = subprocess.check_output(
+        ['sh', '-c', 'eval "$1"; exec "$2" -c "import json, os; '
+         'print(json.dumps(dict(os.environ)))"', 'sh', script,
+         sys.executable], env=base)
+    return dict((str(name), str(value)) for (name, value) in
+                json.loads(output.decode('utf-8')).items())
+
+
+def terraform_env(filenames):
+    """Get environment for terraform, from environment files.
+
+    The environment has the PASSED_ENV (and OPTIONAL_ENV) variables, with
+    the variables exported by each line of the files (as with `export LINE`
+    in sh) in order; it is only made once for the same files.
+
+    :param filenames: environment files
+    :type filenames: list(str)
+    :returns: environment
+    :rtype: dict
+    """
+    key = tuple(filenames)
+    if key in ENVIRONMENTS:
+        return ENVIRONMENTS[key]
+    base = dict((name, os.environ.get(name, '')) for name in PASSED_ENV)
+    base['PWD'] = os.getcwd()
+    base.update((name, os.environ[name]) for name in OPTIONAL_ENV
+                if name in os.environ)
+    lines = []
+    for filename in filenames:
+        try:
+            with open(filename) as env_file:
+                lines.extend(env_file.readlines())
+        except IOError as err:
+            print(err, file=sys.stderr)
+    env = dict(base)
+    try:
+        for line in lines:
+            for word in shell_words(line, env):
+                match = ASSIGNMENT.match(word)
+                if match is None:
+                    raise ValueError('not an assignment')
+                if match.group(2) is not None:
+                    env[match.group(1)] = match.group(2)
+    except ValueError:  # more than assignments, let sh evaluate it
+        env = shell_env(''.join('export ' + line for line in lines), base)
+    env = dict((str(name), str(value)) for (name, value) in env.items())
+    ENVIRONMENTS[key] = env
+    return env
+
+
+def deployment_env(deployment):
+    """Get environment for terraform for a deployment.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: environment from *.env and DEPLOY.tfenv files
+    :rtype: dict
+    """
+    filenames = sorted(glob.glob('*.env'))
+    if os.path.isfile(deployment + '.tfenv'):
+        filenames.append(deployment + '.tfenv')
+    return terraform_env(filenames)
+
+
+def terraform(args, env, log=None, append=False):
+    """Run terraform (copying its output to a log file).
+
+    :param args: terraform arguments
+    :type args: list(str)
+    :param env: environment
+    :type env: dict
+    :param log: log filename for output (like tee)
+    :type log: str
+    :param append: append to log file
+    :type append: bool
+    :returns: exit code of terraform
+    :rtype: int
+    """
+    command = [str('terraform')] + [str(arg) for arg in args]
+    sys.stdout.flush()
+    try:
+        if log is None:
+            return subprocess.call(command, env=env)
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+    except OSError as err:
+        print('terraform: {0}'.format(err), file=sys.stderr)
+        return 127
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    with open(log, 'ab' if append else 'wb') as log_file:
+        data = os.read(process.stdout.fileno(), CHUNK_SIZE)
+        while data:
+            output.write(data)
+            output.flush()
+            log_file.write(data)
+            data = os.read(process.stdout.fileno(), CHUNK_SIZE)
+    process.stdout.close()
+    return process.wait()
+
+
+def timed(phase, function, *args, **kwargs):
+    """Run function returning an exit code, recording its timing.
+
+    :param phase: phase name
+    :type phase: str
+    :param function: function (returning exit code)
+    :type function: function
+    :param args: function arguments
+    :returns: exit code
+    :rtype: int
+    """
+    import phasetime
+    start = time.time()
+    status = 1
+    try:
+        status = function(*args, **kwargs)
+        return status
+    finally:
+        phasetime.record(phase, time.time() - start, status)
+
+
+def remote_name():
+    """Get Atlas remote name, exiting as getremote.py if state is invalid.
+
+    :returns: remote name (None if state is local)
+    :rtype: str
+    """
+    import getremote
+    import phasetime
+    start = time.time()
+    try:
+        name = getremote.name()
+    except ValueError:
+        phasetime.record('getremote', time.time() - start, 1)
+        raise SystemExit(getremote.main())  # outputs the error
+    # bytes read from state are for this phase, not for the whole run
+    (nbytes, phasetime.BYTES[0]) = (phasetime.BYTES[0], None)
+    phasetime.record('getremote', time.time() - start,
+                     0 if name is not None else 2, nbytes)
+    return name
+
+
+def set_deployment(deployment):
+    """Set deployment for timing records (and helpers) and profiles.
+
+    :param deployment: deployment name
+    :type deployment: str
+    """
+    import phasetime
+    os.environ[str(phasetime.DEPLOYMENT_ENV)] = str(deployment)
+
+
+def lock_deployment(deployment):
+    """Lock deployment against concurrent plan/apply (see tfmulti.lock).
+
+    :param deployment: deployment name
+    :type deployment: str
+    :returns: open lock file (closing it releases the lock)
+    :returns: None if tfmulti running this command holds the lock
+    :rtype: file
+    :raises SystemExit: if deployment is locked (exit code 1)
+    """
+    import tfmulti
+    if os.environ.get(tfmulti.LOCKED_ENV) == deployment:
+        return None
+    lock_file = tfmulti.lock(deployment)
+    if lock_file is None:
+        print("Deployment '{0}' is locked by another plan/apply".format(
+            deployment))
+        raise SystemExit(1)
+    return lock_file
+
+
+def run_preflight():
+    """Run pre-flight checks (see preflight.py).
+
+    :returns: exit code (0 if checks passed)
+    :rtype: int
+    """
+    import preflight
+    try:
+        result = preflight.preflight()
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    preflight.report(result)
+    return 0 if result['passed'] else 1
+
+
+def make_userdata():
+    """Make the userdata files referenced by *.tf files (with Makefile).
+
+    :returns: exit code of make (0 if there are none)
+    :rtype: int
+    """
+    import planfingerprint
+    names = set()
+    for filename in glob.glob('*.tf'):
+        with open(filename, 'rb') as tf_file:
+            names.update(name.decode('utf-8') for name in
+                         planfingerprint.USERDATA.findall(tf_file.read()))
+    if not names:
+        return 0
+    # writemime.py cache leaves unchanged userdata files untouched
+    return subprocess.call(['make', 'userdata', str('USERDATA_FILES=' +
+                                                    ' '.join(sorted(names)))])
+
+
+def check_reuse(plan, deployment, options, statefile):
+    """Check whether a plan can be reused (see planfingerprint.py).
+
+    :param plan: plan filename (latest.plan or destroy.plan)
+    :type plan: str
+    :param deployment: deployment name
+    :type deployment: str
+    :param options: tfplan -target and -destroy options
+    :type options: list(str)
+    :param statefile: state file
+    :type statefile: str
+    :returns: exit code (0 if plan can be reused)
+    :rtype: int
+    """
+    import planfingerprint
+    try:
+        changed = planfingerprint.reuse(plan, deployment, options, statefile)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    if changed:
+        print('Not reusing plan: ' + ', '.join(changed), file=sys.stderr)
+        return 1
+    return 0
+
+
+def show_log(deployment, kind, stamp):
+    """Output stored log of a run (see artifacts.py).
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param kind: 'plan' or 'apply'
+    :type kind: str
+    :param stamp: plan timestamp
+    :type stamp: str
+    """
+    import artifacts
+    import zlib
+    try:
+        records = artifacts.find(artifacts.read_index(deployment), kind,
+                                 stamp=stamp)
+        if not records:
+            print('no matching runs', file=sys.stderr)
+            return
+        sys.stdout.flush()
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+        artifacts.write_log(deployment, records[-1], output)
+        output.flush()
+    except (IOError, OSError, zlib.error) as err:
+        print(err, file=sys.stderr)
+
+
+def store(deployment, kind, stamp, status, base, plan, targets):
+    """Store log and plan of a run (see artifacts.py).
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param kind: 'plan' or 'apply'
+    :type kind: str
+    :param stamp: plan timestamp
+    :type stamp: str
+    :param status: exit code of terraform
+    :type status: int
+    :param base: plan filename without .plan (for BASE.log)
+    :type base: str
+    :param plan: plan filename
+    :type plan: str
+    :param targets: -target options
+    :type targets: list(str)
+    :returns: exit code (0 if stored)
+    :rtype: int
+    """
+    import artifacts
+    try:
+        artifacts.put(deployment, kind, stamp, status, base + '.log', plan,
+                      targets)
+    except (IOError, OSError) as err:
+        print(err, file=sys.stderr)
+        return 1
+    return 0
+
+
+def remove(*filenames):
+    """Remove files, if they exist.
+
+    :param filenames: filenames
+    :type filenames: str
+    """
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def tfplan(args):
+    """Make a Terraform plan (tfplan).
+
+    :param args: tfplan arguments
+    :type args: list(str)
+    :returns: exit code (0 if no changes, 1 on error, 2 if changes)
+    :rtype: int
+    """
+    remote = remote_name()
+    options = []
+    targets = []
+    query = {}
+    prepare = False
+    refresh = ''
+    deployment = ''
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-destroy':
+            options.append(arg)
+        elif arg == '-prepare':
+            prepare = True
+        elif arg in ('-refresh=true', '-refresh=false'):
+            refresh = arg
+        elif arg.startswith('-target='):
+            targets.append(arg)
+        elif arg.startswith(('-target-type=', '-target-module=',
+                             '-target-id=')):
+            (option, value) = arg[len('-target-'):].split('=', 1)
+            query['--' + option] = value
+        elif arg.startswith('--') and '=' in arg:
+            # attempt to accomodate users used to --options
+            print("[ATTENTION! fix '{0}' to terraform '{1}']".format(
+                arg.split('=')[0], arg[1:].split('=')[0]), file=sys.stderr)
+            args.insert(0, arg[1:])
+        elif arg.startswith('--'):
+            usage('plan', "bad option '{0}' - use '{1}' or '{1}=...'".format(
+                arg, arg[1:]))
+        elif arg.startswith('-target') or arg == '-refresh':
+            usage('plan', "bad option '{0}' - use '{0}=...'".format(arg))
+        elif arg.startswith('-'):
+            usage('plan', "bad option '{0}'".format(arg))
+        elif re.match(r'.*\.([^t]|.*[^fvars]$)', arg, re.DOTALL):
+            usage('plan', "deployment '{0}' is not a .tfvars file".format(arg))
+        elif not deployment:
+            deployment = arg
+        else:
+            usage('plan')
+    if not deployment:
+        deployment = git_branch()
+        if not deployment or not os.path.isfile(deployment + '.tfvars'):
+            usage('plan')
+
+    deployment = re.sub(r'\.tfvars$', '', deployment)
+    set_deployment(deployment)
+    stamp = time.strftime('%Y%m%d-%H%M%S') + ' '.join(options)
+    base = os.path.join(deployment, stamp)
+
+    if not os.path.isfile(deployment + '.tfvars'):
+        usage('plan', "there is no '{0}.tfvars' file".format(deployment))
+
+    if remote is not None and remote.split('/', 1)[1] != deployment:
+        print("Configured to use different remote '{0}' - use tfremote "
+              "disable".format(remote))
+        print(" (or if remote for it exists: tfremote config '{0}')".format(
+            deployment))
+        return 1
+
+    # state file actually used by terraform (remote state is in .terraform)
+    livestate = os.path.join(deployment, 'terraform.tfstate')
+    if remote is not None:
+        livestate = os.path.join('.terraform', 'terraform.tfstate')
+
+    # (-prepare only runs the steps shared by all deployments)
+    lock_file = None if prepare else lock_deployment(deployment)
+    if query:
+        targets.extend(timed_query(livestate, query))
+
+    cleanup = 'all'  # what is removed on exit (like a shell exit trap)
+    try:
+        status = plan_run(deployment, base, stamp, options, targets, refresh,
+                          prepare, remote is not None, livestate)
+        if status in (0, 2):
+            cleanup = 'rmdir'
+        elif status is None:  # plan reused
+            cleanup = None
+            status = 2
+        return status
+    finally:
+        if cleanup == 'all':
+            remove(*(base + ext for ext in
+                     ('.plan', '.targets', '.log', '.fingerprint')))
+        if cleanup is not None:
+            try:
+                os.rmdir(deployment)
+            except OSError:
+                pass
+        if lock_file is not None:
+            lock_file.close()
+
+
+def timed_query(livestate, query):
+    """Get -target options for resources in state matching tfplan query.
+
+    :param livestate: state file
+    :type livestate: str
+    :param query: stateindex.py query options (e.g. '--type') and values
+    :type query: dict
+    :returns: -target options
+    :rtype: list(str)
+    :raises SystemExit: if no resources match
+    """
+    import phasetime
+    import stateindex
+    start = time.time()
+    entries = []
+    try:
+        # index is only rebuilt when the state changes
+        entries = stateindex.query(
+            stateindex.index_file(livestate), None, query.get('--type'),
+            query.get('--module'), query.get('--id'))
+    except ValueError as err:
+        if str(err).endswith("'"):
+            print(err, file=sys.stderr)
+        else:
+            print("{0}: '{1}'".format(err, livestate), file=sys.stderr)
+    phasetime.record('query', time.time() - start, 0 if entries else 2)
+    if not entries:
+        usage('plan', "no resources in '{0}' match {1}".format(
+            livestate, ' '.join('{0}={1}'.format(option, value)
+                                for (option, value) in sorted(query.items()))))
+    return ['-target=' + entry[stateindex.ADDRESS] for entry in entries]
+
+
+def get_modules(env):
+    """Get modules, linking cached git modules first (see modcache.py).
+
+    :param env: environment
+    :type env: dict
+    :returns: exit code of terraform get
+    :rtype: int
+    """
+    import modcache
+    import phasetime
+    args = ['get', '-update']
+    if modcache.cache_dir():
+        start = time.time()
+        status = 1
+        try:
+            # other remote modules still need -update (which would replace
+            # the linked modules)
+            if modcache.link_modules(env=env):
+                args = ['get']
+            status = 0
+        except ValueError as err:
+            print('module cache: {0}'.format(err), file=sys.stderr)
+        phasetime.record('module-cache', time.time() - start, status)
+    return terraform(args, env)
+
+
+def plan_run(deployment, base, stamp, options, targets, refresh, prepare,
+             is_remote, livestate):
+    """Run checks, userdata, terraform get, refresh and plan for tfplan.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param base: plan filename without .plan
+    :type base: str
+    :param stamp: plan timestamp
+    :type stamp: str
+    :param options: -destroy option (if given)
+    :type options: list(str)
+    :param targets: -target options
+    :type targets: list(str)
+    :param refresh: -refresh=true or -refresh=false option (or '')
+    :type refresh: str
+    :param prepare: only run the steps shared by all deployments
+    :type prepare: bool
+    :param is_remote: state is remote
+    :type is_remote: bool
+    :param livestate: state file actually used by terraform
+    :type livestate: str
+    :returns: exit code of terraform plan (None if previous plan reused)
+    :rtype: int
+    """
+    import phasetime
+    prepared = bool(os.environ.get('TFPLAN_PREPARED'))
+
+    # Git staging and pre-commit (private key/merge conflict) checks, only
+    # for files changed since they last passed
+    if not prepared and timed('preflight', run_preflight):
+        return 1
+    if not prepared and os.path.isfile('Makefile'):
+        timed('userdata', make_userdata)
+
+    if '-destroy' in options:
+        lastplan = os.path.join(deployment, 'destroy.plan')
+    else:
+        lastplan = os.path.join(deployment, 'latest.plan')
+    if (not prepare and os.path.islink(lastplan) and
+            refresh != '-refresh=true' and
+            timed('reuse-check', check_reuse, lastplan, deployment,
+                  options + targets, livestate) == 0):
+        show_log(deployment, 'plan',
+                 re.sub(r'\.plan$', '', os.readlink(lastplan)))
+        print("Inputs unchanged, reusing plan '{0}' (use -refresh=true".format(
+            lastplan))
+        print(' to make a new plan)')
+        return None
+
+    env = deployment_env(deployment)
+
+    # default get + refresh on a 'best-effort' basis
+    run_get = True
+    run_refresh = False
+    dont_fail = True
+    state = os.path.join(deployment, 'terraform.tfstate')
+    if refresh == '-refresh=false':
+        run_get = False
+    elif refresh == '-refresh=true':
+        dont_fail = False
+    else:
+        run_refresh = os.path.exists(state) or is_remote
+        refresh = '-refresh=false'
+    if prepared:
+        run_get = False
+    # (maybe) get modules and refresh state
+    if run_get:
+        status = timed('get', get_modules, env)
+        if status and not dont_fail:
+            return status
+    if prepare:
+        return 0
+    if run_refresh:
+        status = timed('refresh', terraform, [
+            'refresh', '-var-file', deployment + '.tfvars', '-state=' + state
+        ] + targets, env)
+        if status and not dont_fail:
+            return status
+
+    if not os.path.isdir(deployment):
+        os.makedirs(deployment)
+    with open(base + '.targets', 'w') as targets_file:
+        targets_file.write(''.join(target + '\n' for target in targets))
+
+    # fingerprint of inputs after refresh, as used for this plan
+    timed('fingerprint', write_fingerprint, base + '.plan', deployment,
+          options + targets, livestate)
+
+    start = time.time()
+    status = terraform(['plan'] + options + [
+        '-module-depth=-1', '-var-file', deployment + '.tfvars',
+        '-state=' + state, '-out', base + '.plan', '-detailed-exitcode'
+    ] + ([refresh] if refresh else []), env, base + '.log')
+    # (no log if terraform could not be run)
+    logged = os.path.exists(base + '.log')
+    phasetime.record('plan', time.time() - start, status,
+                     os.path.getsize(base + '.log') if logged else None)
+
+    if logged and timed('store', store, deployment, 'plan', stamp, status,
+                        base, base + '.plan', targets) == 0:
+        remove(base + '.log')
+
+    # exit code 2 == "succeeded with non-empty diff (changes present)"
+    if status == 2:
+        for ext in ('.plan', '.targets', '.fingerprint'):
+            if os.path.exists(base + ext) and not os.path.getsize(base + ext):
+                remove(base + ext)
+        if '-destroy' in stamp:
+            (old, new) = ('latest.plan', 'destroy.plan')
+        else:
+            (old, new) = ('destroy.plan', 'latest.plan')
+        remove(os.path.join(deployment, old), os.path.join(deployment, new))
+        os.symlink(stamp + '.plan', os.path.join(deployment, new))
+    elif status == 0:
+        # plan without changes is only kept in artifact store
+        remove(*(base + ext for ext in ('.plan', '.targets', '.fingerprint')))
+        remove(os.path.join(deployment, 'latest.plan'),
+               os.path.join(deployment, 'destroy.plan'))
+    return status
+
+
+def write_fingerprint(plan_name, deployment, options, statefile):
+    """Write fingerprint of plan inputs (see planfingerprint.py).
+
+    :param plan_name: plan filename
+    :type plan_name: str
+    :param deployment: deployment name
+    :type deployment: str
+    :param options: tfplan -target and -destroy options
+    :type options: list(str)
+    :param statefile: state file
+    :type statefile: str
+    :returns: exit code (0 if written)
+    :rtype: int
+    """
+    import planfingerprint
+    try:
+        planfingerprint.save(plan_name, planfingerprint.fingerprint(
+            deployment, options, statefile))
+    except IOError as err:
+        print(err, file=sys.stderr)
+        return 1
+    return 0
+
+
+def tfapply(args):
+    """Apply a previously created Terraform plan (tfapply).
+
+    :param args: tfapply arguments
+    :type args: list(str)
+    :returns: exit code of terraform apply
+    :rtype: int
+    """
+    remote = remote_name()
+    if not args:
+        plan_name = git_branch()
+        if not plan_name or not os.path.isdir(plan_name):
+            usage('apply')
+        plan_name = os.path.join(plan_name, 'latest.plan')
+    elif args[0].startswith('-'):
+        usage('apply')
+    elif re.match(r'.*\.([^p]|.*[^lan]$)', args[0], re.DOTALL):
+        usage('apply', "plan '{0}' is not a .plan file".format(args[0]))
+    else:
+        plan_name = args[0]
+    if len(args) > 1:
+        usage('apply')
+
+    if (not plan_name.endswith('.plan') and not os.path.isfile(plan_name) and
+            not os.path.isfile(plan_name + '.plan') and
+            os.path.islink(os.path.join(plan_name, 'latest.plan'))):
+        plan_name = os.path.join(plan_name, 'latest.plan')
+    if os.path.islink(plan_name):
+        plan_file = os.path.join(os.path.dirname(plan_name),
+                                 os.readlink(plan_name))
+    elif os.path.isfile(plan_name):
+        plan_file = plan_name
+    else:
+        usage('apply', "there is no '{0}' file".format(plan_name))
+    base = re.sub(r'\.plan$', '', plan_file)
+
+    deployment = plan_name.split('/')[0]
+    set_deployment(deployment)
+    try:
+        with open(base + '.targets') as targets_file:
+            targets = targets_file.read().split()
+    except IOError:
+        targets = []
+
+    if remote is not None and remote.split('/', 1)[1] != deployment:
+        print("Configured to use different remote '{0}' - use tfremote "
+              "disable".format(remote))
+        print(" (or if remote for it exists: tfremote config '{0}')".format(
+            deployment))
+        return 1
+
+    lock_file = lock_deployment(deployment)
+    try:
+        return apply_run(deployment, plan_name, plan_file, targets)
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+
+def apply_run(deployment, plan_name, plan_file, targets):
+    """Run git check, terraform apply and store its artifacts for tfapply.
+
+    :param deployment: deployment name
+    :type deployment: str
+    :param plan_name: plan filename (or latest.plan link) given to tfapply
+    :type plan_name: str
+    :param plan_file: plan filename
+    :type plan_file: str
+    :param targets: -target options of plan
+    :type targets: list(str)
+    :returns: exit code of terraform apply
+    :rtype: int
+    """
+    import phasetime
+    base = re.sub(r'\.plan$', '', plan_file)
+    stamp = os.path.basename(base)
+
+    # Git commit check
+    start = time.time()
+    uncommitted = git_status(UNCOMMITTED_TF)
+    phasetime.record('git-check', time.time() - start, 1 if uncommitted else 0)
+    if uncommitted:
+        print('\n'.join(uncommitted))
+        print('uncommitted .tf files; use `git commit` or `git stash -u` first')
+        return 1
+
+    env = deployment_env(deployment)
+    start = time.time()
+    status = terraform(['apply', '-state=' + os.path.join(
+        deployment, 'terraform.tfstate')] + targets + [plan_file], env,
+                       base + '.log', append=True)
+    # (no log if terraform could not be run, and there was no plan log)
+    logged = os.path.exists(base + '.log')
+    phasetime.record('apply', time.time() - start, status,
+                     os.path.getsize(base + '.log') if logged else None)
+
+    stored = logged and timed('store', store, deployment, 'apply', stamp,
+                              status, base, plan_file, targets) == 0
+    if logged and not stored:
+        # artifact store not writable, keep log and failed plan as before
+        with open(base + '.log', 'rb') as log_file:
+            with open(os.path.join(deployment, 'terraform.log'),
+                      'ab') as terraform_log:
+                terraform_log.write(log_file.read())
+    remove(base + '.targets', base + '.log', base + '.fingerprint')
+    if status == 0:
+        pass
+    elif stored:
+        import artifacts
+        records = artifacts.find(artifacts.read_index(deployment), 'apply',
+                                 stamp=stamp)
+        if records and records[-1]['plan'] is not None:
+            print('Failed plan stored as ' + artifacts.store_path(
+                deployment, artifacts.PLANS, records[-1]['plan'] + '.plan'))
+    else:
+        os.rename(plan_file, base + '.failed')
+    remove(plan_name, plan_file)
+    if status == 0:
+        try:
+            os.rmdir(deployment)
+        except OSError:
+            pass
+    return status
+
+
+def remote_version(remote, env):
+    """Get version of remote state (see statecache.py), timed as 'state-check'.
+
+    :param remote: remote name
+    :type remote: str
+    :param env: environment (with atlas.env variables)
+    :type env: dict
+    :returns: lineage and serial (None if unknown, with a message)
+    :rtype: tuple(str, int)
+    """
+    import phasetime
+    import statecache
+    start = time.time()
+    try:
+        version = statecache.remote_version(remote, env)
+    except ValueError as err:
+        phasetime.record('state-check', time.time() - start, 1)
+        print('state cache: remote serial unknown: {0}'.format(err),
+              file=sys.stderr)
+        return None
+    phasetime.record('state-check', time.time() - start, 0)
+    return version
+
+
+def local_version():
+    """Get version of local copy of remote state.
+
+    :returns: lineage and serial (None if there is no local copy)
+    :rtype: tuple(str, int)
+    """
+    import statecache
+    try:
+        return statecache.file_version(statecache.TF_STATE)
+    except ValueError:
+        return None
+
+
+def cache_state(remote):
+    """Save local copy of remote state in state cache (errors are reported).
+
+    :param remote: remote name
+    :type remote: str
+    """
+    import statecache
+    try:
+        statecache.save(remote, statecache.TF_STATE)
+    except ValueError as err:
+        print('state cache: {0}'.format(err), file=sys.stderr)
+
+
+def tfremote(args):
+    """Manage Atlas remote state configuration (tfremote).
+
+    :param args: tfremote arguments
+    :type args: list(str)
+    :returns: exit code
+    :rtype: int
+    """
+    import getremote
+    import phasetime
+    import statecache
+    remote = remote_name()
+    command = args[0] if args else ''
+    if command == '':
+        if remote is not None:
+            print(remote)
+        usage('remote')
+    elif command.startswith('-'):
+        usage('remote', "bad option '{0}'".format(command))
+    elif command not in ('push', 'pull', 'disable', 'status', 'enable',
+                         'config'):
+        usage('remote', "unknown argument '{0}'".format(command))
+    # this will save remote state in $LOCAL/terraform.tfstate.remote when
+    # disabling it in one environment before switching to another
+    # environment, where that environment's saved remote state will be
+    # deleted after a successful remote pull.
+    rem_ext = '.remote' if command == 'config' else ''
+    if len(args) > (2 if command == 'config' else 1):
+        usage('remote')
+
+    if command in ('push', 'pull'):
+        if remote is None:
+            usage('remote', 'tfremote {0} requires tfremote config '
+                  'first'.format(command))
+        env = dict(os.environ)
+        env.update(terraform_env([ATLAS_ENV]))
+        # nothing to transfer if the local copy has the remote version (and,
+        # for push, is the cached copy of it, so has no local changes)
+        version = remote_version(remote, env)
+        if version is not None and version == local_version() and (
+                command == 'pull' or statecache.is_cached(
+                    remote, statecache.TF_STATE)):
+            print("Remote state '{0}' serial {1} unchanged, not {2}ed "
+                  '(state cache hit)'.format(remote, version[1], command))
+            if command == 'pull':
+                cache_state(remote)
+            return 0
+        status = timed(command, terraform, ['remote', command], env)
+        if status == 0:
+            cache_state(remote)
+        return status
+    if command == 'status':
+        if remote is None:
+            print('Using local state')
+            return 1
+        print(remote)
+        (org, env_name) = remote.split('/', 1)
+        print('https://atlas.hashicorp.com/{0}/environments/{1}/'
+              'changes'.format(org, env_name))
+        env = dict(os.environ)
+        env.update(terraform_env([ATLAS_ENV]))
+        version = remote_version(remote, env)
+        if version is not None:
+            if version == local_version():
+                cached = 'local copy is up to date (state cache hit)'
+            elif [entry for entry in statecache.entries(remote)
+                  if entry[:2] == (version[1], version[0])]:
+                cached = 'cached copy (state cache hit)'
+            else:
+                cached = 'not cached (state cache miss)'
+            print('Remote serial {0}{1}: {2}'.format(
+                version[1], ' lineage ' + version[0] if version[0] else '',
+                cached))
+        return 0
+
+    deployment = args[1] if len(args) > 1 else ''
+    if not deployment and command != 'disable':
+        deployment = git_branch()
+        if not deployment or not os.path.isfile(deployment + '.tfvars'):
+            usage('remote')
+    if deployment and '/' not in deployment:
+        deployment = ORG_USER + '/' + deployment
+    set_deployment(deployment.split('/', 1)[-1])
+
+    if remote is not None and remote == deployment:
+        print("Already configured to use remote '{0}'".format(remote))
+        return 0
+
+    if command == 'enable' and remote is not None:
+        print('Different remote state already enabled', file=sys.stderr)
+        print("current state '{0}' != branch remote '{1}'".format(
+            remote, deployment), file=sys.stderr)
+        return 1
+    if command in ('disable', 'config'):
+        if remote is not None:
+            local = remote.split('/', 1)[1]
+            if not os.path.isdir(local):
+                os.makedirs(local)
+            env = dict(os.environ)
+            env.update(terraform_env([ATLAS_ENV]))
+            # pull first (unless the local copy has the remote version) so
+            # that the state is cached before disabling, which then does not
+            # need to pull (the default is -pull=true)
+            version = remote_version(remote, env)
+            if version is not None and version == local_version():
+                print("Remote state '{0}' serial {1} unchanged, not pulled "
+                      '(state cache hit)'.format(remote, version[1]))
+                status = 0
+            else:
+                status = timed('pull', terraform, ['remote', 'pull'], env)
+            if status == 0:
+                cache_state(remote)
+                status = timed('disable', terraform, [
+                    'remote', 'config', '-disable', '-pull=false', '-state',
+                    os.path.join(local, 'terraform.tfstate' + rem_ext)], env)
+            if status == 0:
+                status = getremote.main()  # 2 (and message) if now local
+            status = 0 if status == 2 else 1
+            if status != 0 or command != 'config':
+                return status
+        elif command == 'disable':
+            print('remote state already disabled', file=sys.stderr)
+            return 0
+
+    # Git staging check
+    start = time.time()
+    unstaged = git_status(UNSTAGED_TF)
+    phasetime.record('git-check', time.time() - start, 1 if unstaged else 0)
+    if unstaged:
+        print('\n'.join(unstaged))
+        print('unstaged .tf files; use `git add *.tf` or `git stash -u` first')
+        return 1
+
+    local = deployment.split('/', 1)[1]
+    if not os.path.isdir(local):
+        os.makedirs(local)
+    # a cached copy of the remote version is used instead of a pull, unless
+    # there is local state for terraform to upload (or a local copy)
+    env = terraform_env([ATLAS_ENV])
+    restored = None
+    if not os.path.exists(os.path.join(local, 'terraform.tfstate')) and (
+            not os.path.exists(statecache.TF_STATE)):
+        version = remote_version(deployment, env)
+        if version is not None:
+            try:
+                restored = statecache.restore(deployment, version,
+                                              statecache.TF_STATE)
+            except ValueError as err:
+                print('state cache: {0}'.format(err), file=sys.stderr)
+    if restored is not None:
+        print("Remote state '{0}' serial {1} restored from '{2}' "
+              '(state cache hit)'.format(deployment, version[1], restored))
+        status = 0
+    else:
+        # default is -pull=true
+        status = timed('config', terraform, [
+            'remote', 'config', '-backend-config=name=' + deployment,
+            '-state=' + os.path.join(local, 'terraform.tfstate')], env)
+        if status == 0:
+            cache_state(deployment)
+    if status == 0 and rem_ext:
+        remove(os.path.join(local, 'terraform.tfstate' + rem_ext))
+    if len(args) < 2:
+        remote_status = getremote.main()
+        if status == 0:
+            status = remote_status
+    return status
+
+
+def main():
+    """Run tfplan, tfapply or tfremote command.
+
+    :returns: Exit code of command
+    :rtype: int
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print('Usage: tftools.py {0} [ARG]...'.format(
+            '|'.join(sorted(COMMANDS))), file=sys.stderr)
+        return 1
+    import phasetime
+    command = sys.argv[1]
+    os.environ[str(phasetime.TIMINGS_ENV)] = str(os.environ.get(
+        phasetime.TIMINGS_ENV, phasetime.TIMINGS_DEFAULT))
+    os.environ[str(phasetime.COMMAND_ENV)] = str(COMMANDS[command])
+    os.environ[str(phasetime.DEPLOYMENT_ENV)] = str('')
+    function = {'plan': tfplan, 'apply': tfapply, 'remote': tfremote}
+    return phasetime.main_timed(
+        'total', lambda: function[command](sys.argv[2:]), COMMANDS[command])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,55 +1,242 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""Expand Base64-encoded data in MIME multipart userdata files for Git diff.
+"""Expand Base64 and quoted-printable data in MIME multipart userdata files.
 
-Only parts with MIME type 'text' are expanded; furthermore, boundary strings
-are normalized to '--==cloud-multi===='.
+Only parts with MIME type 'text' are expanded (for Git diff); furthermore,
+boundary strings are normalized to '--==cloud-multi====' (including the
+boundary parameter of the multipart Content-Type, as writemime.py --canonical
+boundaries vary).
+
+Gzip compressed userdata (writemime.py -z) is decompressed transparently.
+If $USERDATA_DECODE_CACHE is set (see CACHE_ENV), results are cached there
+by content hash, so that walking history with e.g. `git log -p` only decodes
+each userdata revision once; as decoded userdata can have secrets in plain
+text, there is no cache by default.
 """
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import base64
+import binascii
+import gzip
+import hashlib
+import io
+import os
 import re
+import shutil
 import sys
+import tempfile
 
 BOUNDARY = '--==cloud-multi===='
 
+# Buffer size for reading userdata (and writing decoded output)
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Environment variable for result cache directory (unset or empty for none)
+CACHE_ENV = 'USERDATA_DECODE_CACHE'
+
+# Cached results kept: the most recently used ones (`git log -p` over a long
+# history decodes many revisions)
+CACHE_ENTRIES = 256
+
+# Included in cache keys, so that changes in output invalidate cached results
+CACHE_VERSION = b'userdata_decode 3\n'
+
+BOUNDARY_LINE = re.compile(br'^--==')
+BOUNDARY_PARAM = re.compile(br'(; *boundary=")==[^"]*(")', re.IGNORECASE)
+CONTENT_TYPE = re.compile(br'^Content-Type: *([^/]+)/', re.IGNORECASE)
+CONTENT_BASE64 = re.compile(br'^Content-Transfer-Encoding: base64$',
+                            re.IGNORECASE)
+CONTENT_QP = re.compile(br'^Content-Transfer-Encoding: quoted-printable$',
+                        re.IGNORECASE)
+CODED = re.compile(br'^[A-Za-z0-9+/=]+$')
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def cache_dir():
+    """Get result cache directory.
+
+    :returns: $USERDATA_DECODE_CACHE (None if unset or empty: no cache)
+    :rtype: str
+    """
+    return os.environ.get(CACHE_ENV) or None
+
+
+def file_digest(filename, digest=None):
+    """Compute cache key (content hash) for a userdata file.
+
+    planfingerprint.py also uses this for the digests of plan inputs.
+
+    :param filename: userdata filename
+    :type filename: str
+    :param digest: hash to update (default: SHA-256 of CACHE_VERSION)
+    :type digest: hashlib hash object
+    :returns: hex digest
+    :rtype: str
+    :raises IOError: if the file cannot be read
+    """
+    if digest is None:
+        digest = hashlib.sha256(CACHE_VERSION)
+    with open(filename, 'rb') as input_file:
+        data = input_file.read(CHUNK_SIZE)
+        while data:
+            digest.update(data)
+            data = input_file.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def cache_evict(directory, entries=CACHE_ENTRIES):
+    """Remove all but the most recently used cached results.
+
+    Only files named by a hex digest are results (others are temporary files
+    being written); writemime.py also uses this for its cache.
+
+    :param directory: cache directory
+    :type directory: str
+    :param entries: cached results to keep
+    :type entries: int
+    """
+    names = []
+    for name in os.listdir(directory):
+        if DIGEST.match(name):
+            try:
+                names.append((os.path.getmtime(os.path.join(directory, name)),
+                              name))
+            except OSError:  # removed concurrently
+                pass
+    for (_, name) in sorted(names, reverse=True)[entries:]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def open_userdata(filename):
+    """Open userdata file for reading lines, decompressing gzip input.
+
+    :param filename: userdata filename
+    :type filename: str
+    :returns: buffered binary file object
+    :rtype: file
+    """
+    input_file = io.open(filename, 'rb', buffering=CHUNK_SIZE)
+    if input_file.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return io.BufferedReader(gzip.GzipFile(fileobj=input_file),
+                                 buffer_size=CHUNK_SIZE)
+    return input_file
+
+
+def decode(input_file, output_file):
+    """Write MIME multipart userdata with Base64 and quoted-printable expansion.
+
+    Base64 lines of text parts are collected and decoded as a single block
+    (per part, or up to a padded line) rather than line by line; the body
+    lines of quoted-printable text parts (writemime.py -O) are decoded one at
+    a time, as soft line breaks only join a line to the next.
+
+    :param input_file: binary file object with userdata
+    :type input_file: file
+    :param output_file: binary file object for expanded userdata
+    :type output_file: file
+    :raises ValueError: (binascii.Error) if Base64 data cannot be decoded
+    """
+    boundary = BOUNDARY.encode() + b'\n'
+    boundary_param = br'\g<1>' + BOUNDARY[2:].encode() + br'\2'
+    is_text = False
+    is_b64 = False
+    is_qp = False
+    in_body = False
+    coded = []
+    for line in input_file:
+        line_len = len(line)
+        if is_text and is_b64 and (line_len <= 77 and
+                                   0 == (line_len - 1) % 4 and
+                                   CODED.match(line) is not None):
+            coded.append(line)
+            if line.rstrip().endswith(b'='):
+                # padding ends a Base64 block, nothing can be joined after it
+                output_file.write(base64.b64decode(b''.join(coded)))
+                coded = []
+            continue
+
+        if coded:
+            output_file.write(base64.b64decode(b''.join(coded)))
+            coded = []
+
+        if BOUNDARY_LINE.match(line):
+            output_file.write(boundary)
+            in_body = False
+            continue
+
+        if in_body:
+            if is_text and is_qp:
+                line = binascii.a2b_qp(line)
+            output_file.write(line)
+            continue
+        if line == b'\n':  # end of headers
+            in_body = True
+
+        type_match = CONTENT_TYPE.match(line)
+        if type_match is not None:
+            main_type = type_match.group(1)
+            is_b64 = False
+            is_qp = False
+            is_text = main_type.lower() == b'text'
+            line = BOUNDARY_PARAM.sub(boundary_param, line)
+        elif CONTENT_BASE64.match(line):
+            is_b64 = True
+        elif CONTENT_QP.match(line):
+            is_qp = True
+
+        output_file.write(line)
+
+    if coded:
+        output_file.write(base64.b64decode(b''.join(coded)))
+
 
 def main():
-    """Print MIME multipart userdata files with Base64 expansion."""
+    """Print MIME multipart userdata files with Base64 (and QP) expansion."""
+    temp_name = None
     try:
         if len(sys.argv) != 2:
             raise ValueError('usage: ' + sys.argv[0] + ' USERDATA_FILE')
 
-        boundary = re.compile(r'^--==')
-        content_type = re.compile(r'^Content-Type: *([^/]+)/', re.IGNORECASE)
-        content_base64 = re.compile(r'^Content-Transfer-Encoding: base64$',
-                                    re.IGNORECASE)
-        coded = re.compile(r'^[A-Za-z0-9+/=]+$')
-        is_text = False
-        is_b64 = False
-        with open(sys.argv[1]) as input_file:
-            for line in input_file:
-                line_len = len(line)
-                if boundary.match(line):
-                    print(BOUNDARY)
-                elif is_text and is_b64 and (line_len <= 77 and
-                                             0 == (line_len - 1) % 4 and
-                                             coded.match(line) is not None):
-                    print(base64.b64decode(line).decode('utf-8'), end='')
+        if hasattr(sys.stdout, 'buffer'):
+            # We want to write bytes not strings
+            output_file = sys.stdout.buffer  # pylint: disable=E1101
+        else:
+            output_file = sys.stdout
+
+        cached = None
+        directory = cache_dir()
+        if directory is not None:
+            cached = os.path.join(directory, file_digest(sys.argv[1]))
+            try:
+                os.utime(cached, None)  # recently used (see cache_evict())
+            except OSError:
+                try:
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory, 0o700)  # not world readable
+                    (temp_fd, temp_name) = tempfile.mkstemp(dir=directory)
+                except (IOError, OSError):  # cache not writable, decode only
+                    cached = None
                 else:
-                    type_match = content_type.match(line)
-                    if type_match is not None:
-                        main_type = type_match.group(1)
-                        is_b64 = False
-                        if main_type.lower() == 'text':
-                            is_text = True
-                        else:
-                            is_text = False
-                    elif content_base64.match(line):
-                        is_b64 = True
-
-                    print(line, end='')
+                    with io.open(temp_fd, 'wb') as temp_file:
+                        with open_userdata(sys.argv[1]) as input_file:
+                            decode(input_file, temp_file)
+                    os.rename(temp_name, cached)
+                    temp_name = None
+                    cache_evict(directory)
+
+        if cached is not None:
+            with open(cached, 'rb') as cached_file:
+                shutil.copyfileobj(cached_file, output_file, CHUNK_SIZE)
+        else:
+            with open_userdata(sys.argv[1]) as input_file:
+                decode(input_file, output_file)
+        output_file.flush()
 
     except IOError as err:
         print(err, file=sys.stderr)
@@ -63,6 +250,10 @@ def main():
         print(err, file=sys.stderr)
         return 3
 
+    finally:
+        if temp_name is not None:
+            os.remove(temp_name)
+
     return 0
 
 
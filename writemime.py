@@ -12,14 +12,33 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import argparse
+import base64
+import binascii
+import codecs
+import filecmp
 import gzip
+import hashlib
+import io
+import json
 import mimetypes
+import multiprocessing
 import os
+import quopri
+import shlex
+import shutil
 import sys
+import tempfile
+import zlib
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.parser import Parser
+
+try:
+    import phasetime
+except ImportError:  # standalone (e.g. on an instance), no timing/profiling
+    phasetime = None
 
 MAPPINGS = {
     '#include': 'text/x-include-url',
@@ -34,10 +53,36 @@ MAPPINGS = {
 
 MIME_DEFTYPE = 'application/octet-stream'
 
+# Raw bytes read (and Base64 encoded) at a time when streaming part contents;
+# a multiple of 57 so that every chunk encodes to whole 76-character lines
+CHUNK_SIZE = 57 * 1024
+
+# Environment variable for default --cache directory (setting it rather than
+# passing --cache leaves the argument count, and so the boundary, unchanged)
+CACHE_ENV = 'WRITEMIME_CACHE'
+
+# Cached outputs (and target stamps) kept: the most recently used ones
+CACHE_ENTRIES = 64
+
+# Environment variable for default --limit, and its default: OpenStack
+# accepts user_data of at most 65535 bytes once it is Base64 encoded (as
+# Terraform does)
+LIMIT_ENV = 'WRITEMIME_LIMIT'
+LIMIT_DEFAULT = 65535
+
+# Longest line (without CRLF) allowed for 7bit and 8bit encodings (RFC 5322)
+MAX_LINE = 998
+
 # Preload some common script extensions into MIME types lookup
 for ext in ('sh', 'py', 'rb'):
     mimetypes.add_type('text/x-shellscript', '.' + ext, strict=False)
 
+# Python 2/3 compatibility
+try:
+    ENCODEBYTES = base64.encodebytes
+except AttributeError:
+    ENCODEBYTES = base64.encodestring  # pylint: disable=E1101
+
 
 # noinspection PyRedundantParentheses
 def try_decode(data):
@@ -54,17 +99,51 @@ def try_decode(data):
         return (False, data)
 
 
-def get_mimetype(filename, default_mime_type):
+def first_line(part_file):
+    """Read and decode the first line of a file in bounded memory.
+
+    Equivalent to try_decode(part_file.readline()), except that the line is
+    read CHUNK_SIZE bytes at a time and only as much of the decoded line is
+    kept as is needed to match MAPPINGS (so a large binary file without any
+    newlines is not read into memory whole).
+
+    :param part_file: binary file object positioned at start of file
+    :type part_file: file
+    :return: tuple with Unicode text indication and (prefix of) decoded line
+    :rtype: tuple(bool, str)
+    """
+    decoder = codecs.getincrementaldecoder(sys.getdefaultencoding())()
+    keep = max(len(start_str) for start_str in MAPPINGS)
+    line = ''
+    while True:
+        data = part_file.readline(CHUNK_SIZE)
+        final = len(data) < CHUNK_SIZE or data.endswith(b'\n')
+        try:
+            line = (line + decoder.decode(data, final))[:keep]
+        except UnicodeDecodeError:
+            # noinspection PyRedundantParentheses
+            return (False, data)
+        if final:
+            # noinspection PyRedundantParentheses
+            return (True, line)
+
+
+def get_mimetype(filename, default_mime_type, part_file=None):
     """Determine MIME type of file based on first line contents or extension.
 
     If no specific MIME type can be guessed, and the file is decodable UTF-8
     (or ASCII) text, the provided default mime type is used; for non-text files,
     application/octet-stream is returned.
 
+    If an open (binary) part_file is given, the first line is read from it and
+    it is rewound afterwards, rather than opening filename again.
+
     :param filename: filename to examine for MIME type
     :type filename: str
     :param default_mime_type: default type for text (decodable UTF-8) file
     :type default_mime_type: str
+    :param part_file: optional open binary file object for filename
+    :type part_file: file
     :return: MIME type for file
     :rtype: str
     """
@@ -74,9 +153,12 @@ def get_mimetype(filename, default_mime_type):
         mime_type = default_mime_type
     if encoding is not None:
         can_be_decoded = False
+    elif part_file is not None:
+        (can_be_decoded, line) = first_line(part_file)
+        part_file.seek(0)
     else:
         with open(filename, 'rb') as part_file:
-            (can_be_decoded, line) = try_decode(part_file.readline())
+            (can_be_decoded, line) = first_line(part_file)
 
     if can_be_decoded:
         # sorted_list is sorted longest first
@@ -121,6 +203,38 @@ def part_get_mimetype(part_name, default_mime_type, delimiter=':'):
     return (path, mime_type)
 
 
+def open_part(part_name, default_mime_type, delimiter=':'):
+    """Open the file for a part name argument and get its MIME type.
+
+    Like part_get_mimetype(), but the part file is opened (once) and returned,
+    so that it can be sniffed for a MIME type and then streamed from the same
+    file object by part_chunks().
+
+    :param part_name: part string with file path and optional MIME type suffix
+    :type part_name: str
+    :param default_mime_type: default MIME type for text (decodable UTF-8) file
+    :type default_mime_type: str
+    :param delimiter: delimiter separating suffix from path (default=':')
+    :type delimiter: str
+    :return: open binary part file, file path of part content, MIME type
+    :rtype: tuple(file, str, str)
+    :raises IOError: if the part file cannot be opened or read
+    """
+    argtype = part_name.split(delimiter, 1)
+    path = argtype[0]
+    part_file = open(path, 'rb')
+    try:
+        if len(argtype) > 1:
+            mime_type = argtype[1]
+        else:
+            mime_type = get_mimetype(path, default_mime_type, part_file)
+    except IOError:
+        part_file.close()
+        raise
+    # noinspection PyRedundantParentheses
+    return (part_file, path, mime_type)
+
+
 def add_part(body, path, mime_type=MIME_DEFTYPE, encode=None):
     """Add a message part to a multipart message body.
 
@@ -161,14 +275,469 @@ def add_part(body, path, mime_type=MIME_DEFTYPE, encode=None):
     body.attach(msg)
 
 
-def main():
-    """Generate MIME multi-part user-data file from specified parts.
+def text_encodings(text, charset):
+    """Encode text with each valid Content-Transfer-Encoding.
 
-    :raises IOError: (FileNotFoundError) when specified part file not found
-    :raises IOError: (PermissionError) when specified part file cannot be read
+    7bit (or 8bit, for non-ASCII text) is only valid if the text has no NUL
+    or CR characters, and no lines longer than MAX_LINE bytes.
+
+    :param text: part contents
+    :type text: str
+    :param charset: charset of part ('us-ascii' or 'utf-8')
+    :type charset: str
+    :return: encoding and encoded text, in order of preference
+    :rtype: list(tuple(str, str))
+    """
+    data = text.encode(charset)
+    encoded = []
+    if (b'\0' not in data and b'\r' not in data and
+            max(len(line) for line in data.split(b'\n')) <= MAX_LINE):
+        encoded.append(('7bit' if charset == 'us-ascii' else '8bit', text))
+    encoded.append(('quoted-printable', quopri.encodestring(data).decode()))
+    encoded.append(('base64', ENCODEBYTES(data).decode('ascii')))
+    return encoded
+
+
+def binary_encodings(data):
+    """Encode binary data with each valid Content-Transfer-Encoding.
+
+    Quoted-printable also encodes line breaks (as =0A and =0D), so that the
+    decoded part is exactly the data, as with Base64.
+
+    :param data: part contents
+    :type data: bytes
+    :return: encoding and encoded text, in order of preference
+    :rtype: list(tuple(str, str))
+    """
+    return [('base64', ENCODEBYTES(data).decode('ascii')),
+            ('quoted-printable',
+             binascii.b2a_qp(data, istext=False).decode('ascii'))]
+
+
+def smallest_encoding(encodings, compress=False):
+    """Choose the Content-Transfer-Encoding giving the smallest part.
+
+    :param encodings: encoding and encoded text, as from text_encodings() or
+                      binary_encodings() (the first of equal sizes is chosen)
+    :type encodings: list(tuple(str, str))
+    :param compress: compare sizes after compression (for gzip output)
+    :type compress: bool
+    :return: encoding and encoded text
+    :rtype: tuple(str, str)
     """
-    outer = MIMEMultipart(boundary='==cloud-multi' + ('==' * len(sys.argv)))
+    def size(encoding):
+        """Get (compressed) size of encoded text."""
+        data = encoding[1].encode('utf-8')
+        return len(zlib.compress(data, 9)) if compress else len(data)
+    return min(encodings, key=size)
+
+
+def header_block(msg):
+    """Flatten the headers of a message, including the blank separator line.
+
+    :param msg: message (or message part) to get headers for
+    :type msg: email.message.Message
+    :return: headers exactly as they appear in msg.as_string()
+    :rtype: str
+    """
+    return msg.as_string().split('\n\n', 1)[0] + '\n\n'
+
+
+def part_chunks(part_file, path, mime_type=MIME_DEFTYPE, encode=None,
+                canonical=False, optimize=False, compress=False):
+    """Generate a message part (headers and encoded body) in chunks.
+
+    The output is identical to that of add_part() for the same arguments, but
+    the headers are generated from a message part with an empty payload, and
+    non-text part contents are read and Base64 encoded CHUNK_SIZE bytes at a
+    time, so that memory use is bounded regardless of part size. Text parts
+    are read whole, as they must be decoded to choose the charset.
+
+    With optimize, parts (unless Base64 encoding is forced) use the encoding
+    that makes them smallest (see smallest_encoding()); non-text parts are
+    then read whole too, to compare the encoded sizes.
+
+    :param part_file: open binary file object for part contents
+    :type part_file: file
+    :param path: pathname of part contents (basename is used for filename=)
+    :type path: str
+    :param mime_type: optional MIME type
+    :type mime_type: str
+    :param encode: optional encoder function (only encode_base64 is supported)
+    :type encode: function(MIMEBase)
+    :param canonical: use single Content-Transfer-Encoding header (fixed order)
+    :type canonical: bool
+    :param optimize: use smallest encoding for each part
+    :type optimize: bool
+    :param compress: with optimize, choose encoding for gzip output
+    :type compress: bool
+    :return: generator of part text chunks
+    :rtype: generator(str)
+    """
+    (maintype, subtype) = mime_type.split('/', 1)
+    text = None
+    if maintype == 'text':
+        # (a py2 file object cannot be wrapped directly)
+        text = io.TextIOWrapper(io.BytesIO(part_file.read()),
+                                encoding='utf-8').read()
+        try:
+            text.encode('us-ascii')
+            charset = 'us-ascii'
+        except UnicodeEncodeError:
+            charset = 'utf-8'
+        msg = MIMEText('', _subtype=subtype, _charset=charset)
+        if optimize and encode is None:
+            (cte, text) = smallest_encoding(text_encodings(text, charset),
+                                            compress)
+            del msg['Content-Transfer-Encoding']
+            msg['Content-Transfer-Encoding'] = cte
+        elif charset != 'us-ascii' or encode is not None:
+            # Base64 encoded (below) like binary parts, rather than 7bit
+            part_file = io.BytesIO(text.encode(charset))
+            text = None
+    else:
+        msg = MIMEBase(maintype, subtype)
+        if optimize and encode is None:
+            (cte, text) = smallest_encoding(
+                binary_encodings(part_file.read()), compress)
+            msg.set_payload('')
+            msg['Content-Transfer-Encoding'] = cte
+        else:
+            msg.set_payload(b'')
+            # Encode the payload using Base64
+            encode = encoders.encode_base64
+
+    if encode is not None:
+        encode(msg)
+
+    if canonical:
+        # encode_base64 appends a second header to forced Base64 text parts
+        cte = msg.get_all('Content-Transfer-Encoding')[-1]
+        del msg['Content-Transfer-Encoding']
+        msg['Content-Transfer-Encoding'] = cte
+
+    # Set the filename parameter
+    # noinspection PyUnresolvedReferences
+    msg.add_header('Content-Disposition', 'attachment',
+                   filename=os.path.basename(path))
+    yield header_block(msg)
+
+    if text is not None:
+        yield text
+    else:
+        data = part_file.read(CHUNK_SIZE)
+        while data:
+            yield ENCODEBYTES(data).decode('ascii')
+            data = part_file.read(CHUNK_SIZE)
+
+
+def message_chunks(part_iters, boundary):
+    """Generate a MIME multi-part message in chunks.
+
+    :param part_iters: chunk iterables for each part, in order, typically
+                       part_chunks() generators (which are only run as the
+                       message is generated)
+    :type part_iters: list(iterable(str))
+    :param boundary: MIME multi-part boundary string
+    :type boundary: str
+    :return: generator of message text chunks
+    :rtype: generator(str)
+    """
+    yield header_block(MIMEMultipart(boundary=boundary))
+    delimiter = '--' + boundary + '\n'
+    for part_iter in part_iters:
+        yield delimiter
+        for chunk in part_iter:
+            yield chunk
+        delimiter = '\n--' + boundary + '\n'
+    yield '\n--' + boundary + '--\n'
+
+
+def write_message(output_file, chunks, compress=False, filename='',
+                  mtime=None, level=9):
+    """Write message chunks to an output file, optionally gzip compressed.
+
+    :param output_file: binary file object to write (encoded) message to
+    :type output_file: file
+    :param chunks: message text chunks
+    :type chunks: iterable(str)
+    :param compress: gzip compress output
+    :type compress: bool
+    :param filename: filename recorded in gzip header
+    :type filename: str
+    :param mtime: timestamp recorded in gzip header (default: current time)
+    :type mtime: int
+    :param level: gzip compression level
+    :type level: int
+    """
+    if compress:
+        gzip_file = gzip.GzipFile(fileobj=output_file, mode='wb',
+                                  filename=filename, mtime=mtime,
+                                  compresslevel=level)
+        for chunk in chunks:
+            gzip_file.write(chunk.encode('utf-8'))
+        gzip_file.close()
+    else:
+        for chunk in chunks:
+            output_file.write(chunk.encode('utf-8'))
+
+
+def smallest_gzip(message, filename='', mtime=None):
+    """Compress a message with the gzip level that makes it smallest.
+
+    :param message: message text
+    :type message: str
+    :param filename: filename recorded in gzip header
+    :type filename: str
+    :param mtime: timestamp recorded in gzip header (default: current time)
+    :type mtime: int
+    :return: compressed message and compression level (highest if equal)
+    :rtype: tuple(bytes, int)
+    """
+    smallest = None
+    for level in range(9, 0, -1):
+        output_file = io.BytesIO()
+        write_message(output_file, [message], True, filename, mtime, level)
+        if smallest is None or len(output_file.getvalue()) < len(smallest[0]):
+            smallest = (output_file.getvalue(), level)
+    return smallest
+
+
+def size_report(output, part_texts, size, data, level, limit):
+    """Report sizes of message parts and output, and check output size.
+
+    :param output: output filename ('-' for standard output)
+    :type output: str
+    :param part_texts: message parts (headers and encoded body)
+    :type part_texts: list(str)
+    :param size: size of (uncompressed) message
+    :type size: int
+    :param data: output
+    :type data: bytes
+    :param level: gzip compression level (None if not compressed)
+    :type level: int
+    :param limit: maximum size of output once Base64 encoded
+    :type limit: int
+    :raises ValueError: if output is larger than limit once Base64 encoded
+    """
+    parser = Parser()
+    for part_text in part_texts:
+        # (only the ASCII headers, which py2 can parse from unicode)
+        headers = parser.parsestr(part_text.split('\n\n', 1)[0],
+                                  headersonly=True)
+        print('{0}: {1} ({2}, {3}): {4} bytes'.format(
+            output, headers.get_filename(), headers.get_content_type(),
+            headers['Content-Transfer-Encoding'],
+            len(part_text.encode('utf-8'))), file=sys.stderr)
+    encoded = (len(data) + 2) // 3 * 4
+    compressed = ''
+    if level is not None:
+        compressed = ' ({0} with gzip -{1})'.format(len(data), level)
+    print('{0}: total {1} bytes{2}, {3} Base64 encoded (limit {4})'.format(
+        output, size, compressed, encoded, limit), file=sys.stderr)
+    if encoded > limit:
+        raise ValueError('{0}: {1} bytes Base64 encoded is over limit of '
+                         '{2}'.format(output, encoded, limit))
+
+
+def part_digests(parts, hashes=None):
+    """Hash the contents and output attributes of message parts.
+
+    Part files are rewound after hashing, so they can still be streamed.
+
+    :param parts: part_chunks() argument tuples for each part, in order
+    :type parts: list(tuple(file, str, str, function))
+    :param hashes: optional content hashes by path, used and updated to hash
+                   part files shared by several messages only once
+    :type hashes: dict
+    :return: basename, MIME type, forced encoding and content hash of parts
+    :rtype: list(list(str, str, bool, str))
+    """
+    if hashes is None:
+        hashes = {}
+    digests = []
+    for (part_file, path, mime_type, encode) in parts:
+        if path not in hashes:
+            digest = hashlib.sha256()
+            data = part_file.read(CHUNK_SIZE)
+            while data:
+                digest.update(data)
+                data = part_file.read(CHUNK_SIZE)
+            part_file.seek(0)
+            hashes[path] = digest.hexdigest()
+        digests.append([os.path.basename(path), mime_type,
+                        encode is not None, hashes[path]])
+    return digests
+
+
+def canonical_boundary(digests):
+    """Derive a MIME boundary from the parts of a message.
 
+    Unlike the default boundary, which depends on the argument count, this
+    depends only on the part contents and attributes (and has the '==' prefix
+    that userdata_decode.py normalizes). It is short enough for py2's email
+    package not to fold the multipart Content-Type header, which would make
+    the output differ between interpreters (and hide the boundary parameter
+    from userdata_decode.py).
+
+    :param digests: part digests from part_digests()
+    :type digests: list(list(str, str, bool, str))
+    :return: MIME multi-part boundary string
+    :rtype: str
+    """
+    digest = hashlib.sha256(json.dumps(digests).encode('utf-8')).hexdigest()
+    return '==cloud-multi-' + digest[:16] + '=='
+
+
+def cache_key(digests, boundary, options):
+    """Compute content-addressed cache key for a multi-part message.
+
+    The key is a hash of everything that determines the output: the contents,
+    basenames, resolved MIME types and encoders of the parts (in order), the
+    boundary, and the options (gzip, default type, delimiter, output name).
+
+    :param digests: part digests from part_digests()
+    :type digests: list(list(str, str, bool, str))
+    :param boundary: MIME multi-part boundary string
+    :type boundary: str
+    :param options: other options affecting output
+    :type options: dict
+    :return: hex digest cache key
+    :rtype: str
+    """
+    material = {'boundary': boundary, 'options': options, 'parts': digests}
+    return hashlib.sha256(
+        json.dumps(material, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def cache_paths(cache_dir, key, target):
+    """Get cache object and target stamp paths for a key and target.
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param key: cache key from cache_key()
+    :type key: str
+    :param target: output filename
+    :type target: str
+    :return: cached output object path, target stamp path
+    :rtype: tuple(str, str)
+    """
+    target_id = hashlib.sha256(os.path.abspath(target).encode('utf-8')).hexdigest()
+    # noinspection PyRedundantParentheses
+    return (os.path.join(cache_dir, 'objects', key),
+            os.path.join(cache_dir, 'targets', target_id))
+
+
+def target_stamp(key, target):
+    """Get stamp recording the cache key and file identity of a target.
+
+    :param key: cache key from cache_key()
+    :type key: str
+    :param target: output filename
+    :type target: str
+    :return: key, inode, size and mtime of target
+    :rtype: list
+    """
+    stat = os.stat(target)
+    return [key, stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+def cache_lookup(cache_dir, key, target):
+    """Bring a target up to date from the cache, if possible.
+
+    If the target stamp shows that the target was written for this key and
+    has not changed since, nothing is read or written at all (only the cached
+    output is touched, for cache_evict()). Otherwise, if
+    the output for this key is cached, the target is left untouched if its
+    contents are identical, or the cached output is copied over it.
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param key: cache key from cache_key()
+    :type key: str
+    :param target: output filename
+    :type target: str
+    :return: True if target is up to date (cache hit), False if not
+    :rtype: bool
+    """
+    (cached, stamp_name) = cache_paths(cache_dir, key, target)
+    try:
+        os.utime(cached, None)
+    except OSError:  # not cached (or evicted)
+        return False
+    if os.path.isfile(target):
+        try:
+            with open(stamp_name) as stamp_file:
+                if json.load(stamp_file) == target_stamp(key, target):
+                    return True
+        except (IOError, ValueError):  # no stamp yet, or corrupted
+            pass
+        if not filecmp.cmp(cached, target, shallow=False):
+            shutil.copyfile(cached, target)
+    else:
+        shutil.copyfile(cached, target)
+    write_stamp(stamp_name, target_stamp(key, target))
+    return True
+
+
+def cache_store(cache_dir, key, target):
+    """Save a (newly written) target in the cache for its key.
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param key: cache key from cache_key()
+    :type key: str
+    :param target: output filename
+    :type target: str
+    """
+    (cached, stamp_name) = cache_paths(cache_dir, key, target)
+    if not os.path.isdir(os.path.dirname(cached)):
+        os.makedirs(os.path.dirname(cached))
+    (temp_fd, temp_name) = tempfile.mkstemp(dir=os.path.dirname(cached))
+    os.close(temp_fd)
+    shutil.copyfile(target, temp_name)
+    os.rename(temp_name, cached)
+    write_stamp(stamp_name, target_stamp(key, target))
+    cache_evict(cache_dir)
+
+
+def cache_evict(cache_dir, entries=CACHE_ENTRIES):
+    """Remove all but the most recently used cached outputs and stamps.
+
+    Temporary files of outputs being stored are left alone (see
+    userdata_decode.cache_evict()).
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param entries: cached outputs (and target stamps) to keep
+    :type entries: int
+    """
+    import userdata_decode
+    for subdir in ('objects', 'targets'):
+        userdata_decode.cache_evict(os.path.join(cache_dir, subdir), entries)
+
+
+def write_stamp(stamp_name, stamp):
+    """Write a target stamp file.
+
+    :param stamp_name: target stamp path
+    :type stamp_name: str
+    :param stamp: stamp from target_stamp()
+    :type stamp: list
+    """
+    if not os.path.isdir(os.path.dirname(stamp_name)):
+        os.makedirs(os.path.dirname(stamp_name))
+    with open(stamp_name, 'w') as stamp_file:
+        json.dump(stamp, stamp_file)
+
+
+def make_parser():
+    """Create command-line argument parser.
+
+    :return: argument parser (also used for each --batch manifest line)
+    :rtype: argparse.ArgumentParser
+    """
     parser = argparse.ArgumentParser(
         epilog='parts are added as follows: positional arguments, '
         'then -e/--encode arguments, and finally -a/--add arguments '
@@ -194,52 +763,354 @@ def main():
                         help="MIME for unknown text (default: '%(default)s')")
     parser.add_argument('--delimiter', dest='delimiter', default=':',
                         help="MIME suffix delimiter (default: '%(default)s')")
+    parser.add_argument('-c', '--cache', dest='cache',
+                        default=os.environ.get(CACHE_ENV),
+                        help='with -o, reuse output cached in DIR if parts '
+                        'and options are unchanged (default: $' + CACHE_ENV +
+                        ')',
+                        metavar='DIR')
+    parser.add_argument('--canonical', dest='canonical', default=False,
+                        help='make output bytes depend only on part contents: '
+                        'boundary from part hashes, no gzip name or time, '
+                        'fixed part headers (default: %(default)s)',
+                        action='store_true')
+    parser.add_argument('-O', '--optimize', dest='optimize', default=False,
+                        help='use the smallest encoding for each part '
+                        '(and gzip level with -z), report part and total '
+                        'sizes, and fail if the output is over --limit '
+                        '(default: %(default)s)', action='store_true')
+    parser.add_argument('--limit', dest='limit', type=int,
+                        default=os.environ.get(LIMIT_ENV, LIMIT_DEFAULT),
+                        help='with --optimize, maximum output size once '
+                        'Base64 encoded, as for OpenStack user_data '
+                        '(default: $' + LIMIT_ENV + ' or ' +
+                        str(LIMIT_DEFAULT) + ')', metavar='BYTES')
+    parser.add_argument('-b', '--batch', dest='batch', default=None,
+                        help='generate several outputs, each line of MANIFEST '
+                        'giving the arguments for one (e.g. -o FILE PARTS...)',
+                        metavar='MANIFEST')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=None, type=int,
+                        help='--batch worker processes (default: CPU count)')
     parser.add_argument('-h', '--help', action='help',
                         help='show this help message and exit')
 
     parser.add_argument('parts', nargs='*',
                         help='part filename and optional MIME type/subtype',
                         metavar='PART_FILE[:MIME/TYPE]')
+    return parser
 
-    args = parser.parse_args()
 
+def prepare_target(parser, args, argc, opener=open_part, hashes=None):
+    """Open the parts and get the boundary and cache key for an output.
+
+    :param parser: argument parser (for reporting errors)
+    :type parser: argparse.ArgumentParser
+    :param args: parsed arguments for output
+    :type args: argparse.Namespace
+    :param argc: command-line argument count (for default boundary)
+    :type argc: int
+    :param opener: function to open parts, with open_part() signature
+    :type opener: function(str, str, str)
+    :param hashes: optional content hashes by path (see part_digests())
+    :type hashes: dict
+    :return: part_chunks() argument tuples, boundary, cache key (or None)
+    :rtype: tuple(list(tuple(file, str, str, function)), str, str)
+    """
     # There is no easy way to preserve command-line ordering; we just output
     # positional args, then encoded args, and finally added (unencoded) args.
-    no_parts = True
+    parts = []
     for arg_list, encoder in [(args.parts, None),
                               (args.encoded_parts, encoders.encode_base64),
                               (args.added_parts, None)]:
         for arg in arg_list:
-            (path, mime) = part_get_mimetype(arg, args.deftype, args.delimiter)
-            add_part(outer, path, mime, encoder)
-            no_parts = False
+            (part_file, path, mime) = opener(arg, args.deftype, args.delimiter)
+            parts.append((part_file, path, mime, encoder))
 
-    if no_parts:
+    if not parts:
         parser.error('No parts specified (at least one PART_FILE required)')
 
-    if args.output is '-':
+    boundary = '==cloud-multi' + ('==' * argc)
+    digests = None
+    if args.canonical or (args.cache and args.output != '-'):
+        digests = part_digests(parts, hashes)
+    if args.canonical:
+        boundary = canonical_boundary(digests)
+    key = None
+    if args.cache and args.output != '-':
+        options = {
+            'canonical': args.canonical, 'compress': args.compress,
+            'deftype': args.deftype, 'delimiter': args.delimiter,
+            'output': os.path.basename(args.output)
+        }
+        if args.optimize:  # (only then, so other keys are unchanged)
+            options.update(optimize=True, limit=args.limit)
+        key = cache_key(digests, boundary, options)
+    # noinspection PyRedundantParentheses
+    return (parts, boundary, key)
+
+
+def target_limit(args):
+    """Get size limit for an output (only checked with --optimize).
+
+    :param args: parsed arguments for output
+    :type args: argparse.Namespace
+    :return: maximum size of output once Base64 encoded (or None)
+    :rtype: int
+    """
+    return args.limit if args.optimize else None
+
+
+def write_target(output, compress, canonical, part_iters, boundary,
+                 limit=None):
+    """Write a MIME multi-part message to an output file (or standard output).
+
+    Parts are streamed from their chunk iterables straight into the output,
+    so the whole message is never held in memory; a part that fails part way
+    through (e.g. undecodable text) leaves no output file.
+
+    With a limit (--optimize), the message is instead assembled in memory,
+    compressed with the gzip level that makes it smallest, and its size is
+    reported and checked before it is written. If it is over the limit, any
+    existing output file is removed, so that a stale one is not used.
+
+    :param output: output filename ('-' for standard output)
+    :type output: str
+    :param compress: gzip compress output
+    :type compress: bool
+    :param canonical: omit filename and time from gzip header
+    :type canonical: bool
+    :param part_iters: chunk iterables for each part, in order
+    :type part_iters: list(iterable(str))
+    :param boundary: MIME multi-part boundary string
+    :type boundary: str
+    :param limit: maximum size of output once Base64 encoded
+    :type limit: int
+    :raises ValueError: if output is larger than limit
+    """
+    data = None
+    if limit is not None:
+        part_texts = [''.join(part_iter) for part_iter in part_iters]
+        message = ''.join(message_chunks([[part_text]
+                                          for part_text in part_texts],
+                                         boundary))
+        data = message.encode('utf-8')
+        level = None
+        if compress:
+            (data, level) = smallest_gzip(message, *(
+                ('', 0) if canonical else (output, None)))
+        try:
+            size_report(output, part_texts, len(message.encode('utf-8')), data,
+                        level, limit)
+        except ValueError:
+            if output != '-' and os.path.exists(output):
+                os.remove(output)
+            raise
+
+    if output == '-':
         if hasattr(sys.stdout, 'buffer'):
             # We want to write bytes not strings
             output_file = sys.stdout.buffer  # pylint: disable=E1101
         else:
             output_file = sys.stdout
     else:
-        output_file = open(args.output, 'wb')
+        output_file = open(output, 'wb')
 
-    if args.compress:
-        gzip_file = gzip.GzipFile(fileobj=output_file, filename=args.output)
-        gzip_file.write(outer.as_string().encode())
-        gzip_file.close()
+    try:
+        if data is not None:
+            output_file.write(data)
+        elif canonical:
+            write_message(output_file, message_chunks(part_iters, boundary),
+                          compress, '', 0)
+        else:
+            write_message(output_file, message_chunks(part_iters, boundary),
+                          compress, output)
+    except (IOError, ValueError):
+        output_file.close()
+        if output != '-':
+            os.remove(output)
+        raise
+    output_file.close()
+
+
+def spool_part(job):
+    """Encode a message part into a spool file (--batch worker).
+
+    :param job: spool filename and part_chunks() arguments (path not file)
+    :type job: tuple(str, str, str, function, bool, bool, bool)
+    """
+    (spool_name, path, mime_type, encode, canonical, optimize, compress) = job
+    with open(path, 'rb') as part_file:
+        with io.open(spool_name, 'w', encoding='utf-8',
+                     newline='') as spool_file:
+            for chunk in part_chunks(part_file, path, mime_type, encode,
+                                     canonical, optimize, compress):
+                spool_file.write(chunk)
+
+
+def spooled_chunks(spool_name):
+    """Generate an encoded message part from its spool file in chunks.
+
+    :param spool_name: spool filename written by spool_part()
+    :type spool_name: str
+    :return: generator of part text chunks
+    :rtype: generator(str)
+    """
+    with io.open(spool_name, encoding='utf-8', newline='') as spool_file:
+        data = spool_file.read(CHUNK_SIZE)
+        while data:
+            yield data
+            data = spool_file.read(CHUNK_SIZE)
+
+
+def assemble_target(job):
+    """Write a MIME multi-part message from spooled parts (--batch worker).
+
+    :param job: write_target() arguments, with spool filenames for parts
+    :type job: tuple(str, bool, bool, list(str), str, int)
+    """
+    (output, compress, canonical, spool_names, boundary, limit) = job
+    write_target(output, compress, canonical,
+                 [spooled_chunks(spool_name) for spool_name in spool_names],
+                 boundary, limit)
+
+
+def batch(parser, manifest, jobs=None):
+    """Generate MIME multi-part user-data files listed in a manifest.
+
+    Each (non-blank, non-comment) manifest line has the (shell-quoted)
+    arguments for one output, e.g. '-o example.userdata example.sh', and
+    the output is identical to running writemime.py with those arguments.
+    Each distinct part file is read, typed, hashed (for --cache/--canonical)
+    and encoded only once, however many outputs it is used in; encoding and
+    assembly of outputs are done in a pool of worker processes.
+
+    :param parser: argument parser (for parsing manifest lines)
+    :type parser: argparse.ArgumentParser
+    :param manifest: manifest filename ('-' for standard input)
+    :type manifest: str
+    :param jobs: number of worker processes (default: CPU count)
+    :type jobs: int
+    :raises IOError: when manifest or part files cannot be read
+    """
+    if manifest == '-':
+        lines = sys.stdin.readlines()
     else:
-        output_file.write(outer.as_string().encode())
+        with open(manifest) as manifest_file:
+            lines = manifest_file.readlines()
 
-    output_file.close()
+    opened = {}
+
+    def opener(part_name, default_mime_type, delimiter):
+        """Open each part (with the same MIME type options) only once."""
+        open_key = (part_name, default_mime_type, delimiter)
+        if open_key not in opened:
+            opened[open_key] = open_part(part_name, default_mime_type,
+                                         delimiter)
+        return opened[open_key]
+
+    hashes = {}
+    spools = {}
+    targets = []
+    spool_dir = tempfile.mkdtemp(prefix=str('writemime.'))
+    try:
+        for line in lines:
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            args = parser.parse_args(argv)
+            if args.batch is not None or args.output == '-':
+                parser.error("manifest line needs -o FILE and no --batch: '" +
+                             line.strip() + "'")
+            (parts, boundary, key) = prepare_target(parser, args, len(argv) + 1,
+                                                    opener, hashes)
+            if key is not None and cache_lookup(args.cache, key, args.output):
+                continue
+            spool_names = []
+            for (_, path, mime, encoder) in parts:
+                spool_key = (path, mime, encoder, args.canonical,
+                             args.optimize, args.optimize and args.compress)
+                if spool_key not in spools:
+                    spools[spool_key] = os.path.join(spool_dir,
+                                                     str(len(spools)))
+                spool_names.append(spools[spool_key])
+            targets.append((args, key, (args.output, args.compress,
+                                        args.canonical, spool_names, boundary,
+                                        target_limit(args))))
+
+        spool_jobs = [(spool_name,) + spool_key
+                      for (spool_key, spool_name) in spools.items()]
+        if jobs == 1 or len(targets) < 2:
+            list(map(spool_part, spool_jobs))
+            list(map(assemble_target, [target[2] for target in targets]))
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                pool.map(spool_part, spool_jobs)
+                pool.map(assemble_target, [target[2] for target in targets])
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for (args, key, _) in targets:
+            if key is not None:
+                cache_store(args.cache, key, args.output)
+            if phasetime is not None:
+                phasetime.processed(os.path.getsize(args.output))
+
+    finally:
+        for (part_file, _, _) in opened.values():
+            part_file.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def main():
+    """Generate MIME multi-part user-data file from specified parts.
+
+    :raises IOError: (FileNotFoundError) when specified part file not found
+    :raises IOError: (PermissionError) when specified part file cannot be read
+    """
+    parser = make_parser()
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        if (args.parts or args.encoded_parts or args.added_parts or
+                args.output != '-' or args.compress or args.canonical or
+                args.optimize or args.limit != int(parser.get_default('limit')) or
+                args.deftype != parser.get_default('deftype') or
+                args.delimiter != parser.get_default('delimiter')):
+            parser.error('with --batch, parts and options go in MANIFEST')
+        batch(parser, args.batch, args.jobs)
+        return
+
+    parts = []
+    try:
+        (parts, boundary, key) = prepare_target(parser, args, len(sys.argv))
+        if key is not None and cache_lookup(args.cache, key, args.output):
+            return
+
+        write_target(args.output, args.compress, args.canonical,
+                     [part_chunks(*part, canonical=args.canonical,
+                                  optimize=args.optimize,
+                                  compress=args.compress)
+                      for part in parts], boundary, target_limit(args))
+
+        if key is not None:
+            cache_store(args.cache, key, args.output)
+        if phasetime is not None and args.output != '-':
+            phasetime.processed(os.path.getsize(args.output))
+
+    finally:
+        for part in parts:
+            part[0].close()
 
 if __name__ == '__main__':
     try:
-        main()
+        if phasetime is None:
+            main()
+        else:
+            phasetime.main_timed('writemime', main)
         sys.exit(0)
-    except IOError as err:
+    except (IOError, ValueError) as err:
         print('{0}: {1}'.format(os.path.basename(sys.argv[0]), err),
               file=sys.stderr)
         sys.exit(1)